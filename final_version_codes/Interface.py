@@ -7,6 +7,7 @@ from PIL import Image, ImageTk
 from user_system.usr_manage_system import UserSystem
 from car_system.car_manage_system import ParkingLotSystem
 from data_export_system.data_export_system import DataExportImport
+from monitoring.metrics import configure_from_environment
 
 
 class MainMenuApp:
@@ -16,11 +17,12 @@ class MainMenuApp:
     Attributes:
     root: The main window
     user_system: The user system object
-    logged_in: A boolean indicating if the user is logged in
+    logged_in: Whether the session of this terminal is open, it ends after its TTL or idle timeout
     car_system: The car management system object
     data_export_system: The data export/import system object
 
     Methods:
+    require_session: Check the session before an action
     create_main_menu: Create the main menu
     after_login: Callback after successful login
     car_management: Car management function
@@ -32,12 +34,28 @@ class MainMenuApp:
         self.root = root
         self.root.title("Welcome to the Parking lot Management System!")
         self.user_system = UserSystem(root, self.create_main_menu)
-        self.logged_in = False
+        # Every click is operator activity, it keeps the session from its idle timeout (an O(1) lookup)
+        self.root.bind_all("<ButtonRelease-1>", lambda event: self.user_system.current_user(), add="+")
         self.car_system = ParkingLotSystem(root)
         self.data_export_system = DataExportImport(
-            root, self.car_system.parking_records, self.car_system.history_records)
+            root, self.car_system.parking_records, self.car_system.history_records,
+            self.car_system.engine.storage)
         self.create_main_menu()
 
+    @property
+    def logged_in(self):
+        return self.user_system.current_user() is not None
+
+    def require_session(self):
+        '''
+        This method checks the session before an action, and goes back to the main menu if it ended.
+        '''
+        if self.logged_in:
+            return True
+        messagebox.showinfo("Session expired", "Your session has expired. Please log in again.")
+        self.create_main_menu()
+        return False
+
     def create_main_menu(self):
         '''
         This method creates the main menu, which is the first screen the user sees when they open the application.
@@ -81,15 +99,16 @@ class MainMenuApp:
 
     def after_login(self):
         '''
-        This method is called after the user has successfully logged in.
+        This method is called after the user has successfully logged in, the session is already open.
         '''
-        self.logged_in = True
         self.create_main_menu()
 
     def car_management(self):
         '''
         This method displays the car management screen. Using the ParkingLotSystem class, the user can manage the parking lot.
         '''
+        if not self.require_session():
+            return
         self.car_system.manage_screen()
         tk.Button(self.root, text="Back to Main Menu", font=("Times New Roman", 14),
                   command=self.create_main_menu).pack(pady=10)
@@ -98,6 +117,8 @@ class MainMenuApp:
         '''
         This method displays the data export/import screen. Using the DataExportImport class, the user can export and import parking records.
         '''
+        if not self.require_session():
+            return
         self.data_export_system.export_import_data()
         tk.Button(self.root, text="Back to Main Menu", font=("Times New Roman", 14),
                   command=self.create_main_menu).pack(pady=10)
@@ -106,12 +127,13 @@ class MainMenuApp:
         '''
         This method allows the user to logout of the system.
         '''
-        self.logged_in = False
+        self.user_system.logout()
         messagebox.showinfo("Logout", "You have been logged out successfully.")
         self.create_main_menu()
 
 
 if __name__ == "__main__":
+    configure_from_environment()
     root = tk.Tk()
     root.geometry("1000x800")
     app = MainMenuApp(root)
@@ -0,0 +1,358 @@
+'''
+This module benchmarks the hot paths of the parking lot system on synthetic traffic, without any interface:
+saving and loading the history, the vehicle entries and exits, the paged history queries and the exports
+of DataExportImport. The suite drives the ParkingEngine directly, not the Tk ParkingLotSystem: the timings
+are those of the logic and the storage, without the interface.
+Every scenario runs in its own process, so its peak memory is measured alone, and reports its
+events (or records) per second, the p50/p99 latency of one event and the peak memory.
+The results can be saved as JSON and compared with a previous run to catch the regressions.
+
+Run it from the final_version_codes folder:
+    python -m benchmark.run_benchmarks [--sizes 10000 1000000 10000000] [--output FILE] [--baseline FILE]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+from benchmark.traffic import EPOCH, generate_traffic, traffic_events
+try:
+    import resource
+except ImportError:  # Windows, the peak memory is read with psutil
+    resource = None
+
+DEFAULT_SIZES = (10_000, 1_000_000, 10_000_000)
+SCENARIOS = ("save", "load", "entry_exit", "query", "export")
+LIVE_EVENTS = 100_000
+QUERIES = 1_000
+EXPORT_ROWS = 100_000
+EXCEL_MAX_ROWS = 1_048_575
+
+
+def _paths(workdir):
+    '''
+    This function returns the files of a benchmark folder.
+    '''
+    return {name: os.path.join(workdir, file_name) for name, file_name in (
+        ("parking_file", "parking_records.csv"), ("history_file", "history_records.csv"),
+        ("tombstone_file", "tombstones.txt"), ("log_file", "events.log"), ("checkpoint_file", "checkpoint.json"))}
+
+
+def _open_storage(workdir):
+    '''
+    This function opens the CSV storage of a benchmark folder, with its own event log.
+    '''
+    from car_system.event_log import EventLog
+    from car_system.record_storage import CsvRecordStorage
+    os.makedirs(workdir, exist_ok=True)
+    paths = _paths(workdir)
+    return CsvRecordStorage(paths["parking_file"], paths["history_file"],
+                            EventLog(paths["log_file"], paths["checkpoint_file"]), paths["tombstone_file"])
+
+
+def _fill_history(storage, size, seed):
+    '''
+    This function puts size synthetic historical records in the history of a storage.
+    '''
+    from car_system.tariff import Tariff
+    plates, entry, exit_ = generate_traffic(size, np.random.default_rng(seed))
+    _, fees = Tariff().compute_fees(entry, exit_)
+    storage.active_history.append_columns(plates, entry, exit_, fees)
+    return plates
+
+
+def _peak_memory_mb():
+    '''
+    This function returns the peak resident memory of the process in MB.
+    '''
+    if resource is None:
+        import psutil
+        memory = psutil.Process().memory_info()
+        return getattr(memory, "peak_wset", memory.rss) / 1024 / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def _result(count, seconds, latencies=None):
+    '''
+    This function builds the result of a scenario from its number of events, duration and event latencies.
+    '''
+    result = {
+        "events": count,
+        "seconds": round(seconds, 3),
+        "events_per_second": round(count / seconds, 1) if seconds > 0 else None,
+        "p50_ms": None,
+        "p99_ms": None,
+    }
+    if latencies is not None and len(latencies):
+        p50, p99 = np.percentile(np.asarray(latencies) / 1e6, [50, 99])
+        result["p50_ms"], result["p99_ms"] = round(float(p50), 4), round(float(p99), 4)
+    return result
+
+
+def prepare(workdir, size, seed):
+    '''
+    This function writes the history file of size records the other scenarios start from.
+    '''
+    storage = _open_storage(workdir)
+    _fill_history(storage, size, seed)
+    storage.save_history_records()
+    storage.close()
+
+
+def bench_save(workdir, size, seed, options):
+    '''
+    This function measures the full rewrite of the history file, i.e. a history compaction.
+    '''
+    storage = _open_storage(os.path.join(workdir, "save"))
+    _fill_history(storage, size, seed)
+    start = time.perf_counter()
+    storage.save_history_records()
+    seconds = time.perf_counter() - start
+    storage.close()
+    return _result(size, seconds)
+
+
+def bench_load(workdir, size, seed, options):
+    '''
+    This function measures the startup of the storage, i.e. loading the history file.
+    '''
+    start = time.perf_counter()
+    storage = _open_storage(workdir)
+    seconds = time.perf_counter() - start
+    loaded = len(storage.history_records)
+    storage.close()
+    return _result(loaded, seconds)
+
+
+def bench_entry_exit(workdir, size, seed, options):
+    '''
+    This function measures the vehicle entries and exits of the ParkingEngine on top of the history,
+    with the event log and its compactions, each event timed alone.
+    '''
+    from car_system.parking_engine import ParkingEngine, ParkingError
+    live = os.path.join(workdir, "entry_exit")
+    os.makedirs(live)
+    shutil.copy(_paths(workdir)["history_file"], _paths(live)["history_file"])
+    engine = ParkingEngine(_open_storage(live))
+    stays = max(1, options["events"] // 2)
+    plates, entry, exit_ = generate_traffic(stays, np.random.default_rng(seed + 1),
+                                            start=datetime(2030, 1, 1), days=max(1, stays // 2000))
+    plates = plates.tolist()
+    latencies = np.zeros(2 * stays, dtype=np.int64)
+    parked = np.zeros(stays, dtype=bool)
+    count = 0
+    start = time.perf_counter()
+    for timestamp, is_exit, index in traffic_events(entry, exit_):
+        if is_exit and not parked[index]:
+            continue  # The entry was refused, the plate was already parked
+        event_time = EPOCH + timedelta(seconds=timestamp)
+        begin = time.perf_counter_ns()
+        try:
+            if is_exit:
+                engine.exit(plates[index], event_time)
+            else:
+                engine.enter(plates[index], event_time)
+                parked[index] = True
+        except ParkingError:
+            continue
+        latencies[count] = time.perf_counter_ns() - begin
+        count += 1
+    seconds = time.perf_counter() - start
+    engine.close()
+    return _result(count, seconds, latencies[:count])
+
+
+def bench_query(workdir, size, seed, options):
+    '''
+    This function measures the history view queries: a count and the first page of a plate search.
+    '''
+    from car_system.parking_engine import ParkingEngine
+    engine = ParkingEngine(_open_storage(workdir))
+    plates = engine.storage.history_plates()
+    rng = np.random.default_rng(seed + 2)
+    picks = rng.integers(0, len(plates), size=options["queries"]) if plates else []
+    latencies = np.zeros(len(picks), dtype=np.int64)
+    start = time.perf_counter()
+    for number, pick in enumerate(picks):
+        begin = time.perf_counter_ns()
+        engine.history_count(plate=plates[pick])
+        engine.history_page(0, 100, plate=plates[pick])
+        latencies[number] = time.perf_counter_ns() - begin
+    seconds = time.perf_counter() - start
+    engine.close()
+    return _result(len(picks), seconds, latencies)
+
+
+def bench_export(workdir, size, seed, options):
+    '''
+    This function measures the Excel export of DataExportImport, on at most export_rows records
+    since an Excel sheet is limited to about one million rows.
+    '''
+    from data_export_system.data_export_system import DataExportImport
+    storage = _open_storage(workdir)
+    rows = min(size, options["export_rows"], EXCEL_MAX_ROWS)
+    records = storage.history_records[:rows]
+    exporter = DataExportImport(None, storage.parking_records, storage.history_records)
+    start = time.perf_counter()
+    exporter.write_history_records(os.path.join(workdir, "export.xlsx"), records)
+    seconds = time.perf_counter() - start
+    storage.close()
+    return _result(rows, seconds)
+
+
+BENCHMARKS = {
+    "save": bench_save,
+    "load": bench_load,
+    "entry_exit": bench_entry_exit,
+    "query": bench_query,
+    "export": bench_export,
+}
+
+
+def _run_in_process(name, workdir, size, seed, options):
+    '''
+    This function runs one scenario inside its worker process and adds its peak memory to the result.
+    '''
+    result = BENCHMARKS[name](workdir, size, seed, options)
+    result["peak_memory_mb"] = round(_peak_memory_mb(), 1)
+    return result
+
+
+def _in_fresh_process(function, *args):
+    '''
+    This function runs a function in a new process, so its memory is measured alone.
+    '''
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, scenarios=SCENARIOS, seed=1, events=LIVE_EVENTS,
+                   queries=QUERIES, export_rows=EXPORT_ROWS, workdir=None):
+    '''
+    This function runs the scenarios for every size of history and prints a line per result as it finishes.
+
+    ***Parameters***
+    sizes: list of int
+        The numbers of historical records.
+    scenarios: list of str
+        The scenarios of BENCHMARKS to run.
+    seed: int
+        The seed of the synthetic traffic.
+    events: int
+        The number of entry/exit events of the entry_exit scenario.
+    queries: int
+        The number of plate searches of the query scenario.
+    export_rows: int
+        The maximum number of records of the export scenario.
+    workdir: str
+        The folder of the benchmark files, a temporary folder by default.
+
+    ***Returns***
+    list
+        One result dictionary per size and scenario.
+    '''
+    options = {"events": events, "queries": queries, "export_rows": export_rows}
+    print(f"{'scenario':<11} {'records':>11} {'events/s':>14} {'p50 ms':>10} {'p99 ms':>10} {'peak MB':>12}")
+    results = []
+    for size in sizes:
+        size_dir = tempfile.mkdtemp(prefix=f"parking_benchmark_{size}_", dir=workdir)
+        try:
+            _in_fresh_process(prepare, size_dir, size, seed)
+            for name in scenarios:
+                result = _in_fresh_process(_run_in_process, name, size_dir, size, seed, options)
+                results.append({"scenario": name, "size": size, **result})
+                print(_format_row(results[-1]), flush=True)
+        finally:
+            shutil.rmtree(size_dir, ignore_errors=True)
+    return results
+
+
+def _format_row(result):
+    '''
+    This function formats one result as a line of the report.
+    '''
+    def number(value, digits=1):
+        return "-" if value is None else f"{value:,.{digits}f}"
+    return (f"{result['scenario']:<11} {result['size']:>11,} {number(result['events_per_second']):>14} "
+            f"{number(result['p50_ms'], 3):>10} {number(result['p99_ms'], 3):>10} "
+            f"{number(result['peak_memory_mb']):>12}")
+
+
+def compare(results, baseline, tolerance):
+    '''
+    This function compares the throughput of the results with a previous run.
+
+    ***Returns***
+    list
+        A message per scenario and size slower than the baseline by more than the tolerance.
+    '''
+    previous = {(result["scenario"], result["size"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["scenario"], result["size"]))
+        if not old or not old["events_per_second"] or not result["events_per_second"]:
+            continue
+        change = result["events_per_second"] / old["events_per_second"] - 1
+        if change < -tolerance:
+            regressions.append(f"{result['scenario']} at {result['size']:,} records: "
+                               f"{old['events_per_second']:,.1f} -> {result['events_per_second']:,.1f} "
+                               f"events/s ({change:+.0%})")
+    return regressions
+
+
+def main(argv=None):
+    '''
+    This function runs the benchmarks given on the command line, prints the report and saves it.
+    It exits with status 1 if a scenario regressed compared with the baseline.
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark the parking lot hot paths on synthetic traffic.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Numbers of historical records (default: 10000 1000000 10000000).")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS),
+                        help="Scenarios to run (default: all).")
+    parser.add_argument("--events", type=int, default=LIVE_EVENTS,
+                        help="Entry/exit events of the entry_exit scenario.")
+    parser.add_argument("--queries", type=int, default=QUERIES,
+                        help="Plate searches of the query scenario.")
+    parser.add_argument("--export-rows", type=int, default=EXPORT_ROWS,
+                        help="Maximum records of the export scenario.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic traffic.")
+    parser.add_argument("--workdir", default=None, help="Folder of the benchmark files (default: temporary).")
+    parser.add_argument("--output", default=None, help="JSON file to save the results to.")
+    parser.add_argument("--baseline", default=None, help="JSON results of a previous run to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Throughput drop reported as a regression (default: 0.2, i.e. 20%%).")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.scenarios, args.seed, args.events,
+                             args.queries, args.export_rows, args.workdir)
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, mode="w") as file:
+            json.dump(report, file, indent=1)
+    if args.baseline:
+        with open(args.baseline, mode="r") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for message in regressions:
+            print(f"Regression: {message}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
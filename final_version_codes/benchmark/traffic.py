@@ -0,0 +1,118 @@
+'''
+This module generates synthetic parking traffic for the benchmarks: plates in several national formats,
+arrivals following a daily curve with morning and evening peaks and quieter weekends, and stays mixing
+short visits and commuter days. Everything is drawn with NumPy from a seed, so a run is reproducible.
+'''
+
+from datetime import datetime
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1)
+LETTERS = np.array(list("ABCDEFGHJKLMNPQRSTUVWXYZ"))
+DIGITS = np.array(list("0123456789"))
+ALPHANUMERICS = np.concatenate((LETTERS, DIGITS))
+PROVINCES = np.array(list("京津沪渝冀豫云辽黑湘皖鲁新苏浙赣鄂桂甘晋蒙陕吉闽贵粤青藏川宁琼"))
+# A plate format is a list of character sets, a str being a literal character
+PLATE_FORMATS = {
+    "cn": [PROVINCES, LETTERS, ALPHANUMERICS, ALPHANUMERICS, ALPHANUMERICS, DIGITS, DIGITS],
+    "us": [LETTERS, LETTERS, LETTERS, "-", DIGITS, DIGITS, DIGITS, DIGITS],
+    "eu": [LETTERS, LETTERS, DIGITS, DIGITS, " ", LETTERS, LETTERS, LETTERS],
+}
+PLATE_FORMAT_SHARES = {"cn": 0.6, "us": 0.25, "eu": 0.15}
+# The share of the arrivals of a weekday in each hour, the weekends are flatter and half as busy
+WEEKDAY_ARRIVALS = np.array([1, 1, 1, 1, 2, 4, 8, 14, 16, 10, 7, 7, 8, 7, 6, 6, 7, 9, 10, 8, 6, 4, 3, 2], dtype=float)
+WEEKEND_ARRIVALS = np.array([1, 1, 1, 1, 1, 1, 2, 3, 5, 7, 9, 10, 10, 10, 9, 9, 8, 7, 6, 5, 4, 3, 2, 1], dtype=float)
+WEEKEND_FACTOR = 0.5
+# The stays are short visits (median 45 minutes) or commuter days (median 9 hours)
+SHORT_STAY_MEDIAN_MINUTES = 45
+LONG_STAY_MEDIAN_MINUTES = 9 * 60
+LONG_STAY_SHARE = 0.3
+
+
+def generate_plates(count, rng, formats=PLATE_FORMAT_SHARES):
+    '''
+    This function generates random plates, mixing the formats of PLATE_FORMATS.
+    The characters are drawn as a (count, length) array of single characters and viewed as strings,
+    so no Python string is built per plate.
+
+    ***Parameters***
+    count: int
+        The number of plates.
+    rng: numpy.random.Generator
+        The random generator.
+    formats: dict
+        The share of each format.
+
+    ***Returns***
+    numpy.ndarray
+        The plates, they are not guaranteed to be distinct.
+    '''
+    names = list(formats)
+    shares = np.array([formats[name] for name in names], dtype=float)
+    choice = rng.choice(len(names), size=count, p=shares / shares.sum())
+    width = max(len(PLATE_FORMATS[name]) for name in names)
+    plates = np.empty(count, dtype=f"<U{width}")
+    for index, name in enumerate(names):
+        rows = np.flatnonzero(choice == index)
+        pattern = PLATE_FORMATS[name]
+        chars = np.empty((len(rows), len(pattern)), dtype="<U1")
+        for position, charset in enumerate(pattern):
+            chars[:, position] = charset if isinstance(charset, str) \
+                else charset[rng.integers(0, len(charset), size=len(rows))]
+        plates[rows] = chars.view(f"<U{len(pattern)}").reshape(-1)
+    return plates
+
+
+def generate_traffic(count, rng, start=datetime(2024, 1, 1), days=None, distinct_ratio=0.25):
+    '''
+    This function generates the stays of a synthetic parking lot, sorted by entry time.
+
+    ***Parameters***
+    count: int
+        The number of stays.
+    rng: numpy.random.Generator
+        The random generator.
+    start: datetime
+        The first day of the traffic.
+    days: int
+        The number of days the stays are spread over, about 2000 stays a day by default.
+    distinct_ratio: float
+        The number of distinct plates per stay, the regular customers come back.
+
+    ***Returns***
+    numpy.ndarray, numpy.ndarray, numpy.ndarray
+        The plates, and the entry and exit times as int64 epoch seconds.
+    '''
+    days = days or max(1, count // 2000)
+    first_day = (start - EPOCH).days
+    day_of_week = (np.arange(days) + start.weekday()) % 7
+    day_weights = np.where(day_of_week >= 5, WEEKEND_FACTOR, 1.0)
+    day = rng.choice(days, size=count, p=day_weights / day_weights.sum())
+    weekend = day_of_week[day] >= 5
+    hour = np.where(weekend,
+                    rng.choice(24, size=count, p=WEEKEND_ARRIVALS / WEEKEND_ARRIVALS.sum()),
+                    rng.choice(24, size=count, p=WEEKDAY_ARRIVALS / WEEKDAY_ARRIVALS.sum()))
+    entry = (first_day + day) * 86400 + hour * 3600 + rng.integers(0, 3600, size=count)
+    long_stay = rng.random(count) < LONG_STAY_SHARE
+    median = np.where(long_stay, LONG_STAY_MEDIAN_MINUTES, SHORT_STAY_MEDIAN_MINUTES) * 60
+    dwell = np.maximum(60, median * rng.lognormal(0.0, 0.5, size=count)).astype(np.int64)
+    order = np.argsort(entry, kind="stable")
+    entry = entry[order].astype(np.int64)
+    pool = generate_plates(max(1, int(count * distinct_ratio)), rng)
+    plates = pool[rng.integers(0, len(pool), size=count)]
+    return plates, entry, entry + dwell[order]
+
+
+def traffic_events(entry, exit_):
+    '''
+    This function merges the entries and exits of some stays into one chronological stream.
+
+    ***Returns***
+    generator
+        (time, is_exit, index) tuples, time being epoch seconds and index the stay.
+    '''
+    times = np.concatenate((entry, exit_))
+    order = np.argsort(times, kind="stable")
+    count = len(entry)
+    for position in order.tolist():
+        yield int(times[position]), position >= count, position % count
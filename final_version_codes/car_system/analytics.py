@@ -0,0 +1,320 @@
+import threading
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+import numpy as np
+from car_system.tariff import to_epoch_seconds
+
+DWELL_BINS_MINUTES = (15, 30, 60, 120, 240, 480, 1440)
+EPOCH = datetime(1970, 1, 1)
+
+
+def summarize_history(entry, exit_, fee, dwell_bins_minutes=DWELL_BINS_MINUTES, window_hours=0, last_hour=None):
+    '''
+    This function aggregates historical records given by column, for TrafficAnalytics.seed.
+    The summaries of several parts of the history, e.g. of the partitions, are added up with merge_summaries.
+
+    ***Parameters***
+    entry, exit_: numpy.ndarray
+        The entry and exit times, int64 epoch seconds.
+    fee: numpy.ndarray
+        The fees.
+    dwell_bins_minutes: tuple
+        The upper bounds of the dwell time histogram bins.
+    window_hours: int
+        The number of hours of hourly traffic, none by default.
+    last_hour: int
+        The epoch hour ending the hourly traffic, the hour of the last exit by default.
+
+    ***Returns***
+    dict
+        "dwell_bins_minutes", "arrivals_by_hour", "departures_by_hour" and "dwell_histogram" lists,
+        "dwell_count", "dwell_seconds", "revenue_by_day" ("YYYY-MM-DD" -> fees), "revenue_by_month"
+        ("YYYY-MM" -> fees), "total_revenue", "last_exit" (epoch seconds, None without records)
+        and "hourly_traffic" (epoch hour -> [arrivals, departures]).
+    '''
+    entry = np.asarray(entry, dtype=np.int64)
+    exit_ = np.asarray(exit_, dtype=np.int64)
+    fee = np.asarray(fee, dtype=np.float64)
+    bounds = np.array([minutes * 60 for minutes in dwell_bins_minutes], dtype=np.int64)
+    dwell = exit_ - entry
+    exit_days = (exit_ // 86400).astype("datetime64[D]")
+    days, day_inverse = np.unique(exit_days, return_inverse=True)
+    months, month_inverse = np.unique(exit_days.astype("datetime64[M]"), return_inverse=True)
+    summary = {
+        "dwell_bins_minutes": list(dwell_bins_minutes),
+        "arrivals_by_hour": np.bincount((entry % 86400) // 3600, minlength=24).tolist(),
+        "departures_by_hour": np.bincount((exit_ % 86400) // 3600, minlength=24).tolist(),
+        "dwell_histogram": np.bincount(np.searchsorted(bounds, dwell, side="right"),
+                                       minlength=len(bounds) + 1).tolist(),
+        "dwell_count": len(dwell),
+        "dwell_seconds": float(dwell.sum()),
+        "revenue_by_day": {str(day): total for day, total
+                           in zip(days, np.bincount(day_inverse, fee, minlength=len(days)).tolist())},
+        "revenue_by_month": {str(month): total for month, total
+                             in zip(months, np.bincount(month_inverse, fee, minlength=len(months)).tolist())},
+        "total_revenue": float(fee.sum()),
+        "last_exit": int(exit_.max()) if len(exit_) else None,
+        "hourly_traffic": {},
+    }
+    if window_hours and len(exit_):
+        last = int(exit_.max()) // 3600 if last_hour is None else last_hour
+        first = last - window_hours + 1
+        entry_hours, exit_hours = entry // 3600, exit_ // 3600
+        entry_hours = entry_hours[(entry_hours >= first) & (entry_hours <= last)]
+        exit_hours = exit_hours[(exit_hours >= first) & (exit_hours <= last)]
+        arrivals = np.bincount(entry_hours - first, minlength=window_hours)
+        departures = np.bincount(exit_hours - first, minlength=window_hours)
+        for offset in np.flatnonzero(arrivals + departures):
+            summary["hourly_traffic"][int(first + offset)] = [int(arrivals[offset]), int(departures[offset])]
+    return summary
+
+
+def merge_summaries(summaries, dwell_bins_minutes=DWELL_BINS_MINUTES):
+    '''
+    This function adds up the summaries of parts of the history, see summarize_history.
+    They must have the same dwell time bins.
+    '''
+    merged = summarize_history([], [], [], dwell_bins_minutes)
+    for summary in summaries:
+        if summary["dwell_bins_minutes"] != merged["dwell_bins_minutes"]:
+            raise ValueError("The summaries have different dwell time bins")
+        for key in ("arrivals_by_hour", "departures_by_hour", "dwell_histogram"):
+            merged[key] = [total + count for total, count in zip(merged[key], summary[key])]
+        for key in ("dwell_count", "dwell_seconds", "total_revenue"):
+            merged[key] += summary[key]
+        for key in ("revenue_by_day", "revenue_by_month"):
+            for period, total in summary[key].items():
+                merged[key][period] = merged[key].get(period, 0.0) + total
+        for hour, (arrivals, departures) in summary["hourly_traffic"].items():
+            counts = merged["hourly_traffic"].setdefault(hour, [0, 0])
+            counts[0] += arrivals
+            counts[1] += departures
+        if summary["last_exit"] is not None:
+            merged["last_exit"] = max(merged["last_exit"] or 0, summary["last_exit"])
+    return merged
+
+
+class TrafficAnalytics:
+    '''
+    This is a class for the occupancy and traffic statistics of the parking lot.
+    It listens to the entries and exits of a ParkingEngine and keeps its aggregates up to date
+    in O(1) per event, so the dashboards and reports read them instead of rescanning the history.
+    seed builds the aggregates of the existing records once, at startup, and on_delete takes
+    the deleted historical records back out.
+
+    Attributes:
+    occupancy: The number of vehicles in the parking lot.
+    peak_occupancy: The highest occupancy seen, and peak_time when it was reached.
+    arrivals_by_hour, departures_by_hour: The number of entries and exits by hour of the day (0-23).
+    hourly_traffic: The [arrivals, departures] of each of the last window_hours hours, by hour start.
+    dwell_bins_minutes: The upper bounds of the dwell time histogram bins, the last bin has no bound.
+    dwell_histogram: The number of stays in each dwell time bin.
+    dwell_count, dwell_seconds: The number and total duration of the stays.
+    revenue_by_day, revenue_by_month: The fees by exit date and by exit month ("YYYY-MM").
+    total_revenue: The sum of all the fees.
+
+    Methods:
+    on_entry: Count a vehicle entry.
+    on_exit: Count a vehicle exit.
+    on_delete: Uncount deleted historical records.
+    seed: Build the aggregates of the existing records.
+    average_dwell: Return the average stay duration.
+    busiest_hours: Return the hours of the day with the most arrivals.
+    snapshot: Return a copy of all the aggregates.
+    '''
+
+    def __init__(self, dwell_bins_minutes=DWELL_BINS_MINUTES, window_hours=7 * 24):
+        self.dwell_bins_minutes = tuple(dwell_bins_minutes)
+        self.window_hours = window_hours
+        self.occupancy = 0
+        self.peak_occupancy = 0
+        self.peak_time = None
+        self.arrivals_by_hour = [0] * 24
+        self.departures_by_hour = [0] * 24
+        self.hourly_traffic = {}
+        self._newest_hour = None
+        self.dwell_histogram = [0] * (len(self.dwell_bins_minutes) + 1)
+        self.dwell_count = 0
+        self.dwell_seconds = 0.0
+        self.revenue_by_day = {}
+        self.revenue_by_month = {}
+        self.total_revenue = 0.0
+        self._dwell_bounds = [minutes * 60 for minutes in self.dwell_bins_minutes]
+        self._lock = threading.Lock()
+
+    def _hour_bucket(self, time, column):
+        '''
+        This method counts an event in the bucket of its hour, and drops the buckets older than the window.
+        The buckets are only scanned when a new hour starts, i.e. once per hour.
+        '''
+        hour = time.replace(minute=0, second=0, microsecond=0)
+        bucket = self.hourly_traffic.get(hour)
+        if bucket is None:
+            if self._newest_hour is not None and hour <= self._newest_hour - timedelta(hours=self.window_hours):
+                return  # A late event, already out of the window
+            bucket = self.hourly_traffic[hour] = [0, 0]
+            if self._newest_hour is None or hour > self._newest_hour:
+                self._newest_hour = hour
+                oldest = hour - timedelta(hours=self.window_hours)
+                for expired in [other for other in self.hourly_traffic if other <= oldest]:
+                    del self.hourly_traffic[expired]
+        bucket[column] += 1
+
+    def on_entry(self, plate, entry_time):
+        '''
+        This method counts a vehicle entry.
+        '''
+        with self._lock:
+            self.occupancy += 1
+            if self.occupancy > self.peak_occupancy:
+                self.peak_occupancy = self.occupancy
+                self.peak_time = entry_time
+            self.arrivals_by_hour[entry_time.hour] += 1
+            if self.window_hours:
+                self._hour_bucket(entry_time, 0)
+
+    def on_exit(self, receipt):
+        '''
+        This method counts a vehicle exit from its Receipt.
+        '''
+        with self._lock:
+            self.occupancy = max(0, self.occupancy - 1)
+            self.departures_by_hour[receipt.exit_time.hour] += 1
+            if self.window_hours:
+                self._hour_bucket(receipt.exit_time, 1)
+            dwell = (receipt.exit_time - receipt.entry_time).total_seconds()
+            self.dwell_histogram[bisect_right(self._dwell_bounds, dwell)] += 1
+            self.dwell_count += 1
+            self.dwell_seconds += dwell
+            day = receipt.exit_time.date()
+            month = receipt.exit_time.strftime("%Y-%m")
+            self.revenue_by_day[day] = self.revenue_by_day.get(day, 0.0) + receipt.fee
+            self.revenue_by_month[month] = self.revenue_by_month.get(month, 0.0) + receipt.fee
+            self.total_revenue += receipt.fee
+
+    def on_delete(self, records):
+        '''
+        This method takes deleted historical (plate, entry time, exit time, fee) records out of the aggregates.
+        The hourly traffic only changes for the hours still in its window.
+        '''
+        with self._lock:
+            for _, entry_time, exit_time, fee in records:
+                self.arrivals_by_hour[entry_time.hour] -= 1
+                self.departures_by_hour[exit_time.hour] -= 1
+                for time, column in ((entry_time, 0), (exit_time, 1)):
+                    bucket = self.hourly_traffic.get(time.replace(minute=0, second=0, microsecond=0))
+                    if bucket is not None:
+                        bucket[column] -= 1
+                dwell = (exit_time - entry_time).total_seconds()
+                self.dwell_histogram[bisect_right(self._dwell_bounds, dwell)] -= 1
+                self.dwell_count -= 1
+                self.dwell_seconds -= dwell
+                day = exit_time.date()
+                month = exit_time.strftime("%Y-%m")
+                self.revenue_by_day[day] = self.revenue_by_day.get(day, 0.0) - fee
+                self.revenue_by_month[month] = self.revenue_by_month.get(month, 0.0) - fee
+                self.total_revenue -= fee
+
+    def seed(self, parking_records, history_records):
+        '''
+        This method builds the aggregates of the existing records. A history with a summarize method
+        aggregates itself (the SQLite one with GROUP BY queries, the partitioned one from the summaries of its
+        closed partitions), the in-memory one is read by column; the records are only read one by one otherwise.
+        The peak occupancy of the past is not known, it starts at the current occupancy.
+
+        ***Parameters***
+        parking_records: Mapping
+            The current parking records, plate -> entry time.
+        history_records: Sequence
+            The historical (plate, entry time, exit time, fee) records.
+        '''
+        if hasattr(history_records, "summarize"):
+            summary = history_records.summarize(self.dwell_bins_minutes, self.window_hours)
+        else:
+            if hasattr(history_records, "columns"):
+                columns = history_records.columns()
+                entry, exit_, fee = columns["entry_time"], columns["exit_time"], columns["fee"]
+            else:
+                records = list(history_records)
+                entry = to_epoch_seconds(record[1] for record in records)
+                exit_ = to_epoch_seconds(record[2] for record in records)
+                fee = np.array([record[3] for record in records], dtype=np.float64)
+            summary = summarize_history(entry, exit_, fee, self.dwell_bins_minutes, self.window_hours)
+        entries = list(parking_records.values())
+        with self._lock:
+            self.occupancy = len(entries)
+            self.peak_occupancy = self.occupancy
+            self.peak_time = max(entries, default=None)
+
+            self.arrivals_by_hour = list(summary["arrivals_by_hour"])
+            for entry_time in entries:
+                self.arrivals_by_hour[entry_time.hour] += 1
+            self.departures_by_hour = list(summary["departures_by_hour"])
+
+            self.dwell_histogram = list(summary["dwell_histogram"])
+            self.dwell_count = summary["dwell_count"]
+            self.dwell_seconds = float(summary["dwell_seconds"])
+
+            self.revenue_by_day = {date.fromisoformat(day): total for day, total in summary["revenue_by_day"].items()}
+            self.revenue_by_month = dict(summary["revenue_by_month"])
+            self.total_revenue = float(summary["total_revenue"])
+
+            self.hourly_traffic = {}
+            self._newest_hour = None
+            if self.window_hours:
+                self._seed_hourly(summary, entries)
+
+    def _seed_hourly(self, summary, entries):
+        '''
+        This method fills the hourly traffic of the last window_hours hours before the latest event.
+        The summary holds the hourly traffic of the history up to its last exit, the parked vehicles are added to it.
+        '''
+        entry_hours = [(time - EPOCH) // timedelta(hours=1) for time in entries]
+        hours = list(summary["hourly_traffic"]) + entry_hours
+        if summary["last_exit"] is not None:
+            hours.append(summary["last_exit"] // 3600)
+        if not hours:
+            return
+        last = max(hours)
+        first = last - self.window_hours + 1
+        traffic = {hour: list(counts) for hour, counts in summary["hourly_traffic"].items() if hour >= first}
+        for hour in entry_hours:
+            if hour >= first:
+                traffic.setdefault(hour, [0, 0])[0] += 1
+        for hour in sorted(traffic):
+            self.hourly_traffic[EPOCH + timedelta(hours=int(hour))] = traffic[hour]
+        self._newest_hour = EPOCH + timedelta(hours=int(last))
+
+    def average_dwell(self):
+        '''
+        This method returns the average stay duration, None if no vehicle exited yet.
+        '''
+        if not self.dwell_count:
+            return None
+        return timedelta(seconds=self.dwell_seconds / self.dwell_count)
+
+    def busiest_hours(self, count=3):
+        '''
+        This method returns the hours of the day (0-23) with the most arrivals, busiest first.
+        '''
+        return sorted(range(24), key=lambda hour: self.arrivals_by_hour[hour], reverse=True)[:count]
+
+    def snapshot(self):
+        '''
+        This method returns a consistent copy of all the aggregates, for a dashboard or a report.
+        '''
+        with self._lock:
+            return {
+                "occupancy": self.occupancy,
+                "peak_occupancy": self.peak_occupancy,
+                "peak_time": self.peak_time,
+                "arrivals_by_hour": list(self.arrivals_by_hour),
+                "departures_by_hour": list(self.departures_by_hour),
+                "hourly_traffic": {hour: tuple(self.hourly_traffic[hour]) for hour in sorted(self.hourly_traffic)},
+                "dwell_bins_minutes": self.dwell_bins_minutes,
+                "dwell_histogram": list(self.dwell_histogram),
+                "average_dwell": self.average_dwell(),
+                "revenue_by_day": dict(self.revenue_by_day),
+                "revenue_by_month": dict(self.revenue_by_month),
+                "total_revenue": self.total_revenue,
+            }
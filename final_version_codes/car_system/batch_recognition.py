@@ -0,0 +1,133 @@
+'''
+This module runs the license plate recognition over many images at once, e.g. a night's worth of gate snapshots.
+The images are spread over a pool of worker processes, each one with its own loaded model,
+and the results are streamed back as they finish. It does not need the Tk interface.
+
+Run it from the final_version_codes folder:
+    python -m car_system.batch_recognition <folder or images> [--workers N] [--cache FILE]
+'''
+
+import os
+import sys
+import csv
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+from car_system.plate_recognizer import PlateRecognizer
+from car_system.recognition_cache import RecognitionCache
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+_worker_recognizer = None
+
+
+def list_images(source):
+    '''
+    This function lists the images to recognize.
+
+    ***Parameters***
+    source: str or list
+        A folder (its images are taken in name order) or a list of image paths.
+
+    ***Returns***
+    list
+        The image paths.
+    '''
+    if isinstance(source, (str, os.PathLike)):
+        if not os.path.isdir(source):
+            return [source]
+        return [os.path.join(source, name) for name in sorted(os.listdir(source))
+                if name.lower().endswith(IMAGE_EXTENSIONS)]
+    return list(source)
+
+
+def _init_worker(cache_file=None):
+    '''
+    This function loads the model once in every worker process.
+    With a cache file, the images already recognized by a previous batch are not inferred again.
+    '''
+    global _worker_recognizer
+    cache = RecognitionCache(disk_file=cache_file) if cache_file else None
+    _worker_recognizer = PlateRecognizer(pool_size=1, cache=cache)
+    _worker_recognizer.wait_until_ready()
+
+
+def _recognize_file(file_path):
+    '''
+    This function decodes and recognizes one image inside a worker process.
+
+    ***Returns***
+    tuple
+        (file, plate, confidence, latency, error), plate is None if nothing is recognized,
+        latency is the decode plus inference time in seconds and error is None.
+    '''
+    start = time.perf_counter()
+    img = cv2.imread(file_path)
+    if img is None:
+        raise ValueError(f"Cannot read the image {file_path}")
+    result = _worker_recognizer.recognize_plate(img)
+    latency = time.perf_counter() - start
+    if result is None:
+        return file_path, None, 0.0, latency, None
+    plate, confidence = result
+    return file_path, plate, confidence, latency, None
+
+
+def recognize_batch(source, workers=None, cache_file=None):
+    '''
+    This function recognizes a batch of images over a pool of worker processes.
+    It is a generator, the results are yielded in the order they finish, not in the input order.
+    An image which fails, e.g. an unreadable file or a worker process which died, gives an error result
+    and the batch goes on with the other images.
+
+    ***Parameters***
+    source: str or list
+        A folder or a list of image paths.
+    workers: int
+        The number of worker processes, the number of CPU cores by default.
+    cache_file: str
+        The disk tier of the recognition cache shared by the workers, None to disable the cache.
+
+    ***Returns***
+    generator
+        (file, plate, confidence, latency, error) tuples, error is the message of the failure or None.
+    '''
+    files = list_images(source)
+    if not files:
+        return
+    workers = min(workers or os.cpu_count() or 1, len(files))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(cache_file,)) as executor:
+        futures = {executor.submit(_recognize_file, file_path): file_path for file_path in files}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield futures[future], None, 0.0, 0.0, f"{type(e).__name__}: {e}"
+
+
+def main(argv=None):
+    '''
+    This function recognizes the images given on the command line and writes the results as CSV to stdout.
+    '''
+    parser = argparse.ArgumentParser(
+        description="Recognize the license plates of a folder or a list of images.")
+    parser.add_argument("source", nargs="+",
+                        help="A folder of images, or one or more image files.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: number of CPU cores).")
+    parser.add_argument("--cache", default=None,
+                        help="Recognition cache file, to skip the images of previous batches.")
+    args = parser.parse_args(argv)
+
+    source = args.source[0] if len(args.source) == 1 else args.source
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["File", "Plate", "Confidence", "Latency", "Error"])
+    for file_path, plate, confidence, latency, error in recognize_batch(source, args.workers, args.cache):
+        writer.writerow([file_path, plate or "", f"{confidence:.3f}", f"{latency:.3f}", error or ""])
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,38 @@
 import tkinter as tk
-from tkinter import messagebox, filedialog
-from datetime import datetime
+from tkinter import messagebox, filedialog, ttk
+from datetime import datetime, timedelta
 import random
 import string
-import hyperlpr3 as lpr3
 import cv2
 from PIL import Image, ImageTk
-import csv
+from car_system.plate_recognizer import get_recognizer
+from car_system.parking_engine import ParkingEngine, ParkingError
+from car_system.analytics import TrafficAnalytics
+from car_system.spot_allocator import SpotAllocator, SPOT_TYPES
+from car_system.csv_loader import rejected_file
+from monitoring.metrics import (RECOGNITION_SECONDS, VEHICLE_EVENTS, UI_RENDER_SECONDS, OCCUPANCY,
+                                HISTORY_RECORDS, timed)
+
+HISTORY_PAGE_SIZE = 100
 
 
 class ParkingLotSystem:
     '''
     This is a class for managing the parking lot system.
+    It is the Tk client of the ParkingEngine, which holds the entry/exit, fee and persistence logic.
 
     Attributes:
     root: The root window of the application.
-    parking_records: A dictionary to store the current parking records.
-    history_records: A list to store the historical parking records.
+    engine: The parking engine behind the interface.
+    parking_records: A mapping of the current parking records, owned by the engine.
+    history_records: A sequence of the historical parking records, owned by the engine.
     image_label: A label to display the uploaded image.
+    recognizer: The shared license plate recognizer.
+    history_window: The window of the historical records, None until it is opened.
+    history_page: The page shown in the history window.
+    history_filter: The plate and exit time range of the history search.
+    analytics: The TrafficAnalytics fed by the entries and exits of the engine.
+    vehicle_type: The type of the entering vehicle, for the spot allocation.
 
     Methods:
     clear_frame: Clear the current interface.
@@ -28,28 +43,55 @@ class ParkingLotSystem:
     vehicle_entry: Handle the vehicle entry logic.
     vehicle_exit: Handle the vehicle exit logic.
     view_parking_records: View the current parking records.
+    view_statistics: View the occupancy and traffic statistics.
     view_history_records: View and manage the historical parking records.
+    search_history_records: Filter the historical records by plate and exit date range.
+    show_history_page: Load one page of the historical records.
+    delete_selected_history_records: Delete the selected historical records.
+    delete_matching_history_records: Delete all the historical records matching the search.
     delete_history_record: Delete a specific historical record.
-    save_parking_records: Save the current parking records to a CSV file.
-    load_parking_records: Load the parking records from a CSV file.
-    save_history_records: Save the historical parking records to a CSV file.
-    load_history_records: Load the historical parking records from a CSV file.
+    refresh_history_view: Reload the history view after a deletion.
+    report_load_errors: Warn about the malformed records skipped at startup.
     '''
 
-    def __init__(self, root):
+    def __init__(self, root, engine=None):
         self.root = root
         self.root.title("Parking Lot System")
         self.root.geometry("1000x800")
 
-        self.parking_records = {}
-        self.history_records = []
+        self.engine = engine or ParkingEngine(allocator=SpotAllocator.from_layout_file())
+        self.parking_records = self.engine.parking_records
+        self.history_records = self.engine.history_records
         self.image_label = None
+        self.recognizer = get_recognizer()
+        self.history_window = None
+        self.history_page = 0
+        self.history_filter = {}
+        self.analytics = TrafficAnalytics()
+        self.analytics.seed(self.parking_records, self.history_records)
+        self.engine.add_listener(self.analytics)
+        self.vehicle_type = tk.StringVar(self.root, value="standard")
+        # Read when the metrics are exported, nothing is updated per event
+        OCCUPANCY.set_function(self.engine.occupancy)
+        HISTORY_RECORDS.set_function(lambda: len(self.history_records))
 
         self.manage_screen()
+        self.report_load_errors()
 
-        self.load_history_records()
-        self.load_parking_records()
+    def report_load_errors(self):
+        '''
+        This method warns about the malformed rows which were skipped when loading the records.
+        '''
+        errors = getattr(self.engine.storage, "load_errors", [])
+        if errors:
+            lines = [f"{file_path}, line {line}: {message}" for file_path, line, message in errors[:10]]
+            if len(errors) > 10:
+                lines.append(f"... and {len(errors) - 10} more")
+            quarantine_files = sorted({rejected_file(file_path) for file_path, _, _ in errors})
+            lines.append("Their lines were copied to " + ", ".join(quarantine_files))
+            messagebox.showwarning("Warning", f"{len(errors)} malformed records were skipped:\n" + "\n".join(lines))
 
+    @timed(UI_RENDER_SECONDS, view="main")
     def manage_screen(self):
         '''
         This method creates the main interface of the parking lot system.
@@ -81,6 +123,8 @@ class ParkingLotSystem:
             font=(
                 "Times New Roman",
                 12)).pack()
+        if self.engine.allocator is not None:
+            tk.OptionMenu(self.root, self.vehicle_type, *SPOT_TYPES).pack(pady=5)
         tk.Button(
             self.root,
             text="Vehicle Entry",
@@ -101,6 +145,8 @@ class ParkingLotSystem:
                   command=self.view_parking_records).pack(pady=10)
         tk.Button(self.root, text="View and Manage History Records", font=("Times New Roman", 14),
                   command=self.view_history_records).pack(pady=10)
+        tk.Button(self.root, text="View Statistics", font=("Times New Roman", 14),
+                  command=self.view_statistics).pack(pady=10)
 
     def clear_frame(self):
         '''
@@ -147,56 +193,61 @@ class ParkingLotSystem:
     def simulate_plate_recognition(self, file_path):
         '''
         This method simulates the license plate recognition from the image.
-        Use the hyperlpr3 library to recognize the license plate from the image.
+        Use the shared hyperlpr3 recognizer, whose models are loaded once at startup.
         '''
-        catcher = lpr3.LicensePlateCatcher()
-        img = cv2.imread(file_path)
-        chars = catcher(img)
-        return chars[0][0] if chars else None
+        with RECOGNITION_SECONDS.time():
+            img = cv2.imread(file_path)
+            result = self.recognizer.recognize_plate(img)
+        return result[0] if result else None
 
     def vehicle_entry(self):
         '''
         This method handles the vehicle entry.
         '''
         plate = self.plate_entry.get().strip()
-        if not plate:
-            messagebox.showerror("Error", "License plate cannot be empty!")
+        try:
+            entry_time = self.engine.enter(plate, vehicle_type=self.vehicle_type.get())
+        except ParkingError as e:
+            VEHICLE_EVENTS.inc(event="entry", result="refused")
+            messagebox.showerror("Error", str(e))
             return
-        if plate in self.parking_records:
-            messagebox.showerror(
-                "Error", "This vehicle is already in the parking lot!")
-        else:
-            self.parking_records[plate] = datetime.now()
-            self.save_parking_records()
-            messagebox.showinfo(
-                "Info",
-                f"Vehicle {plate} entered at {self.parking_records[plate].strftime('%Y-%m-%d %H:%M:%S')}")
+        VEHICLE_EVENTS.inc(event="entry", result="ok")
+        spot = self.engine.spot_of(plate)
+        messagebox.showinfo(
+            "Info",
+            f"Vehicle {plate} entered at {entry_time.strftime('%Y-%m-%d %H:%M:%S')}"
+            + (f"\nSpot {spot.number + 1}: level {spot.level}, zone {spot.zone} ({spot.spot_type})" if spot else ""))
 
     def vehicle_exit(self):
         '''
         This method handles the vehicle exit.
         '''
         plate = self.plate_entry.get().strip()
-        if not plate:
-            messagebox.showerror("Error", "License plate cannot be empty!")
-            return
-        if plate not in self.parking_records:
-            messagebox.showerror(
-                "Error", "This vehicle is not in the parking lot!")
-        else:
-            entry_time = self.parking_records.pop(plate)
-            exit_time = datetime.now()
-            duration = exit_time - entry_time
-            hours = max(1, int(duration.total_seconds() // 3600))
-            fee = hours * 5  # I set the parking fee as S5 per hour
-            self.history_records.append((plate, entry_time, exit_time, fee))
-            self.save_history_records()
-
-            messagebox.showinfo("Exit Info",
-                                f"Vehicle {plate} exited at {exit_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
-                                f"Total time: {hours} hours\n"
-                                f"Parking fee: ${fee}")
+        try:
+            receipt = self.engine.exit(plate)
+        except ParkingError as e:
+            if not e.suggestions:
+                VEHICLE_EVENTS.inc(event="exit", result="refused")
+                messagebox.showerror("Error", str(e))
+                return
+            # A misread plate, e.g. "0" for "O", offers the closest parked plate instead
+            if not messagebox.askyesno("Error", f"{e}\nDid you mean {e.suggestions[0]}?"):
+                VEHICLE_EVENTS.inc(event="exit", result="refused")
+                return
+            plate = e.suggestions[0]
+            try:
+                receipt = self.engine.exit(plate)
+            except ParkingError as e:
+                VEHICLE_EVENTS.inc(event="exit", result="refused")
+                messagebox.showerror("Error", str(e))
+                return
+        VEHICLE_EVENTS.inc(event="exit", result="ok")
+        messagebox.showinfo("Exit Info",
+                            f"Vehicle {plate} exited at {receipt.exit_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+                            f"Total time: {receipt.hours} hours\n"
+                            f"Parking fee: ${receipt.fee}")
 
+    @timed(UI_RENDER_SECONDS, view="parking_records")
     def view_parking_records(self):
         '''
         This method displays the current parking records.
@@ -216,110 +267,193 @@ class ParkingLotSystem:
                 "Times New Roman",
                 14)).pack(
             pady=10)
-        for plate, entry_time in self.parking_records.items():
-            tk.Label(record_window, text=f"Vehicle {plate} - Entered at {entry_time.strftime('%Y-%m-%d %H:%M:%S')}",
+        for plate, entry_time in list(self.parking_records.items()):
+            spot = self.engine.spot_of(plate)
+            tk.Label(record_window, text=f"Vehicle {plate} - Entered at {entry_time.strftime('%Y-%m-%d %H:%M:%S')}"
+                     + (f" - Spot {spot.number + 1} ({spot.level}/{spot.zone})" if spot else ""),
                      font=("Times New Roman", 10)).pack(anchor="w", padx=10, pady=2)
 
+    def view_statistics(self):
+        '''
+        This method displays the occupancy and traffic statistics, read from the analytics aggregates.
+        '''
+        stats = self.analytics.snapshot()
+        average_dwell = stats["average_dwell"]
+        peak_time = stats["peak_time"]
+        busiest = ", ".join(f"{hour:02d}:00" for hour in self.analytics.busiest_hours())
+        today = stats["revenue_by_day"].get(datetime.now().date(), 0.0)
+        month = stats["revenue_by_month"].get(datetime.now().strftime("%Y-%m"), 0.0)
+        messagebox.showinfo(
+            "Statistics",
+            f"Current occupancy: {stats['occupancy']}"
+            + (f" ({self.engine.free_spots()} free spots)" if self.engine.allocator is not None else "") + "\n"
+            f"Peak occupancy: {stats['peak_occupancy']}"
+            + (f" at {peak_time.strftime('%Y-%m-%d %H:%M:%S')}" if peak_time else "") + "\n"
+            f"Busiest arrival hours: {busiest}\n"
+            f"Average stay: {str(average_dwell).split('.')[0] if average_dwell else 'n/a'}\n"
+            f"Revenue today: ${today:.2f}\n"
+            f"Revenue this month: ${month:.2f}\n"
+            f"Total revenue: ${stats['total_revenue']:.2f}")
+
+    @timed(UI_RENDER_SECONDS, view="history_records")
     def view_history_records(self):
         '''
         This method displays the historical parking records.
+        The records are shown one page at a time in a Treeview, so only the visible rows are created,
+        and the search by plate and exit date runs against the storage, not the widgets.
         '''
-        if not self.history_records:
+        if not self.engine.history_count():
             messagebox.showinfo(
                 "History Records",
                 "No historical records available.")
             return
-        history_window = tk.Toplevel(self.root)
-        history_window.title("History Records")
-        history_window.geometry("1000x800")
+        if self.history_window is not None and self.history_window.winfo_exists():
+            self.history_window.lift()
+            return
+        self.history_window = tk.Toplevel(self.root)
+        self.history_window.title("History Records")
+        self.history_window.geometry("1000x800")
         tk.Label(
-            history_window,
+            self.history_window,
             text="Historical Parking Records",
             font=(
                 "Times New Roman",
                 14)).pack(
             pady=10)
-        for idx, record in enumerate(self.history_records):
-            plate, entry_time, exit_time, fee = record
-            record_frame = tk.Frame(history_window)
-            record_frame.pack(fill="x", padx=10, pady=5)
-
-            tk.Label(record_frame, text=(f"{idx+1}. Vehicle {plate}: Entered at {entry_time.strftime('%Y-%m-%d %H:%M:%S')}, "
-                                         f"Exited at {exit_time.strftime('%Y-%m-%d %H:%M:%S')}, Fee: ${fee}"),
-                     font=("Times New Roman", 10)).pack(side="left")
-            tk.Button(record_frame, text="Delete", font=("Times New Roman", 10),
-                      command=lambda idx=idx: self.delete_history_record(idx)).pack(side="right")
-
-    def delete_history_record(self, idx):
-        '''
-        This method allow users to delete a specific historical record.
-        '''
-        if idx < len(self.history_records):
-            del self.history_records[idx]
-            self.save_history_records()
-            for widget in self.root.winfo_children():
-                if isinstance(widget, tk.Toplevel) and widget.title(
-                ) == "History Records":
-                    widget.destroy()
-            if not self.history_records:
-                messagebox.showinfo("Info", "No historical records left.")
-                return
-            messagebox.showinfo("Info", "Record deleted successfully!")
-            self.view_history_records()
 
-    def save_parking_records(self):
+        search_frame = tk.Frame(self.history_window)
+        search_frame.pack(fill="x", padx=10, pady=5)
+        tk.Label(search_frame, text="Plate:", font=("Times New Roman", 10)).pack(side="left")
+        self.history_plate_entry = tk.Entry(search_frame, font=("Times New Roman", 10), width=12)
+        self.history_plate_entry.pack(side="left", padx=5)
+        tk.Label(search_frame, text="Exited from (YYYY-MM-DD):",
+                 font=("Times New Roman", 10)).pack(side="left")
+        self.history_from_entry = tk.Entry(search_frame, font=("Times New Roman", 10), width=12)
+        self.history_from_entry.pack(side="left", padx=5)
+        tk.Label(search_frame, text="to:", font=("Times New Roman", 10)).pack(side="left")
+        self.history_to_entry = tk.Entry(search_frame, font=("Times New Roman", 10), width=12)
+        self.history_to_entry.pack(side="left", padx=5)
+        tk.Button(search_frame, text="Search", font=("Times New Roman", 10),
+                  command=self.search_history_records).pack(side="left", padx=5)
+
+        tree_frame = tk.Frame(self.history_window)
+        tree_frame.pack(fill="both", expand=True, padx=10, pady=5)
+        columns = ("No", "Plate", "Entry Time", "Exit Time", "Fee")
+        self.history_tree = ttk.Treeview(tree_frame, columns=columns, show="headings")
+        for column in columns:
+            self.history_tree.heading(column, text=column)
+            self.history_tree.column(column, width=80 if column in ("No", "Fee") else 200)
+        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self.history_tree.yview)
+        self.history_tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+        self.history_tree.pack(side="left", fill="both", expand=True)
+
+        control_frame = tk.Frame(self.history_window)
+        control_frame.pack(fill="x", padx=10, pady=5)
+        tk.Button(control_frame, text="Previous", font=("Times New Roman", 10),
+                  command=lambda: self.show_history_page(self.history_page - 1)).pack(side="left")
+        tk.Button(control_frame, text="Next", font=("Times New Roman", 10),
+                  command=lambda: self.show_history_page(self.history_page + 1)).pack(side="left", padx=5)
+        self.history_page_label = tk.Label(control_frame, font=("Times New Roman", 10))
+        self.history_page_label.pack(side="left", padx=10)
+        tk.Button(control_frame, text="Delete All Matching", font=("Times New Roman", 10),
+                  command=self.delete_matching_history_records).pack(side="right", padx=5)
+        tk.Button(control_frame, text="Delete Selected", font=("Times New Roman", 10),
+                  command=self.delete_selected_history_records).pack(side="right")
+
+        self.history_filter = {}
+        self.show_history_page(0)
+
+    def search_history_records(self):
         '''
-        This method saves the current parking records to a CSV file.
+        This method filters the historical records by plate and exit date range.
         '''
-        with open("final_version_codes/data_storage/parking_records.csv", mode="w", newline="") as file:
-            writer = csv.writer(file)
-            writer.writerow(["Plate", "Entry Time"])
-            for plate, entry_time in self.parking_records.items():
-                writer.writerow(
-                    [plate, entry_time.strftime('%Y-%m-%d %H:%M:%S')])
+        try:
+            start = self.history_from_entry.get().strip()
+            end = self.history_to_entry.get().strip()
+            start = datetime.strptime(start, '%Y-%m-%d') if start else None
+            # The "to" date is included, so the range ends at the next midnight
+            end = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None
+        except ValueError:
+            messagebox.showerror("Error", "Dates must be in the YYYY-MM-DD format!")
+            return
+        self.history_filter = {
+            "plate": self.history_plate_entry.get().strip() or None,
+            "start": start,
+            "end": end,
+        }
+        self.show_history_page(0)
+        plate = self.history_filter["plate"]
+        if plate is not None and not self.engine.history_count(**self.history_filter):
+            suggestions = [match for match, _ in self.engine.suggest_plates(plate, present_only=False)
+                           if match != plate]
+            if suggestions:
+                messagebox.showinfo("History Records",
+                                    f"No records of {plate}. Similar plates: {', '.join(suggestions)}")
 
-    def load_parking_records(self):
+    @timed(UI_RENDER_SECONDS, view="history_page")
+    def show_history_page(self, page):
         '''
-        This method loads the parking records from a CSV file.
+        This method loads one page of the (filtered) historical records into the Treeview.
         '''
-        try:
-            with open("final_version_codes/data_storage/parking_records.csv", mode="r", newline="") as file:
-                reader = csv.reader(file)
-                next(reader)  # Skip header row
-                for row in reader:
-                    plate, entry_time = row
-                    self.parking_records[plate] = datetime.strptime(
-                        entry_time, '%Y-%m-%d %H:%M:%S')
-        except FileNotFoundError:
-            pass  # If file not found, it means no records exist yet
+        total = self.engine.history_count(**self.history_filter)
+        pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+        self.history_page = min(max(page, 0), pages - 1)
+        records = self.engine.history_page(
+            self.history_page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE, **self.history_filter)
+
+        self.history_tree.delete(*self.history_tree.get_children())
+        first = self.history_page * HISTORY_PAGE_SIZE
+        for number, (record_id, (plate, entry_time, exit_time, fee)) in enumerate(records, start=first + 1):
+            self.history_tree.insert("", "end", iid=str(record_id), values=(
+                number, plate, entry_time.strftime('%Y-%m-%d %H:%M:%S'),
+                exit_time.strftime('%Y-%m-%d %H:%M:%S'), f"${fee}"))
+        self.history_page_label.config(
+            text=f"Page {self.history_page + 1} of {pages} ({total} records)")
+
+    def delete_selected_history_records(self):
+        '''
+        This method deletes the historical records selected in the Treeview.
+        '''
+        selected = self.history_tree.selection()
+        if not selected:
+            messagebox.showerror("Error", "Please select a record to delete!")
+            return
+        self.engine.delete_history_records([int(iid) for iid in selected])
+        self.refresh_history_view()
 
-    def save_history_records(self):
+    def delete_matching_history_records(self):
         '''
-        This method saves the historical parking records to a CSV file.
+        This method deletes all the historical records matching the current search, after a confirmation.
         '''
-        with open("final_version_codes/data_storage/history_records.csv", mode="w", newline="") as file:
-            writer = csv.writer(file)
-            writer.writerow(["Plate", "Entry Time", "Exit Time", "Fee"])
-            for record in self.history_records:
-                plate, entry_time, exit_time, fee = record
-                writer.writerow([plate, entry_time.strftime('%Y-%m-%d %H:%M:%S'),
-                                 exit_time.strftime('%Y-%m-%d %H:%M:%S'), fee])
+        total = self.engine.history_count(**self.history_filter)
+        if not messagebox.askyesno("Confirm", f"Delete the {total} records matching the search?"):
+            return
+        self.engine.delete_history_range(**self.history_filter)
+        self.refresh_history_view()
 
-    def load_history_records(self):
+    def delete_history_record(self, record_id, refresh=True):
         '''
-        This method loads the historical parking records from a CSV file.
+        This method allow users to delete a specific historical record by its ID.
+        The open history view is updated in place.
         '''
         try:
-            with open("final_version_codes/data_storage/history_records.csv", mode="r", newline="") as file:
-                reader = csv.reader(file)
-                next(reader)  # Skip header row
-                for row in reader:
-                    plate, entry_time, exit_time, fee = row
-                    entry_time = datetime.strptime(
-                        entry_time, '%Y-%m-%d %H:%M:%S')
-                    exit_time = datetime.strptime(
-                        exit_time, '%Y-%m-%d %H:%M:%S')
-                    self.history_records.append(
-                        (plate, entry_time, exit_time, float(fee)))
-        except FileNotFoundError:
-            pass  # If file not found, it means no records exist yet
+            self.engine.delete_history_record(record_id)
+        except ParkingError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        if refresh:
+            self.refresh_history_view()
+
+    def refresh_history_view(self):
+        '''
+        This method reloads the current page of the history view after a deletion.
+        '''
+        if not self.engine.history_count():
+            if self.history_window is not None and self.history_window.winfo_exists():
+                self.history_window.destroy()
+            messagebox.showinfo("Info", "No historical records left.")
+            return
+        messagebox.showinfo("Info", "Record deleted successfully!")
+        if self.history_window is not None and self.history_window.winfo_exists():
+            self.show_history_page(self.history_page)
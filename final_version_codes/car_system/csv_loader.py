@@ -0,0 +1,265 @@
+'''
+This module loads the parking and history CSV files in bulk, for a fast startup on large files.
+The rows are read in chunks and every column of a chunk is parsed at once with NumPy: the timestamps
+are written in the fixed "YYYY-MM-DD HH:MM:SS" format, so they are decoded from their bytes
+instead of calling datetime.strptime on each of them.
+A malformed row is skipped and reported with its line number, the rest of the file is still loaded.
+The next compaction rewrites the file without it, so the storage first copies its raw line to a quarantine
+file next to the CSV file (quarantine_rows), where it can be fixed by hand.
+'''
+
+import os
+import csv
+from datetime import datetime
+from itertools import islice
+import numpy as np
+from car_system.event_log import TIME_FORMAT
+
+CHUNK_ROWS = 65536
+TIMESTAMP_LENGTH = 19
+DIGIT_POSITIONS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+SEPARATORS = {4: b"-", 7: b"-", 10: b" ", 13: b":", 16: b":"}
+DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+REJECTED_SUFFIX = ".rejected"
+
+
+def _days_from_civil(year, month, day):
+    '''
+    This function returns the days since 1970-01-01 of arrays of dates (proleptic Gregorian calendar).
+    '''
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def parse_timestamps(values):
+    '''
+    This function parses timestamps in the "YYYY-MM-DD HH:MM:SS" format.
+    The values which are not in the exact format are retried with datetime.strptime.
+
+    ***Parameters***
+    values: sequence of str
+        The timestamps.
+
+    ***Returns***
+    numpy.ndarray, numpy.ndarray
+        The int64 epoch seconds and the mask of the valid values.
+    '''
+    try:
+        # One byte more than a timestamp, so the longer values are not silently truncated
+        raw = np.array(values, dtype=f"S{TIMESTAMP_LENGTH + 1}")
+    except UnicodeEncodeError:
+        raw = np.array([value.encode("ascii", "replace") for value in values],
+                       dtype=f"S{TIMESTAMP_LENGTH + 1}")
+    text = raw.view(np.uint8).reshape(len(raw), TIMESTAMP_LENGTH + 1)
+    digits = text[:, DIGIT_POSITIONS].astype(np.int64) - ord("0")
+    valid = ((digits >= 0) & (digits <= 9)).all(axis=1) & (text[:, TIMESTAMP_LENGTH] == 0)
+    for position, separator in SEPARATORS.items():
+        valid &= text[:, position] == ord(separator)
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    hour = digits[:, 8] * 10 + digits[:, 9]
+    minute = digits[:, 10] * 10 + digits[:, 11]
+    second = digits[:, 12] * 10 + digits[:, 13]
+    # Year 0 is not a datetime: such a row must go to the strptime fallback and be rejected
+    valid &= (year >= 1) & (month >= 1) & (month <= 12)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = DAYS_IN_MONTH[np.clip(month, 0, 12)] + (leap & (month == 2))
+    valid &= (day >= 1) & (day <= month_days) & (hour < 24) & (minute < 60) & (second < 60)
+    seconds = _days_from_civil(year, month, day) * 86400 + hour * 3600 + minute * 60 + second
+
+    for index in np.flatnonzero(~valid):
+        try:
+            parsed = datetime.strptime(values[index], TIME_FORMAT)
+        except (TypeError, ValueError):
+            continue
+        seconds[index] = (parsed - datetime(1970, 1, 1)).total_seconds()
+        valid[index] = True
+    return seconds, valid
+
+
+def parse_numbers(values, dtype):
+    '''
+    This function parses a column of numbers at once, or one by one if some of them are malformed.
+
+    ***Returns***
+    numpy.ndarray, numpy.ndarray
+        The numbers and the mask of the valid values.
+    '''
+    try:
+        return np.array(values).astype(dtype), np.ones(len(values), dtype=bool)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    numbers = np.zeros(len(values), dtype=dtype)
+    valid = np.zeros(len(values), dtype=bool)
+    for index, value in enumerate(values):
+        try:
+            numbers[index] = float(value) if np.dtype(dtype).kind == "f" else int(value)
+            valid[index] = True
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return numbers, valid
+
+
+def read_chunks(file_path, width, errors, chunk_rows=CHUNK_ROWS):
+    '''
+    This function reads the rows of a CSV file in chunks, after its header.
+    The rows which do not have the expected number of fields are reported and skipped.
+
+    ***Parameters***
+    file_path: str
+        The CSV file.
+    width: int or callable
+        The number of fields of a row, or a function of the header returning it.
+    errors: list
+        The (file, line, message) of the malformed rows are appended to it.
+    chunk_rows: int
+        The number of rows per chunk.
+
+    ***Returns***
+    generator
+        (header, line numbers, rows) tuples, the rows being lists of fields, at least one for a header-only file.
+    '''
+    with open(file_path, mode="r", newline="") as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            return
+        if callable(width):
+            width = width(header)
+        first_chunk = True
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows and not first_chunk:
+                return
+            first_chunk = False
+            # The rows have no embedded line breaks, so their line numbers are counted back from the reader
+            first_line = reader.line_num - len(rows) + 1
+            bad = [offset for offset, row in enumerate(rows) if len(row) != width]
+            if not bad:
+                yield header, range(first_line, first_line + len(rows)), rows
+                continue
+            lines, good = [], []
+            for offset, row in enumerate(rows):
+                if len(row) == width:
+                    lines.append(first_line + offset)
+                    good.append(row)
+                elif row:
+                    errors.append((file_path, first_line + offset,
+                                   f"expected {width} fields, got {len(row)}"))
+            yield header, lines, good
+
+
+def _report(errors, file_path, lines, valid, message):
+    '''
+    This function reports the rows of a chunk which failed a check, valid being the mask of the others.
+    '''
+    for index in np.flatnonzero(~valid):
+        errors.append((file_path, lines[index], message))
+
+
+def load_parking_csv(file_path, errors, chunk_rows=CHUNK_ROWS):
+    '''
+    This function loads a parking records CSV file.
+
+    ***Returns***
+    dict
+        The parking records, plate -> entry time.
+    '''
+    records = {}
+    for _, lines, rows in read_chunks(file_path, 2, errors, chunk_rows):
+        if not rows:
+            continue
+        plates, entry_times = zip(*rows)
+        seconds, valid = parse_timestamps(entry_times)
+        _report(errors, file_path, lines, valid, "malformed entry time")
+        entry_times = seconds[valid].astype("datetime64[s]").tolist()
+        records.update(zip(np.array(plates)[valid].tolist(), entry_times))
+    return records
+
+
+def load_history_csv(file_path, history_records, errors, chunk_rows=CHUNK_ROWS):
+    '''
+    This function loads a history records CSV file into a HistoryRecords, column by column.
+    The files written before the record IDs have no ID column, their records are numbered in order.
+
+    ***Returns***
+    bool
+        True if the file has no ID column yet.
+    '''
+    legacy_format = False
+    for header, lines, rows in read_chunks(file_path, len, errors, chunk_rows):
+        legacy_format = len(header) == 4
+        if not rows:
+            continue
+        columns = list(zip(*rows))
+        entry_times, entry_valid = parse_timestamps(columns[1])
+        exit_times, exit_valid = parse_timestamps(columns[2])
+        fees, fee_valid = parse_numbers(columns[3], np.float64)
+        _report(errors, file_path, lines, entry_valid, "malformed entry time")
+        _report(errors, file_path, lines, exit_valid | ~entry_valid, "malformed exit time")
+        _report(errors, file_path, lines, fee_valid | ~(entry_valid & exit_valid), "malformed fee")
+        valid = entry_valid & exit_valid & fee_valid
+        record_ids = None
+        if not legacy_format:
+            record_ids, id_valid = parse_numbers(columns[4], np.int64)
+            _report(errors, file_path, lines, id_valid | ~valid, "malformed ID")
+            valid &= id_valid
+            record_ids = record_ids[valid]
+        history_records.append_columns(
+            np.array(columns[0])[valid], entry_times[valid],
+            exit_times[valid], fees[valid], record_ids)
+    return legacy_format
+
+
+def rejected_file(file_path):
+    '''
+    This function returns the path of the quarantine file of a CSV file.
+    '''
+    return file_path + REJECTED_SUFFIX
+
+
+def quarantine_rows(errors, start=0):
+    '''
+    This function copies the raw lines of the malformed rows to the quarantine file of their CSV file,
+    it must run before the CSV file is rewritten without them. The lines already in the quarantine file
+    are not copied again, so loading the same file twice does not duplicate them.
+
+    ***Parameters***
+    errors: list
+        The (file, line, message) of the malformed rows.
+    start: int
+        The index of the first error to quarantine, e.g. the first one of the last loaded file.
+
+    ***Returns***
+    list
+        The paths of the quarantine files which were written to.
+    '''
+    lines_by_file = {}
+    for file_path, line, _ in errors[start:]:
+        lines_by_file.setdefault(file_path, set()).add(line)
+    written = []
+    for file_path, line_numbers in lines_by_file.items():
+        # The same line numbers as the csv reader: the rows have no embedded line breaks
+        with open(file_path, mode="r", newline="") as file:
+            lines = [line.rstrip("\r\n") for number, line in enumerate(file, 1) if number in line_numbers]
+        quarantine_file = rejected_file(file_path)
+        try:
+            with open(quarantine_file, mode="r", newline="") as file:
+                known = {line.rstrip("\r\n") for line in file}
+        except FileNotFoundError:
+            known = set()  # If file not found, it means no rows were rejected yet
+        lines = [line for line in dict.fromkeys(lines) if line not in known]
+        if not lines:
+            continue
+        with open(quarantine_file, mode="a", newline="") as file:
+            file.writelines(f"{line}\n" for line in lines)
+            file.flush()
+            os.fsync(file.fileno())
+        written.append(quarantine_file)
+    return written
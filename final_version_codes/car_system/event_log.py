@@ -0,0 +1,288 @@
+import os
+import csv
+import json
+import time
+import threading
+from datetime import datetime
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class EventLog:
+    '''
+    This is a class for the append-only log of the vehicle entry/exit events.
+    Every event is one line appended to the log, so its cost does not depend on the number of records.
+    The record CSV files are only the compacted snapshots: a checkpoint remembers the last event
+    folded into them, and on startup the events after it are replayed on top of the snapshots.
+    Appending is thread-safe and split in two steps: append_* buffers the event, commit applies the
+    fsync policy. Concurrent commits share their fsync (group commit): while one thread syncs,
+    the others queue up and the next sync covers all of them.
+    A compaction first rotates the log: the events so far are closed in a segment file named after
+    the sequence number of its last event, and the next events go to a new log file. Once the snapshots
+    contain the segment's events, the checkpoint deletes it, so the lanes keep appending meanwhile.
+
+    Each line of the log is one of:
+        seq,ENTRY,plate,entry_time
+        seq,EXIT,plate,entry_time,exit_time,fee,record_id
+
+    Attributes:
+    log_file: The path of the event log.
+    checkpoint_file: The path of the checkpoint (JSON) of the last compaction.
+    fsync_policy: "always" fsyncs every event, "interval" at most once every fsync_interval seconds,
+        "never" leaves it to the operating system.
+    fsync_interval: The seconds between two fsyncs with the "interval" policy.
+    compact_every: The number of events after which a compaction is due.
+    seq: The sequence number of the last event.
+    checkpoint_seq: The sequence number of the last event folded into the snapshots.
+    pending: The number of events written since the last checkpoint.
+
+    Methods:
+    recover: Restore the history snapshot and return the events to replay.
+    append_entry: Append a vehicle entry event.
+    append_exit: Append a vehicle exit event.
+    commit: Apply the fsync policy to an appended event.
+    should_compact: Check whether a compaction is due.
+    rotate: Close the events so far in a segment and start a new log file.
+    checkpoint: Record that the snapshots contain the events up to a sequence number and delete their segments.
+    close: Flush and close the log.
+    '''
+
+    def __init__(self, log_file="final_version_codes/data_storage/events.log",
+                 checkpoint_file="final_version_codes/data_storage/checkpoint.json",
+                 fsync_policy="interval", fsync_interval=1.0, compact_every=1000):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"fsync_policy must be one of {FSYNC_POLICIES}")
+        self.log_file = log_file
+        self.checkpoint_file = checkpoint_file
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.seq = 0
+        self.checkpoint_seq = 0
+        self._segment_seq = 0  # The sequence number before the first event of the current log file
+        self.pending = 0
+        self._file = None
+        self._writer = None
+        self._last_fsync = time.monotonic()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._synced_seq = 0
+
+    def _read_checkpoint(self):
+        '''
+        This method reads the checkpoint, a missing file means nothing was compacted yet.
+        '''
+        try:
+            with open(self.checkpoint_file, mode="r") as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {"seq": 0, "history_bytes": None}
+
+    def recover(self, history_file):
+        '''
+        This method must be called once at startup, before the history snapshot is loaded.
+        If a compaction was interrupted after appending to the history file, the appended rows
+        are cut off again, as they are still in the log and will be replayed.
+
+        ***Parameters***
+        history_file: str
+            The path of the history records CSV file.
+
+        ***Returns***
+        list
+            The events after the checkpoint, as ("ENTRY", plate, entry_time)
+            or ("EXIT", plate, entry_time, exit_time, fee, record_id) tuples.
+        '''
+        checkpoint = self._read_checkpoint()
+        self.seq = self.checkpoint_seq = checkpoint["seq"]
+        history_bytes = checkpoint.get("history_bytes")
+        if history_bytes is not None and os.path.exists(history_file) \
+                and os.path.getsize(history_file) > history_bytes:
+            with open(history_file, mode="r+b") as file:
+                file.truncate(history_bytes)
+
+        events = []
+        for segment_seq, segment_file in self._segments():
+            if segment_seq <= checkpoint["seq"]:
+                os.remove(segment_file)  # Folded, the compaction stopped before deleting it
+                continue
+            self._read_events(segment_file, checkpoint["seq"], events)
+        self._segment_seq = self.seq
+        self._read_events(self.log_file, checkpoint["seq"], events)
+
+        self.pending = len(events)
+        self._synced_seq = self.seq
+        self._file = open(self.log_file, mode="a", newline="")
+        self._writer = csv.writer(self._file)
+        return events
+
+    def _segments(self):
+        '''
+        This method returns the (last sequence number, path) of the rotated segments, oldest first.
+        '''
+        directory = os.path.dirname(self.log_file) or "."
+        prefix = os.path.basename(self.log_file) + "."
+        segments = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                segments.append((int(name[len(prefix):]), os.path.join(directory, name)))
+        return sorted(segments)
+
+    def _read_events(self, file_path, after_seq, events):
+        '''
+        This method appends the events of a log file after a sequence number to events.
+        '''
+        try:
+            with open(file_path, mode="r", newline="") as file:
+                for row in csv.reader(file):
+                    event = self._parse(row)
+                    if event is None:
+                        continue  # A torn last line after a crash
+                    seq, event = event
+                    if seq > after_seq:
+                        events.append(event)
+                        self.seq = max(self.seq, seq)
+        except FileNotFoundError:
+            pass  # If file not found, it means no events were logged yet
+
+    @staticmethod
+    def _parse(row):
+        '''
+        This method parses one line of the log, it returns None for a malformed line.
+        '''
+        try:
+            seq, kind = int(row[0]), row[1]
+            if kind == "ENTRY" and len(row) == 4:
+                return seq, (kind, row[2], datetime.strptime(row[3], TIME_FORMAT))
+            if kind == "EXIT" and len(row) in (6, 7):
+                # The logs written before the record IDs have no record_id column
+                record_id = int(row[6]) if len(row) == 7 else None
+                return seq, (kind, row[2], datetime.strptime(row[3], TIME_FORMAT),
+                             datetime.strptime(row[4], TIME_FORMAT), float(row[5]), record_id)
+        except (IndexError, ValueError):
+            pass
+        return None
+
+    def _append(self, row):
+        '''
+        This method appends one event to the log buffer and returns its sequence number.
+        '''
+        with self._lock:
+            self.seq += 1
+            self._writer.writerow([self.seq] + row)
+            self.pending += 1
+            if self.fsync_policy != "always":
+                self._file.flush()
+            return self.seq
+
+    def commit(self, seq):
+        '''
+        This method applies the fsync policy to the event seq (and to every event before it).
+        Callers holding a lock of their own should release it first, so the lanes share the fsync.
+        '''
+        if self.fsync_policy == "always":
+            self._sync(seq)
+        elif self.fsync_policy == "interval" \
+                and time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._sync(seq)
+
+    def _sync(self, seq):
+        '''
+        This method makes sure the events up to seq are on disk.
+        The fsync runs outside the append lock, so the other lanes keep appending meanwhile.
+        '''
+        with self._sync_lock:
+            if self._synced_seq >= seq:
+                return  # Another thread's fsync already covered this event
+            with self._lock:
+                self._file.flush()
+                target = self.seq
+            # The rotation takes the sync lock, so the file is not swapped meanwhile
+            os.fsync(self._file.fileno())
+            self._synced_seq = target
+            self._last_fsync = time.monotonic()
+
+    def append_entry(self, plate, entry_time):
+        '''
+        This method appends a vehicle entry event and returns its sequence number.
+        '''
+        return self._append(["ENTRY", plate, entry_time.strftime(TIME_FORMAT)])
+
+    def append_exit(self, plate, entry_time, exit_time, fee, record_id):
+        '''
+        This method appends a vehicle exit event and returns its sequence number.
+        '''
+        return self._append(["EXIT", plate, entry_time.strftime(TIME_FORMAT),
+                             exit_time.strftime(TIME_FORMAT), fee, record_id])
+
+    def should_compact(self):
+        '''
+        This method checks whether enough events were logged to compact them into the snapshots.
+        It counts the events since the last rotation, so a compaction in progress, or one which failed,
+        is not started again for every event.
+        '''
+        return self.seq - self._segment_seq >= self.compact_every
+
+    def rotate(self):
+        '''
+        This method closes the events so far in a segment file and starts a new log file.
+        The caller takes its snapshot of the records at the same time, under the lock of its writers,
+        so the segments up to the returned sequence number hold exactly the events of the snapshot.
+
+        ***Returns***
+        int
+            The sequence number of the last event of the segment.
+        '''
+        with self._sync_lock, self._lock:
+            if self.seq == self._segment_seq:
+                return self.seq  # Nothing logged since the last rotation, e.g. a failed compaction is retried
+            self._file.flush()
+            if self.fsync_policy != "never":
+                os.fsync(self._file.fileno())
+                self._synced_seq = self.seq
+            self._file.close()
+            os.replace(self.log_file, f"{self.log_file}.{self.seq}")
+            self._file = open(self.log_file, mode="a", newline="")
+            self._writer = csv.writer(self._file)
+            self._segment_seq = self.seq
+            return self.seq
+
+    def checkpoint(self, seq, history_file):
+        '''
+        This method must be called once the snapshots contain the events up to seq, the last one of a rotated
+        segment. It records the checkpoint atomically and then deletes the segments up to seq;
+        the other threads may keep appending meanwhile.
+
+        ***Parameters***
+        seq: int
+            The sequence number of the last event in the snapshots.
+        history_file: str
+            The path of the history records CSV file, its size is kept in the checkpoint.
+            None while the history file is being rewritten: the recovery must then not trim it.
+        '''
+        history_bytes = None
+        if history_file is not None:
+            history_bytes = os.path.getsize(
+                history_file) if os.path.exists(history_file) else 0
+        temp_file = self.checkpoint_file + ".tmp"
+        with open(temp_file, mode="w") as file:
+            json.dump({"seq": seq, "history_bytes": history_bytes}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.checkpoint_file)
+        for segment_seq, segment_file in self._segments():
+            if segment_seq <= seq:
+                os.remove(segment_file)
+        with self._lock:
+            self.checkpoint_seq = seq
+            self.pending = self.seq - seq
+
+    def close(self):
+        '''
+        This method flushes and closes the log.
+        '''
+        if self._file is not None:
+            self._sync(self.seq)
+            self._file.close()
+            self._file = None
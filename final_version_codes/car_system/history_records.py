@@ -0,0 +1,331 @@
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+import numpy as np
+from car_system.tariff import to_epoch_seconds
+from car_system.event_log import TIME_FORMAT
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _epoch_seconds(time):
+    '''
+    This function returns the epoch seconds of a datetime, or of a time in TIME_FORMAT (e.g. an imported file).
+    '''
+    if isinstance(time, str):
+        time = datetime.strptime(time, TIME_FORMAT)
+    return (time - EPOCH) // timedelta(seconds=1)
+
+
+class HistoryRecords(Sequence):
+    '''
+    This is a class for the in-memory historical parking records, with a stable ID per record.
+    It reads like a list of (plate, entry time, exit time, fee) tuples, so the interface and
+    the export code use it as before, but the records are stored by column in NumPy arrays:
+    the plates are dictionary-encoded, the times are int64 epoch seconds and the fees are float32,
+    about 33 bytes per record instead of a tuple and four objects. The tuples are only built when read,
+    and the scans (match) and aggregates (columns) run on the arrays.
+    A deletion only leaves a tombstone in its slot, which costs O(1);
+    compact drops the tombstones physically once there are enough of them.
+
+    Attributes:
+    next_id: The ID given to the next appended record.
+    dead: The number of tombstones waiting for a compaction.
+    plates: The distinct plates, a plate is stored as its index in this list.
+
+    Methods:
+    append: Append a record and return its ID.
+    extend: Append several records.
+    append_columns: Append records given as columns.
+    get: Return the record of an ID.
+    remove_id: Delete the record of an ID, leaving a tombstone.
+    items: Iterate over the (ID, record) pairs of the live records.
+    slots: Return the number of slots, tombstones included.
+    live_slots: Return the live slots in a range of slots.
+    items_from: Iterate over the live (ID, record) pairs from a slot on.
+    dead_ids: Return the IDs of the tombstones.
+    match: Return the live slots matching a plate and exit time range.
+    record: Return the record of a slot.
+    columns: Return the columns of the live records.
+    compact: Drop the tombstones.
+    '''
+
+    def __init__(self, capacity=1024):
+        self.plates = []
+        self._plate_codes = {}  # plate -> index in plates
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._plate = np.zeros(capacity, dtype=np.int32)
+        self._entry = np.zeros(capacity, dtype=np.int64)
+        self._exit = np.zeros(capacity, dtype=np.int64)
+        self._fee = np.zeros(capacity, dtype=np.float32)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._size = 0
+        self._ids_sorted = True  # The IDs only grow, unless a stored record is appended out of order
+        self.next_id = 1
+        self.dead = 0
+
+    def _reserve(self, count):
+        '''
+        This method grows the columns, doubling their capacity, so that count more records fit.
+        '''
+        needed = self._size + count
+        capacity = len(self._ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ("_ids", "_plate", "_entry", "_exit", "_fee", "_alive"):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            setattr(self, name, grown)
+
+    def _encode_plate(self, plate):
+        '''
+        This method returns the code of a plate, adding it to the dictionary if it is new.
+        '''
+        code = self._plate_codes.get(plate)
+        if code is None:
+            code = self._plate_codes[plate] = len(self.plates)
+            self.plates.append(plate)
+        return code
+
+    def append(self, record, record_id=None):
+        '''
+        This method appends a record, with its stored ID if it has one, and returns its ID.
+        '''
+        plate, entry_time, exit_time, fee = record
+        if record_id is None:
+            record_id = self.next_id
+        elif self._size and record_id <= self._ids[self._size - 1]:
+            self._ids_sorted = False
+        self.next_id = max(self.next_id, record_id + 1)
+        self._reserve(1)
+        slot = self._size
+        self._ids[slot] = record_id
+        self._plate[slot] = self._encode_plate(plate)
+        self._entry[slot] = _epoch_seconds(entry_time)
+        self._exit[slot] = _epoch_seconds(exit_time)
+        self._fee[slot] = fee
+        self._alive[slot] = True
+        self._size += 1
+        return record_id
+
+    def extend(self, records):
+        '''
+        This method appends several records, each one gets a new ID.
+        '''
+        for record in records:
+            self.append(record)
+
+    def append_columns(self, plates, entry_times, exit_times, fees, record_ids=None):
+        '''
+        This method appends records given as columns, without building a tuple per record.
+
+        ***Parameters***
+        plates: sequence of str
+            The plates.
+        entry_times, exit_times: sequence of datetime or numpy.ndarray
+            The times, as accepted by tariff.to_epoch_seconds.
+        fees: sequence of float
+            The fees.
+        record_ids: sequence of int
+            The stored IDs of the records, None to give them new IDs.
+        '''
+        count = len(plates)
+        if not count:
+            return
+        # Only the distinct plates go through the dictionary
+        distinct, inverse = np.unique(np.asarray(plates, dtype=str), return_inverse=True)
+        codes = np.fromiter((self._encode_plate(plate) for plate in distinct.tolist()),
+                            dtype=np.int32, count=len(distinct))[inverse.reshape(-1)]
+        if record_ids is None:
+            record_ids = np.arange(self.next_id, self.next_id + count, dtype=np.int64)
+        else:
+            record_ids = np.asarray(record_ids, dtype=np.int64)
+            if np.any(np.diff(record_ids) <= 0) or (self._size and record_ids[0] <= self._ids[self._size - 1]):
+                self._ids_sorted = False
+        self._reserve(count)
+        new = slice(self._size, self._size + count)
+        self._ids[new] = record_ids
+        self._plate[new] = codes
+        self._entry[new] = to_epoch_seconds(entry_times)
+        self._exit[new] = to_epoch_seconds(exit_times)
+        self._fee[new] = fees
+        self._alive[new] = True
+        self._size += count
+        self.next_id = max(self.next_id, int(record_ids.max()) + 1)
+
+    def _slot_of(self, record_id):
+        '''
+        This method returns the slot of a live record ID, or None.
+        The IDs are appended in increasing order, so it is a binary search.
+        '''
+        ids = self._ids[:self._size]
+        if self._ids_sorted:
+            slot = int(np.searchsorted(ids, record_id))
+            found = slot < self._size and ids[slot] == record_id
+        else:
+            slots = np.flatnonzero(ids == record_id)
+            found = len(slots) > 0
+            slot = int(slots[-1]) if found else None
+        if not found or not self._alive[slot]:
+            return None
+        return slot
+
+    def record(self, slot):
+        '''
+        This method returns the (plate, entry time, exit time, fee) tuple of a slot.
+        '''
+        return (self.plates[self._plate[slot]],
+                EPOCH + timedelta(seconds=int(self._entry[slot])),
+                EPOCH + timedelta(seconds=int(self._exit[slot])),
+                round(float(self._fee[slot]), 2))
+
+    def get(self, record_id):
+        '''
+        This method returns the record of an ID, or None if it does not exist or was deleted.
+        '''
+        slot = self._slot_of(record_id)
+        return None if slot is None else self.record(slot)
+
+    def remove_id(self, record_id):
+        '''
+        This method deletes the record of an ID, its slot becomes a tombstone.
+
+        ***Returns***
+        bool
+            False if there was no such record.
+        '''
+        slot = self._slot_of(record_id)
+        if slot is None:
+            return False
+        self._alive[slot] = False
+        self.dead += 1
+        return True
+
+    def live_slots(self, start=0, stop=None):
+        '''
+        This method returns the live slots from a slot on, up to stop (excluded) or the last slot.
+        '''
+        stop = self._size if stop is None else stop
+        return np.flatnonzero(self._alive[start:stop]) + start
+
+    def items(self):
+        '''
+        This method iterates over the (ID, record) pairs of the live records, in insertion order.
+        '''
+        return self.items_from(0)
+
+    def slots(self):
+        '''
+        This method returns the number of slots, tombstones included.
+        '''
+        return self._size
+
+    def items_from(self, slot, stop=None):
+        '''
+        This method iterates over the live (ID, record) pairs from a slot on, up to stop (excluded) or the last slot.
+        '''
+        for index in self.live_slots(slot, stop):
+            yield int(self._ids[index]), self.record(index)
+
+    def dead_ids(self):
+        '''
+        This method returns the IDs of the tombstones.
+        '''
+        return self._ids[:self._size][~self._alive[:self._size]]
+
+    def match(self, plate=None, start=None, end=None):
+        '''
+        This method returns the live slots of a plate which exited in [start, end), in insertion order.
+        Every criterion is optional.
+        '''
+        mask = self._alive[:self._size].copy()
+        if plate is not None:
+            code = self._plate_codes.get(plate)
+            if code is None:
+                return np.zeros(0, dtype=np.int64)
+            mask &= self._plate[:self._size] == code
+        if start is not None:
+            mask &= self._exit[:self._size] >= _epoch_seconds(start)
+        if end is not None:
+            mask &= self._exit[:self._size] < _epoch_seconds(end)
+        return np.flatnonzero(mask)
+
+    def record_id(self, slot):
+        '''
+        This method returns the ID of the record of a slot.
+        '''
+        return int(self._ids[slot])
+
+    def columns(self, slots=None):
+        '''
+        This method returns the columns of the live records, or of the given slots, for the vectorized scans.
+
+        ***Returns***
+        dict
+            "id", "plate" (codes into plates), "entry_time" and "exit_time" (int64 epoch seconds) and "fee" arrays.
+        '''
+        if slots is None:
+            slots = self.live_slots()
+        return {
+            "id": self._ids[slots],
+            "plate": self._plate[slots],
+            "entry_time": self._entry[slots],
+            "exit_time": self._exit[slots],
+            "fee": self._fee[slots],
+        }
+
+    def compact(self, live=None, stop=None):
+        '''
+        This method drops the tombstones, it is O(n) so it only runs once enough of them piled up.
+        The compacted columns are built aside and then swapped in: the old arrays are never shifted,
+        so a reader still holding them keeps a consistent view of the old slots.
+
+        ***Parameters***
+        live: numpy.ndarray
+            The live slots below stop at an earlier snapshot, e.g. the records written to a file meanwhile.
+            Only the tombstones of that snapshot are then dropped: the records deleted since it
+            and below stop stay as tombstones, and so do those from stop on.
+        stop: int
+            The number of slots at the snapshot.
+        '''
+        if live is None:
+            live = self.live_slots()
+        else:
+            live = np.concatenate([live, np.arange(stop, self._size)])
+        count = len(live)
+        columns = {}
+        for name in ("_ids", "_plate", "_entry", "_exit", "_fee", "_alive"):
+            column = getattr(self, name)
+            compacted = np.zeros(len(column), dtype=column.dtype)
+            compacted[:count] = column[live]
+            columns[name] = compacted
+        for name, column in columns.items():
+            setattr(self, name, column)
+        self._size = count
+        self.dead = int(count - np.count_nonzero(self._alive[:count]))
+
+    def __len__(self):
+        return self._size - self.dead
+
+    def __iter__(self):
+        for slot in self.live_slots():
+            yield self.record(slot)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.record(slot) for slot in self.live_slots()[idx]]
+        if self.dead == 0:
+            if idx < 0:
+                idx += self._size
+            if not 0 <= idx < self._size:
+                raise IndexError("history record index out of range")
+            return self.record(idx)
+        try:
+            return self.record(self.live_slots()[idx])
+        except IndexError:
+            raise IndexError("history record index out of range") from None
+
+    def __eq__(self, other):
+        return list(self) == list(other)
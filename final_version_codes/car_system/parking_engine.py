@@ -0,0 +1,344 @@
+import asyncio
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+from car_system.record_storage import CsvRecordStorage
+from car_system.tariff import Tariff
+from car_system.plate_index import PlateIndex
+
+Receipt = namedtuple("Receipt", ["plate", "entry_time", "exit_time", "hours", "fee"])
+
+logger = logging.getLogger(__name__)
+
+
+class ParkingError(Exception):
+    '''
+    This is the error raised by the parking engine when an entry or exit is refused.
+    Its message is meant to be shown to the operator as it is.
+
+    Attributes:
+    suggestions: The plates the operator may have meant, e.g. the parked plates close to a misread exit plate.
+    '''
+
+    def __init__(self, message, suggestions=()):
+        super().__init__(message)
+        self.suggestions = list(suggestions)
+
+
+class ParkingEngine:
+    '''
+    This is a class for the entry/exit, fee and persistence logic of the parking lot, without any interface.
+    The Tk screens, gate controllers, benchmarks and servers all drive the parking lot through it.
+    It is safe to use from many lanes at once: each plate is guarded by one of lock_shards locks,
+    so the duplicate-entry and not-present checks are atomic while different plates run in parallel.
+
+    Attributes:
+    storage: The storage backend of the records, the CSV files by default.
+    fee_per_hour: The parking fee of every hour, at least one hour is charged, when no tariff is given.
+    tariff: The Tariff computing the fees.
+    lock_shards: The number of locks the plates are spread over.
+    listeners: The objects notified of every entry (on_entry(plate, entry_time)), exit (on_exit(receipt))
+        and deletion of historical records (on_delete(records), optional).
+    plate_index: The PlateIndex of the parked and historical plates, for the fuzzy plate search.
+    allocator: The SpotAllocator of the parking spots, None for a parking lot without capacity limit.
+    parking_records: A mapping of the current parking records, owned by the storage.
+    history_records: A sequence of the historical parking records, owned by the storage.
+
+    Methods:
+    add_listener: Notify an object, e.g. a TrafficAnalytics, of every entry, exit and history deletion.
+    enter: Register a vehicle entry.
+    exit: Register a vehicle exit and return its receipt.
+    enter_async: Register a vehicle entry from an asyncio task.
+    exit_async: Register a vehicle exit from an asyncio task.
+    suggest_plates: Return the known plates closest to a misread plate.
+    compute_fee: Compute the parking time and fee of a stay.
+    rebill_history: Compute the fees of the historical records with another tariff.
+    occupancy: Return the number of vehicles in the parking lot.
+    spot_of: Return the parking spot of a vehicle.
+    free_spots: Return the number of free spots of a level, zone or spot type.
+    history: Return the historical records matching a query.
+    history_count: Count the historical records matching a query.
+    history_page: Return one page of the historical records matching a query.
+    delete_history_record: Delete the historical record of an ID.
+    delete_history_records: Delete the historical records of a set of IDs.
+    delete_history_range: Delete the historical records matching a query.
+    close: Close the storage backend and the spot assignments file.
+    '''
+
+    def __init__(self, storage=None, fee_per_hour=5, lock_shards=64, tariff=None, allocator=None):
+        self.storage = storage or CsvRecordStorage()
+        self.fee_per_hour = fee_per_hour
+        self.tariff = tariff or Tariff(hourly_rate=fee_per_hour)
+        self.lock_shards = lock_shards
+        self.parking_records = self.storage.parking_records
+        self.history_records = self.storage.history_records
+        self._plate_locks = [threading.Lock() for _ in range(lock_shards)]
+        # The records to delete are read and deleted at once, so the listeners get exactly the deleted ones
+        self._delete_lock = threading.Lock()
+        self.listeners = []
+        self.plate_index = PlateIndex(self.parking_records.keys())
+        self.plate_index.update(self.storage.history_plates())
+        self.allocator = allocator
+        if allocator is not None:
+            # The vehicles already parked get their spots back, the others the free ones in order of entry
+            plates = [plate for plate, _ in sorted(self.parking_records.items(), key=lambda item: item[1])]
+            for plate in allocator.restore(plates):
+                logger.warning("No free spot for %s, parked before the restart: the parking lot is overbooked", plate)
+
+    def add_listener(self, listener):
+        '''
+        This method registers an object with on_entry(plate, entry_time) and on_exit(receipt) methods,
+        called after every successful entry and exit, outside of the plate locks. An optional
+        on_delete(records) method gets the (plate, entry time, exit time, fee) of the deleted historical records.
+        '''
+        self.listeners.append(listener)
+
+    def _notify(self, event, *args):
+        '''
+        This method calls a method of every listener which has it. The event is already stored,
+        so a failing listener is logged and neither fails the operation nor stops the other listeners.
+        '''
+        for listener in self.listeners:
+            method = getattr(listener, event, None)
+            if method is None:
+                continue
+            try:
+                method(*args)
+            except Exception:
+                logger.exception("The %s listener failed on %s", type(listener).__name__, event)
+
+    def _plate_lock(self, plate):
+        '''
+        This method returns the lock guarding a plate.
+        '''
+        return self._plate_locks[hash(plate) % self.lock_shards]
+
+    @staticmethod
+    def _clean_plate(plate):
+        '''
+        This method strips the plate and refuses an empty one.
+        '''
+        plate = (plate or "").strip()
+        if not plate:
+            raise ParkingError("License plate cannot be empty!")
+        return plate
+
+    def enter(self, plate, ts=None, vehicle_type="standard"):
+        '''
+        This method registers a vehicle entry, and assigns it a parking spot if the parking lot has an allocator.
+
+        ***Parameters***
+        plate: str
+            The license plate of the vehicle.
+        ts: datetime
+            The entry time, now by default.
+        vehicle_type: str
+            The type of the vehicle, see spot_allocator.FALLBACK_TYPES.
+
+        ***Returns***
+        datetime
+            The entry time.
+        '''
+        plate = self._clean_plate(plate)
+        with self._plate_lock(plate):
+            if plate in self.parking_records:
+                raise ParkingError("This vehicle is already in the parking lot!")
+            if self.allocator is not None and self.allocator.assign(plate, vehicle_type) is None:
+                raise ParkingError("The parking lot is full!")
+            entry_time = ts or datetime.now()
+            try:
+                self.storage.record_entry(plate, entry_time)
+            except Exception:
+                if self.allocator is not None:
+                    self.allocator.release(plate)
+                raise
+        self.plate_index.add(plate)
+        self._notify("on_entry", plate, entry_time)
+        return entry_time
+
+    def exit(self, plate, ts=None):
+        '''
+        This method registers a vehicle exit, the vehicle moves to the history records.
+
+        ***Parameters***
+        plate: str
+            The license plate of the vehicle.
+        ts: datetime
+            The exit time, now by default.
+
+        ***Returns***
+        Receipt
+            The plate, entry time, exit time, charged hours and fee of the stay.
+        '''
+        plate = self._clean_plate(plate)
+        with self._plate_lock(plate):
+            entry_time = self.parking_records.get(plate)
+            if entry_time is None:
+                raise ParkingError("This vehicle is not in the parking lot!",
+                                   [match for match, _ in self.suggest_plates(plate)])
+            exit_time = ts or datetime.now()
+            hours, fee = self.compute_fee(entry_time, exit_time)
+            self.storage.record_exit(plate, entry_time, exit_time, fee)
+            if self.allocator is not None:
+                self.allocator.release(plate)
+        receipt = Receipt(plate, entry_time, exit_time, hours, fee)
+        self._notify("on_exit", receipt)
+        return receipt
+
+    async def enter_async(self, plate, ts=None, vehicle_type="standard"):
+        '''
+        This method registers a vehicle entry without blocking the event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.enter, plate, ts, vehicle_type)
+
+    async def exit_async(self, plate, ts=None):
+        '''
+        This method registers a vehicle exit without blocking the event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.exit, plate, ts)
+
+    def suggest_plates(self, plate, limit=5, present_only=True):
+        '''
+        This method returns the known plates closest to a plate, e.g. misread by the OCR, see PlateIndex.search.
+
+        ***Parameters***
+        plate: str
+            The plate as read.
+        limit: int
+            The maximum number of plates returned.
+        present_only: bool
+            Only the plates in the parking lot, for an exit, or all the plates ever seen, for a history search.
+
+        ***Returns***
+        list
+            (plate, distance) pairs, closest first.
+        '''
+        within = self.parking_records if present_only else None
+        return self.plate_index.search(plate, limit, within)
+
+    def compute_fee(self, entry_time, exit_time):
+        '''
+        This method computes the charged hours and the fee of a stay with the tariff.
+        '''
+        return self.tariff.compute_fee(entry_time, exit_time)
+
+    def rebill_history(self, tariff=None, plate=None, start=None, end=None):
+        '''
+        This method computes the fees of the historical records matching a query, see history,
+        e.g. to compare a new tariff with the fees actually charged. The records are not modified.
+
+        ***Returns***
+        numpy.ndarray
+            The fees, in the order of the records returned by history.
+        '''
+        if plate is None and start is None and end is None:
+            records = self.history_records
+        else:
+            records = self.storage.query_history(plate, start, end)
+        return (tariff or self.tariff).bill_records(records)
+
+    def occupancy(self):
+        '''
+        This method returns the number of vehicles in the parking lot.
+        '''
+        return len(self.parking_records)
+
+    def spot_of(self, plate):
+        '''
+        This method returns the Spot of a parked vehicle, None without an allocator.
+        '''
+        return None if self.allocator is None else self.allocator.spot_of(plate)
+
+    def free_spots(self, level=None, zone=None, spot_type=None):
+        '''
+        This method returns the number of free spots, of a level, a zone of a level and/or a spot type,
+        in O(1) for the gate signs. It returns None without an allocator.
+        '''
+        return None if self.allocator is None else self.allocator.free_count(level, zone, spot_type)
+
+    def history(self, plate=None, start=None, end=None):
+        '''
+        This method returns the historical records matching a query.
+
+        ***Parameters***
+        plate: str
+            Only the records of this plate, all plates by default.
+        start: datetime
+            Only the records which exited at or after this time.
+        end: datetime
+            Only the records which exited before this time.
+
+        ***Returns***
+        list
+            The matching (plate, entry time, exit time, fee) records, in insertion order.
+        '''
+        return self.storage.query_history(plate, start, end)
+
+    def history_count(self, plate=None, start=None, end=None):
+        '''
+        This method counts the historical records matching a query, see history.
+        '''
+        return self.storage.count_history(plate, start, end)
+
+    def history_page(self, offset, limit, plate=None, start=None, end=None):
+        '''
+        This method returns one page of the historical records matching a query, see history.
+
+        ***Returns***
+        list
+            Up to limit (ID, record) pairs, the ID being the one accepted by delete_history_record.
+        '''
+        return self.storage.page_history(offset, limit, plate, start, end)
+
+    def delete_history_record(self, record_id):
+        '''
+        This method deletes the historical record of an ID.
+        '''
+        if not self.delete_history_records([record_id]):
+            raise ParkingError("This historical record does not exist!")
+
+    def delete_history_records(self, record_ids):
+        '''
+        This method deletes the historical records of a set of IDs in one go.
+
+        ***Returns***
+        int
+            The number of records deleted, the unknown IDs are skipped.
+        '''
+        record_ids = list(dict.fromkeys(record_ids))
+        if not self.listeners:
+            return self.storage.delete_history_records(record_ids)
+        with self._delete_lock:
+            records = [record for record in map(self.history_records.get, record_ids) if record is not None]
+            deleted = self.storage.delete_history_records(record_ids)
+        if records:
+            self._notify("on_delete", records)
+        return deleted
+
+    def delete_history_range(self, start=None, end=None, plate=None):
+        '''
+        This method deletes the historical records matching a query, see history.
+
+        ***Returns***
+        int
+            The number of records deleted.
+        '''
+        if not self.listeners:
+            return self.storage.delete_history_range(start, end, plate)
+        with self._delete_lock:
+            matches = self.storage.page_history(0, self.storage.count_history(plate, start, end), plate, start, end)
+            deleted = self.storage.delete_history_records([record_id for record_id, _ in matches])
+        if matches:
+            self._notify("on_delete", [record for _, record in matches])
+        return deleted
+
+    def close(self):
+        '''
+        This method closes the storage backend and the spot assignments file.
+        '''
+        self.storage.close()
+        if self.allocator is not None:
+            self.allocator.close()
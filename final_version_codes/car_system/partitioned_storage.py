@@ -0,0 +1,546 @@
+import os
+import csv
+import json
+import shutil
+from bisect import bisect_right
+from collections import OrderedDict
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+import numpy as np
+from car_system.record_storage import (CsvRecordStorage, PARKING_RECORDS_FILE, TOMBSTONE_FILE,
+                                       HISTORY_HEADER)
+from car_system.history_records import HistoryRecords, EPOCH
+from car_system.csv_loader import load_history_csv, quarantine_rows
+from car_system.event_log import TIME_FORMAT
+from car_system.analytics import summarize_history, merge_summaries, DWELL_BINS_MINUTES
+
+HISTORY_DIRECTORY = "final_version_codes/data_storage/history"
+MANIFEST_FILE = "partitions.json"
+
+
+def partition_name(time):
+    '''
+    This function returns the name of the monthly partition of a time, e.g. "2024-05".
+    '''
+    return time.strftime("%Y-%m")
+
+
+class PartitionedHistory(Sequence):
+    '''
+    This is a read-only sequence view of the historical records of all the partitions, oldest first.
+    Its length comes from the manifest, the older partitions are only loaded when their records are read.
+
+    Methods:
+    items: Iterate over the (ID, record) pairs.
+    get: Return the record of an ID.
+    columns: Return the time and fee columns of all the records.
+    summarize: Aggregate the records from the summaries of the partitions.
+    extend: Append records to the current partition.
+    '''
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def _parts(self):
+        '''
+        This method yields the HistoryRecords of every partition, loading them one at a time.
+        '''
+        for name in self.storage.partition_names():
+            yield self.storage.partition(name)
+
+    def items(self):
+        for records in self._parts():
+            yield from records.items()
+
+    def get(self, record_id):
+        records = self.storage.partition_of(record_id)
+        return None if records is None else records.get(record_id)
+
+    def columns(self):
+        '''
+        This method returns the "id", "entry_time", "exit_time" and "fee" columns of all the records.
+        The plate codes are left out, every partition has its own plate dictionary.
+        '''
+        parts = [records.columns() for records in self._parts()]
+        return {key: np.concatenate([part[key] for part in parts])
+                for key in ("id", "entry_time", "exit_time", "fee")}
+
+    def summarize(self, dwell_bins_minutes, window_hours=0):
+        return self.storage.summarize_history(dwell_bins_minutes, window_hours)
+
+    def extend(self, records):
+        self.storage.active_history.extend(records)
+
+    def __len__(self):
+        return sum(self.storage.partition_length(name) for name in self.storage.partition_names())
+
+    def __iter__(self):
+        for records in self._parts():
+            yield from records
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(self)[idx]
+        if idx < 0:
+            idx += len(self)
+        if idx >= 0:
+            for name in self.storage.partition_names():
+                length = self.storage.partition_length(name)
+                if idx < length:
+                    return self.storage.partition(name)[idx]
+                idx -= length
+        raise IndexError("history record index out of range")
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+
+class PartitionedRecordStorage(CsvRecordStorage):
+    '''
+    This is the CSV storage backend with the history split into monthly partition files.
+    Only the current partition is loaded at startup and written to, like the history file of CsvRecordStorage.
+    When a vehicle exits in a later month, the current partition is compacted and closed, and a new one starts.
+    The closed partitions are listed in a manifest with their ID and exit time ranges: a query only opens
+    the partitions its time range covers, and at most max_loaded_partitions of them stay in memory.
+    The record IDs keep growing across partitions, so the partition of an ID is found from the manifest.
+
+    Attributes:
+    history_directory: The folder of the partition files and of the manifest.
+    max_loaded_partitions: The number of closed partitions kept in memory, the least recently used are unloaded.
+    active_partition: The name of the current partition.
+    partitions: The manifest of the closed partitions, name -> first/last ID, first/last exit time, row count
+        and the summary of its records for the analytics (see analytics.summarize_history).
+    deleted_ids: The tombstones of the records of the closed partitions.
+
+    Methods:
+    partition_names: Return the names of all the partitions, oldest first.
+    partition: Return the HistoryRecords of a partition, loading it if needed.
+    partition_of: Return the HistoryRecords of the partition of an ID.
+    partition_length: Return the number of records of a partition without loading it.
+    summarize_history: Aggregate the history without loading every partition.
+    roll_partition: Close the current partition and start a new one.
+    archive_partitions: Move or delete the closed partitions older than a month.
+    import_history_file: Split a single history file into partitions.
+    '''
+
+    def __init__(self, parking_file=PARKING_RECORDS_FILE, history_directory=HISTORY_DIRECTORY,
+                 event_log=None, tombstone_file=TOMBSTONE_FILE, compact_tombstones_at=1000,
+                 max_loaded_partitions=12):
+        self.history_directory = history_directory
+        self.max_loaded_partitions = max_loaded_partitions
+        self.manifest_file = os.path.join(history_directory, MANIFEST_FILE)
+        self.partitions = {}
+        self.deleted_ids = set()
+        self._loaded = OrderedDict()  # closed partition name -> HistoryRecords, least recently used first
+        os.makedirs(history_directory, exist_ok=True)
+        self.active_partition = self._load_manifest() or partition_name(datetime.now())
+        super().__init__(parking_file, self._partition_file(self.active_partition), event_log,
+                         tombstone_file, compact_tombstones_at)
+        self.active_history.next_id = max(self.active_history.next_id, self._last_closed_id() + 1)
+        self.history_records = PartitionedHistory(self)
+
+    def _partition_file(self, name):
+        return os.path.join(self.history_directory, f"history_{name}.csv")
+
+    def _load_manifest(self):
+        '''
+        This method loads the manifest of the closed partitions and returns the name of the current one.
+        '''
+        try:
+            with open(self.manifest_file, mode="r") as file:
+                manifest = json.load(file)
+        except FileNotFoundError:
+            return None
+        self.partitions = manifest["partitions"]
+        return manifest["active"]
+
+    def _save_manifest(self):
+        '''
+        This method writes the manifest atomically.
+        '''
+        temp_file = self.manifest_file + ".tmp"
+        with open(temp_file, mode="w") as file:
+            json.dump({"active": self.active_partition, "partitions": self.partitions}, file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.manifest_file)
+
+    def _last_closed_id(self):
+        return max((info["last_id"] for info in self.partitions.values()), default=0)
+
+    def partition_names(self):
+        '''
+        This method returns the names of all the partitions, oldest first, the current one last.
+        '''
+        return sorted(self.partitions, key=lambda name: self.partitions[name]["first_id"]) \
+            + [self.active_partition]
+
+    def partition(self, name):
+        '''
+        This method returns the HistoryRecords of a partition, loading the closed ones on demand.
+        '''
+        if name == self.active_partition:
+            return self.active_history
+        with self._lock:
+            records = self._loaded.get(name)
+            if records is not None:
+                self._loaded.move_to_end(name)
+                return records
+            records = HistoryRecords()
+            first_error = len(self.load_errors)
+            try:
+                load_history_csv(self._partition_file(name), records, self.load_errors)
+            except FileNotFoundError:
+                pass  # An archived partition
+            quarantine_rows(self.load_errors, first_error)
+            info = self.partitions[name]
+            info["count"] = records.slots()
+            for record_id in self.deleted_ids:
+                if info["first_id"] <= record_id <= info["last_id"]:
+                    records.remove_id(record_id)
+            self._loaded[name] = records
+            while len(self._loaded) > self.max_loaded_partitions:
+                self._loaded.popitem(last=False)
+            return records
+
+    def partition_of(self, record_id):
+        '''
+        This method returns the HistoryRecords of the partition holding an ID, or None.
+        '''
+        names = sorted(self.partitions, key=lambda name: self.partitions[name]["first_id"])
+        index = bisect_right([self.partitions[name]["first_id"] for name in names], record_id) - 1
+        if index >= 0 and record_id <= self.partitions[names[index]]["last_id"]:
+            return self.partition(names[index])
+        if record_id > self._last_closed_id():
+            return self.active_history
+        return None
+
+    def partition_length(self, name):
+        '''
+        This method returns the number of live records of a partition, from the manifest if it is not loaded.
+        '''
+        if name == self.active_partition:
+            return len(self.active_history)
+        records = self._loaded.get(name)
+        if records is not None:
+            return len(records)
+        info = self.partitions[name]
+        deleted = sum(1 for record_id in self.deleted_ids
+                      if info["first_id"] <= record_id <= info["last_id"])
+        return info["count"] - deleted
+
+    def _covering_partitions(self, start, end):
+        '''
+        This method returns the names of the partitions which may hold records exiting in [start, end).
+        '''
+        names = []
+        for name in self.partition_names():
+            info = self.partitions.get(name)
+            if info is not None and info["count"]:
+                if start is not None and info["last_exit"] < start.strftime(TIME_FORMAT):
+                    continue
+                if end is not None and info["first_exit"] >= end.strftime(TIME_FORMAT):
+                    continue
+            names.append(name)
+        return names
+
+    def _matching_history(self, plate, start, end):
+        matching = []
+        with self._lock:
+            for name in self._covering_partitions(start, end):
+                records = self.partition(name)
+                matching.extend((records.record_id(slot), records.record(slot))
+                                for slot in records.match(plate, start, end))
+        return matching
+
+    def count_history(self, plate=None, start=None, end=None):
+        with self._lock:
+            if plate is None and start is None and end is None:
+                return len(self.history_records)
+            return sum(len(self.partition(name).match(plate, start, end))
+                       for name in self._covering_partitions(start, end))
+
+    def page_history(self, offset, limit, plate=None, start=None, end=None):
+        with self._lock:
+            return self._page_history(offset, limit, plate, start, end)
+
+    def _page_history(self, offset, limit, plate, start, end):
+        page = []
+        for name in self._covering_partitions(start, end):
+            if plate is None and start is None and end is None \
+                    and offset >= self.partition_length(name):
+                offset -= self.partition_length(name)  # Skipped without loading it
+                continue
+            records = self.partition(name)
+            slots = records.match(plate, start, end)
+            for slot in slots[offset:offset + limit - len(page)]:
+                page.append((records.record_id(slot), records.record(slot)))
+            offset = max(0, offset - len(slots))
+            if len(page) == limit:
+                break
+        return page
+
+    def history_plates(self):
+        '''
+        This method returns the plates of the current partition and of the loaded closed ones,
+        the other partitions are not loaded for it.
+        '''
+        with self._lock:
+            loaded = list(self._loaded.values())
+        return {plate for records in [self.active_history] + loaded for plate in records.plates}
+
+    def _remove_record(self, record_id):
+        if self.active_history.remove_id(record_id):
+            return True
+        records = self.partition_of(record_id)
+        if records is None or records is self.active_history or not records.remove_id(record_id):
+            return False
+        self.deleted_ids.add(record_id)
+        return True
+
+    def _tombstone_count(self):
+        return self.active_history.dead + len(self.deleted_ids)
+
+    def load_tombstones(self):
+        '''
+        This method applies the deletions recorded in the tombstone file, the ones of the closed partitions
+        are kept in deleted_ids until their partition is loaded.
+        '''
+        try:
+            with open(self.tombstone_file, mode="r") as file:
+                for line in file:
+                    if line.strip().isdigit() and not self.active_history.remove_id(int(line)):
+                        self.deleted_ids.add(int(line))
+        except FileNotFoundError:
+            pass  # If file not found, it means no records were deleted since the last compaction
+
+    def record_exit(self, plate, entry_time, exit_time, fee):
+        if partition_name(exit_time) > self.active_partition:
+            with self._compaction_lock, self._lock:
+                if partition_name(exit_time) > self.active_partition:
+                    self.roll_partition(partition_name(exit_time))
+        super().record_exit(plate, entry_time, exit_time, fee)
+
+    def _write_partition(self, name, records):
+        '''
+        This method rewrites a closed partition file atomically and updates its manifest entry.
+        '''
+        file_path = self._partition_file(name)
+        temp_file = file_path + ".tmp"
+        with open(temp_file, mode="w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(HISTORY_HEADER)
+            for record_id, (plate, entry_time, exit_time, fee) in records.items():
+                writer.writerow([plate, entry_time.strftime(TIME_FORMAT),
+                                 exit_time.strftime(TIME_FORMAT), fee, record_id])
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, file_path)
+        self.partitions[name]["count"] = len(records)
+        self.partitions[name]["summary"] = self._history_summary(records)
+
+    def _tombstone_ids(self):
+        return [*super()._tombstone_ids(), *sorted(self.deleted_ids)]
+
+    def compact_history(self):
+        '''
+        This method rewrites the partitions with deleted records, then the current one, and prunes the tombstone file.
+        The closed partitions are compacted under the lock and written outside it; the records deleted meanwhile
+        stay in deleted_ids, so they are still applied if their partition is reloaded from the old file.
+        '''
+        with self._compaction_lock:
+            with self._lock:
+                compacted = set(self.deleted_ids)
+                rewrites = []
+                for name, info in list(self.partitions.items()):
+                    if any(info["first_id"] <= record_id <= info["last_id"] for record_id in compacted):
+                        records = self.partition(name)
+                        records.compact()
+                        rewrites.append((name, records))
+            for name, records in rewrites:
+                self._write_partition(name, records)
+            with self._lock:
+                self.deleted_ids -= compacted
+                self._save_manifest()
+            super().compact_history()
+
+    @staticmethod
+    def _history_summary(records, dwell_bins_minutes=DWELL_BINS_MINUTES, window_hours=0, last_hour=None):
+        '''
+        This method returns the analytics summary of the records of a partition.
+        '''
+        columns = records.columns()
+        return summarize_history(columns["entry_time"], columns["exit_time"], columns["fee"],
+                                 dwell_bins_minutes, window_hours, last_hour)
+
+    @classmethod
+    def _summary(cls, records):
+        '''
+        This method returns the manifest entry of the records of a partition.
+        '''
+        columns = records.columns()
+        if not len(columns["id"]):
+            return None
+        return {
+            "first_id": int(columns["id"].min()),
+            "last_id": int(columns["id"].max()),
+            "first_exit": (EPOCH + timedelta(seconds=int(columns["exit_time"].min()))).strftime(TIME_FORMAT),
+            "last_exit": (EPOCH + timedelta(seconds=int(columns["exit_time"].max()))).strftime(TIME_FORMAT),
+            "count": len(records),
+            "summary": cls._history_summary(records),
+        }
+
+    def summarize_history(self, dwell_bins_minutes=DWELL_BINS_MINUTES, window_hours=0):
+        '''
+        This method aggregates the history for TrafficAnalytics.seed, see analytics.summarize_history.
+        A closed partition contributes the summary kept in its manifest entry, it is only loaded
+        if it has none yet (a manifest written before the summaries), other dwell time bins,
+        deletions not compacted yet, or records within the hourly traffic window.
+        '''
+        with self._lock:
+            active = self.active_history.columns()
+            partitions = {name: dict(info) for name, info in self.partitions.items()}
+            deleted_ids = set(self.deleted_ids)
+        last_exits = [int(active["exit_time"].max())] if len(active["exit_time"]) else []
+        last_exits += [int((datetime.strptime(info["last_exit"], TIME_FORMAT) - EPOCH).total_seconds())
+                       for info in partitions.values() if info["count"]]
+        last_hour = max(last_exits) // 3600 if last_exits else None
+        window_start = None
+        if window_hours and last_hour is not None:
+            window_start = (EPOCH + timedelta(hours=last_hour - window_hours + 1)).strftime(TIME_FORMAT)
+
+        summaries, recent, computed = [], [], {}
+        for name, info in partitions.items():
+            summary = info.get("summary")
+            pending = any(info["first_id"] <= record_id <= info["last_id"] for record_id in deleted_ids)
+            if pending or summary is None or summary["dwell_bins_minutes"] != list(dwell_bins_minutes):
+                summary = self._history_summary(self.partition(name), dwell_bins_minutes)
+                if not pending and list(dwell_bins_minutes) == list(DWELL_BINS_MINUTES):
+                    computed[name] = summary
+            summaries.append(summary)
+            if window_start is not None and info["count"] and info["last_exit"] >= window_start:
+                recent.append(self.partition(name).columns())
+        summaries.append(summarize_history(active["entry_time"], active["exit_time"], active["fee"],
+                                           dwell_bins_minutes))
+        merged = merge_summaries(summaries, dwell_bins_minutes)
+        if window_start is not None:
+            columns = recent + [active]
+            merged["hourly_traffic"] = summarize_history(
+                np.concatenate([part["entry_time"] for part in columns]),
+                np.concatenate([part["exit_time"] for part in columns]),
+                np.concatenate([part["fee"] for part in columns]),
+                dwell_bins_minutes, window_hours, last_hour)["hourly_traffic"]
+        if computed:
+            with self._lock:
+                for name, summary in computed.items():
+                    if name in self.partitions:
+                        self.partitions[name]["summary"] = summary
+                self._save_manifest()
+        return merged
+
+    def roll_partition(self, name):
+        '''
+        This method compacts and closes the current partition, and makes name the current one.
+        '''
+        with self._compaction_lock, self._lock:
+            self.compact_history()
+            summary = self._summary(self.active_history)
+            closed = self.active_partition
+            next_id = self.active_history.next_id
+            if summary is not None:
+                self.partitions[closed] = summary
+                self._loaded[closed] = self.active_history
+            self.active_partition = name
+            self.history_file = self._partition_file(name)
+            self.active_history = HistoryRecords()
+            self.active_history.next_id = next_id
+            self.saved_history_slots = 0
+            self._save_manifest()
+            self.event_log.checkpoint(self.event_log.checkpoint_seq, self.history_file)
+            if summary is None and os.path.exists(self._partition_file(closed)):
+                os.remove(self._partition_file(closed))
+            while len(self._loaded) > self.max_loaded_partitions:
+                self._loaded.popitem(last=False)
+
+    def archive_partitions(self, before, archive_directory=None):
+        '''
+        This method removes the closed partitions of the months before a date from the history,
+        moving their files to archive_directory, or deleting them if it is None.
+
+        ***Returns***
+        list
+            The names of the removed partitions.
+        '''
+        removed = []
+        with self._compaction_lock, self._lock:
+            for name in sorted(self.partitions):
+                if name >= partition_name(before):
+                    continue
+                file_path = self._partition_file(name)
+                if os.path.exists(file_path):
+                    if archive_directory is None:
+                        os.remove(file_path)
+                    else:
+                        os.makedirs(archive_directory, exist_ok=True)
+                        shutil.move(file_path, os.path.join(archive_directory, os.path.basename(file_path)))
+                info = self.partitions.pop(name)
+                self.deleted_ids = {record_id for record_id in self.deleted_ids
+                                    if not info["first_id"] <= record_id <= info["last_id"]}
+                self._loaded.pop(name, None)
+                removed.append(name)
+            if removed:
+                self._save_manifest()
+        return removed
+
+    def import_history_file(self, history_file):
+        '''
+        This method splits a single history file (the CsvRecordStorage one) into closed partitions,
+        when switching a parking lot over to this backend. A partition is started whenever the exit month
+        grows, so the ID ranges of the partitions do not overlap. The records from the month of the current
+        partition on go to the current partition. It must run before any exit is recorded.
+        '''
+        records = HistoryRecords()
+        first_error = len(self.load_errors)
+        load_history_csv(history_file, records, self.load_errors)
+        quarantine_rows(self.load_errors, first_error)
+        with self._compaction_lock, self._lock:
+            if len(self.history_records):
+                raise ValueError("The history must be empty to import a history file")
+            current, part = None, None
+            for record_id, record in records.items():
+                name = partition_name(record[2])
+                if current == self.active_partition or name >= self.active_partition:
+                    if part is not None:
+                        self._write_partition_file(current, part)
+                        part = None
+                    current = self.active_partition
+                    self.active_history.append(record, record_id)
+                    continue
+                if part is not None and name > current:
+                    self._write_partition_file(current, part)
+                    part = None
+                if part is None:
+                    current, part = name, HistoryRecords()
+                part.append(record, record_id)
+            if part is not None:
+                self._write_partition_file(current, part)
+            self.active_history.next_id = max(self.active_history.next_id, self._last_closed_id() + 1)
+            self._save_manifest()
+            self.compact_records()
+
+    def _write_partition_file(self, name, records):
+        '''
+        This method adds a closed partition from records, merging them into a partition of the same name.
+        '''
+        if name in self.partitions:
+            merged = self.partition(name)
+            for record_id, record in records.items():
+                merged.append(record, record_id)
+            records = merged
+        self.partitions[name] = self._summary(records)
+        self._write_partition(name, records)
+        self._loaded.pop(name, None)
+
+    def close(self):
+        super().close()
+        self._loaded.clear()
@@ -0,0 +1,218 @@
+'''
+This module finds the license plates close to an OCR read, e.g. a plate read "AB0123" at the exit
+while "ABO123" is in the parking lot. The characters the OCR mixes up are collapsed into one
+canonical character, so those confusions cost nothing to find, and up to max_distance other
+errors are found through the deletion variants of the canonical plates (the same variant is reached
+from both plates by deleting the differing characters). The candidates are then ranked by an edit
+distance where confusing two similar characters is cheap.
+'''
+
+import threading
+import numpy as np
+
+CONFUSABLE_GROUPS = ("0ODQ", "8B", "1IL", "5S", "2Z", "6G", "7T", "UV")
+CONFUSABLE_COST = 0.25
+_CANONICAL = str.maketrans({char: group[0] for group in CONFUSABLE_GROUPS for char in group[1:]})
+_GROUP = {char: group for group in CONFUSABLE_GROUPS for char in group}
+_SEPARATORS = str.maketrans("", "", " -.·")
+
+
+def normalize(plate):
+    '''
+    This function returns a plate in upper case without spaces, dashes or dots.
+    '''
+    return plate.upper().translate(_SEPARATORS)
+
+
+def canonical(plate):
+    '''
+    This function returns the canonical form of a plate, where the confusable characters are the same.
+    '''
+    return normalize(plate).translate(_CANONICAL)
+
+
+def substitution_cost(a, b):
+    '''
+    This function returns the cost of reading the character b instead of a.
+    '''
+    if a == b:
+        return 0.0
+    group = _GROUP.get(a)
+    return CONFUSABLE_COST if group is not None and b in group else 1.0
+
+
+def plate_distance(a, b):
+    '''
+    This function returns the edit distance between two normalized plates,
+    a substitution of confusable characters costs CONFUSABLE_COST instead of 1.
+    '''
+    previous = [float(j) for j in range(len(b) + 1)]
+    for i, char_a in enumerate(a, start=1):
+        current = [float(i)]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + substitution_cost(char_a, char_b)))
+        previous = current
+    return previous[-1]
+
+
+def _deletion_variants(key, max_distance):
+    '''
+    This function returns the strings obtained by deleting up to max_distance characters of key, key included.
+    '''
+    variants = level = {key}
+    for _ in range(max_distance):
+        level = {variant[:index] + variant[index + 1:] for variant in level for index in range(len(variant))}
+        variants = variants | level
+    return variants
+
+
+class PlateIndex:
+    '''
+    This is a class for the fuzzy search of license plates.
+    The deletion variants of the canonical plates are kept as sorted arrays of hashes, about 16 bytes per variant,
+    so a search is a few binary searches whatever the number of plates. The plates added since the last merge
+    are kept in a small dictionary, and merged into the arrays once there are merge_every of them.
+    Adding a plate already indexed costs a dictionary lookup, the new ones are queued and indexed
+    once merge_every of them are waiting or on the next search, so a search never indexes more than that.
+
+    Attributes:
+    max_distance: The number of errors tolerated besides the confusable characters.
+    merge_every: The number of recent plates kept outside of the arrays.
+
+    Methods:
+    add: Add a plate.
+    update: Add several plates.
+    search: Return the plates closest to a read, best first.
+    '''
+
+    def __init__(self, plates=(), max_distance=1, merge_every=4096):
+        self.max_distance = max_distance
+        self.merge_every = merge_every
+        self._plates = {}       # canonical plate -> the plates having it
+        self._keys = []         # canonical plates, by number
+        self._hashes = np.zeros(0, dtype=np.int64)   # sorted variant hashes ...
+        self._owners = np.zeros(0, dtype=np.int64)   # ... and the number of their canonical plate
+        self._recent = {}       # variant -> numbers of the canonical plates not merged yet
+        self._recent_count = 0
+        self._queued = []
+        self._lock = threading.Lock()
+        self.update(plates)
+
+    def add(self, plate):
+        '''
+        This method adds a plate, it is queued unless it is indexed already.
+        '''
+        self.update((plate,))
+
+    def update(self, plates):
+        '''
+        This method adds several plates.
+        '''
+        with self._lock:
+            for plate in plates:
+                indexed = self._plates.get(canonical(plate))
+                if indexed is None or plate not in indexed:
+                    self._queued.append(plate)
+            if len(self._queued) >= self.merge_every:
+                self._index_queued()
+
+    def __len__(self):
+        with self._lock:
+            self._index_queued()
+            return sum(len(plates) for plates in self._plates.values())
+
+    def _index_queued(self):
+        '''
+        This method indexes the queued plates, merging the recent ones into the arrays when there are enough.
+        '''
+        if not self._queued:
+            return
+        queued, self._queued = self._queued, []
+        # A large batch, e.g. the plates of the history at startup, goes straight into the arrays
+        bulk = len(queued) >= self.merge_every
+        hashes, owners = [], []
+        for plate in queued:
+            key = canonical(plate)
+            if not key:
+                continue
+            plates = self._plates.get(key)
+            if plates is not None:
+                plates.add(plate)
+                continue
+            self._plates[key] = {plate}
+            number = len(self._keys)
+            self._keys.append(key)
+            if bulk:
+                for variant in _deletion_variants(key, self.max_distance):
+                    hashes.append(hash(variant))
+                    owners.append(number)
+                continue
+            for variant in _deletion_variants(key, self.max_distance):
+                self._recent.setdefault(variant, []).append(number)
+            self._recent_count += 1
+        if bulk or self._recent_count >= self.merge_every:
+            self._merge(hashes, owners)
+
+    def _merge(self, hashes, owners):
+        '''
+        This method moves the recent variants, and the given variant hashes and owners, into the sorted arrays.
+        '''
+        for variant, numbers in self._recent.items():
+            hashes.extend([hash(variant)] * len(numbers))
+            owners.extend(numbers)
+        hashes = np.concatenate((self._hashes, np.array(hashes, dtype=np.int64)))
+        owners = np.concatenate((self._owners, np.array(owners, dtype=np.int64)))
+        order = np.argsort(hashes, kind="stable")
+        self._hashes, self._owners = hashes[order], owners[order]
+        self._recent = {}
+        self._recent_count = 0
+
+    def _candidates(self, key):
+        '''
+        This method returns the numbers of the canonical plates sharing a deletion variant with key.
+        '''
+        variants = list(_deletion_variants(key, self.max_distance))
+        hashes = np.array([hash(variant) for variant in variants], dtype=np.int64)
+        starts = np.searchsorted(self._hashes, hashes, side="left")
+        ends = np.searchsorted(self._hashes, hashes, side="right")
+        numbers = set()
+        for start, end in zip(starts, ends):
+            numbers.update(self._owners[start:end].tolist())
+        for variant in variants:
+            numbers.update(self._recent.get(variant, ()))
+        return numbers
+
+    def search(self, plate, limit=5, within=None):
+        '''
+        This method returns the plates closest to a read, with their distance.
+
+        ***Parameters***
+        plate: str
+            The plate as read.
+        limit: int
+            The maximum number of plates returned.
+        within: container
+            Only the plates in it are returned, e.g. the parking records for an exit.
+
+        ***Returns***
+        list
+            (plate, distance) pairs, closest first, the exact plate first with distance 0.
+        '''
+        key = canonical(plate)
+        if not key:
+            return []
+        read = normalize(plate)
+        with self._lock:
+            self._index_queued()
+            candidates = [self._keys[number] for number in self._candidates(key)]
+            matches = []
+            for candidate in candidates:
+                for other in self._plates[candidate]:
+                    if within is not None and other not in within:
+                        continue
+                    distance = plate_distance(read, normalize(other))
+                    if distance <= self.max_distance + len(read) * CONFUSABLE_COST:
+                        matches.append((other, distance))
+        matches.sort(key=lambda match: (match[1], match[0]))
+        return matches[:limit]
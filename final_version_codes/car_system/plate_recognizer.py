@@ -0,0 +1,170 @@
+import threading
+import queue
+import numpy as np
+import hyperlpr3 as lpr3
+from car_system.recognition_cache import RecognitionCache, MISS
+from car_system.preprocess import FramePreprocessor
+
+
+class PlateRecognizer:
+    '''
+    This is a class for running license plate recognition with pre-loaded models.
+    The hyperlpr3 models are loaded once into a pool of inference sessions, so the
+    callers (one per lane) only pay for the inference itself.
+
+    Attributes:
+    pool_size: The number of inference sessions kept in the pool.
+    sessions: A queue holding the idle inference sessions.
+    ready: An event which is set once all the sessions are loaded.
+    cache: The RecognitionCache of the results by image content, None to always run the inference.
+    preprocessor: The default FramePreprocessor (region of interest and downscaling), None to infer the raw image.
+
+    Methods:
+    warm_up: Load and warm up the inference sessions in a background thread.
+    wait_until_ready: Block until the inference sessions are loaded.
+    recognize: Run the recognition on a decoded image and return all the results.
+    recognize_plate: Return the best (plate, confidence) pair of a decoded image.
+    '''
+
+    def __init__(self, pool_size=2, cache=None, preprocessor=None):
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1")
+        self.pool_size = pool_size
+        self.cache = cache
+        self.preprocessor = preprocessor
+        self.sessions = queue.Queue()
+        self.ready = threading.Event()
+        self._load_error = None
+        self._warm_up_thread = None
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        '''
+        This method starts loading the inference sessions in a background thread.
+        Calling it more than once has no effect.
+        '''
+        with self._lock:
+            if self._warm_up_thread is None:
+                self._warm_up_thread = threading.Thread(
+                    target=self._load_sessions, name="plate-recognizer-warm-up", daemon=True)
+                self._warm_up_thread.start()
+
+    def _load_sessions(self):
+        '''
+        This method loads the sessions and runs one dummy inference on each of them,
+        so that the first real image does not pay for the lazy allocations of onnxruntime.
+        '''
+        try:
+            blank = np.zeros((320, 320, 3), dtype=np.uint8)
+            for _ in range(self.pool_size):
+                catcher = lpr3.LicensePlateCatcher()
+                catcher(blank)
+                self.sessions.put(catcher)
+        except Exception as e:
+            self._load_error = e
+        finally:
+            self.ready.set()
+
+    def wait_until_ready(self, timeout=None):
+        '''
+        This method blocks until the inference sessions are loaded.
+        It returns False if the timeout expires first.
+        '''
+        self.warm_up()
+        if not self.ready.wait(timeout):
+            return False
+        if self._load_error is not None:
+            raise RuntimeError(
+                f"Failed to load the plate recognition models: {self._load_error}")
+        return True
+
+    def _infer(self, image):
+        '''
+        This method borrows one session from the pool and runs it on an image.
+        '''
+        catcher = self.sessions.get()
+        try:
+            return catcher(image)
+        finally:
+            self.sessions.put(catcher)
+
+    def recognize(self, image, preprocessor=None):
+        '''
+        This method runs the recognition on a decoded (BGR) image.
+        It borrows one session from the pool, so up to pool_size callers can run at the same time.
+
+        ***Parameters***
+        image: numpy.ndarray
+            The decoded image.
+        preprocessor: FramePreprocessor
+            The preprocessing of the lane, the default preprocessor of the recognizer if None.
+
+        ***Returns***
+        list
+            The hyperlpr3 results, each one as [plate, confidence, plate_type, box],
+            with the box in the coordinates of the original image.
+        '''
+        self.wait_until_ready()
+        preprocessor = preprocessor or self.preprocessor
+        if preprocessor is None:
+            return self._infer(image)
+
+        prepared, transform = preprocessor.prepare(image)
+        results = self._infer(prepared)
+        if not results and preprocessor.roi is not None and preprocessor.fallback_to_full_frame:
+            prepared, transform = preprocessor.prepare_full_frame(image)
+            results = self._infer(prepared)
+        return [[code, confidence, plate_type, preprocessor.to_original(box, transform)]
+                for code, confidence, plate_type, box in results]
+
+    def recognize_plate(self, image, preprocessor=None):
+        '''
+        This method returns the (plate, confidence) pair with the highest confidence,
+        or None if no plate is found in the image. The result is served from the cache if the same image was seen.
+        '''
+        if image is None:
+            return None
+        preprocessor = preprocessor or self.preprocessor
+        if self.cache is not None:
+            # The same frame cropped for another lane may give another result
+            roi = preprocessor.roi if preprocessor is not None else None
+            key = self.cache.key(image, None if roi is None else str(roi))
+            cached = self.cache.get(key)
+            if cached is not MISS:
+                return cached
+        results = self.recognize(image, preprocessor)
+        best = None
+        if results:
+            best = max(results, key=lambda result: result[1])
+            best = best[0], float(best[1])
+        if self.cache is not None:
+            self.cache.put(key, best)
+        return best
+
+
+_shared_recognizer = None
+_shared_recognizer_lock = threading.Lock()
+
+
+def get_recognizer(pool_size=2):
+    '''
+    This function returns the recognizer shared by the whole application.
+    It is created (and starts warming up) on the first call, the pool_size of later calls is ignored.
+    It caches the results of the last images in memory, for the retried uploads,
+    and downscales the large images before the detection.
+
+    ***Parameters***
+    pool_size: int
+        The number of inference sessions, i.e. how many lanes can run recognition at the same time.
+
+    ***Returns***
+    PlateRecognizer
+        The shared recognizer.
+    '''
+    global _shared_recognizer
+    with _shared_recognizer_lock:
+        if _shared_recognizer is None:
+            _shared_recognizer = PlateRecognizer(
+                pool_size, cache=RecognitionCache(), preprocessor=FramePreprocessor())
+            _shared_recognizer.warm_up()
+        return _shared_recognizer
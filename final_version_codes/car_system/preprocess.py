@@ -0,0 +1,79 @@
+import cv2
+
+
+class FramePreprocessor:
+    '''
+    This is a class for shrinking the gate camera images before the plate detection.
+    The image is cropped to the region of interest of the lane (where the plates actually show up),
+    then downscaled if it is still larger than max_side, as the inference time grows with the input size.
+    The boxes found on the prepared image are mapped back to the original coordinates.
+
+    Attributes:
+    roi: The (x, y, width, height) region of interest in original pixels, None for the full frame.
+    max_side: The longest side allowed after cropping, larger images are downscaled, None to never downscale.
+    fallback_to_full_frame: Whether to retry on the full frame when no plate is found in the region of interest.
+
+    Methods:
+    prepare: Crop and downscale an image.
+    prepare_full_frame: Only downscale an image, for the fallback.
+    to_original: Map a box of the prepared image back to the original image.
+    '''
+
+    def __init__(self, roi=None, max_side=1280, fallback_to_full_frame=True):
+        self.roi = roi
+        self.max_side = max_side
+        self.fallback_to_full_frame = fallback_to_full_frame
+
+    def _downscale(self, image):
+        '''
+        This method downscales an image whose longest side is above max_side, keeping its aspect ratio.
+
+        ***Returns***
+        numpy.ndarray, float
+            The image and the scale applied to it.
+        '''
+        height, width = image.shape[:2]
+        longest = max(height, width)
+        if not self.max_side or longest <= self.max_side:
+            return image, 1.0
+        scale = self.max_side / longest
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+
+    def prepare(self, image):
+        '''
+        This method crops an image to the region of interest and downscales it.
+
+        ***Returns***
+        numpy.ndarray, tuple
+            The prepared image and its transform (offset x, offset y, scale), for to_original.
+        '''
+        offset_x, offset_y = 0, 0
+        if self.roi is not None:
+            x, y, width, height = self.roi
+            image_height, image_width = image.shape[:2]
+            x, y = max(0, int(x)), max(0, int(y))
+            right = min(image_width, x + int(width))
+            bottom = min(image_height, y + int(height))
+            if right > x and bottom > y:
+                image = image[y:bottom, x:right]
+                offset_x, offset_y = x, y
+        image, scale = self._downscale(image)
+        return image, (offset_x, offset_y, scale)
+
+    def prepare_full_frame(self, image):
+        '''
+        This method only downscales an image, it is used when the region of interest had no plate.
+        '''
+        image, scale = self._downscale(image)
+        return image, (0, 0, scale)
+
+    @staticmethod
+    def to_original(box, transform):
+        '''
+        This method maps a (x1, y1, x2, y2) box of the prepared image back to the original image.
+        '''
+        offset_x, offset_y, scale = transform
+        x1, y1, x2, y2 = box
+        return [int(x1 / scale) + offset_x, int(y1 / scale) + offset_y,
+                int(x2 / scale) + offset_x, int(y2 / scale) + offset_y]
@@ -0,0 +1,282 @@
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+import cv2
+
+MISS = object()
+PERCEPTUAL_HASH_BITS = 64
+# The standard deviation of the 9x8 thumbnail under which an image is featureless, e.g. a black or uniform frame
+MIN_PERCEPTUAL_CONTRAST = 4.0
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(image):
+    '''
+    This function returns the hash of the decoded image bytes, identical images have the same hash
+    whatever file or upload they come from.
+
+    ***Parameters***
+    image: numpy.ndarray
+        The decoded image.
+
+    ***Returns***
+    str
+        The hex digest of the shape and pixels of the image.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(image.shape).encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def perceptual_hash(image):
+    '''
+    This function returns the 64-bit difference hash (dHash) of an image.
+    Near-duplicate images (re-encoded, slightly different exposure) have hashes a few bits apart.
+    A featureless image has no hash: its bits would be 0 whatever the image, so it would match every other one.
+
+    ***Returns***
+    int or None
+        The hash, None if the contrast of the image is under MIN_PERCEPTUAL_CONTRAST.
+    '''
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    if small.std() < MIN_PERCEPTUAL_CONTRAST:
+        return None
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+class RecognitionCache:
+    '''
+    This is a class for caching the recognition results by image content, so the retried uploads
+    and the re-processed frames do not run the inference again.
+    The memory tier is a bounded LRU, the optional disk tier is a SQLite file which survives restarts.
+    The disk tier is shared by the batch worker processes: it uses WAL journaling and waits for the locks
+    of the other processes, and a failed read or write only counts as a miss, it never fails a recognition.
+    The near duplicates are found through an index on max_distance + 1 bands of the perceptual hash:
+    two hashes at most max_distance bits apart have at least one equal band, so only the entries sharing
+    a band with the image are compared instead of all of them. The featureless images are only matched exactly.
+    The near-duplicate matching is unsafe for the frames of a fixed camera: at 9x8 pixels, the frames of
+    two different cars at the same gate may differ in only a few bits, and one would get the plate of the other.
+    Only enable it for uploads, where a near duplicate is the same photo re-encoded.
+
+    Attributes:
+    max_entries: The number of results kept in memory, the least recently used are evicted.
+    use_perceptual_hash: Whether near-duplicate images are matched by their perceptual hash, not for fixed cameras.
+    max_distance: The number of differing perceptual hash bits still considered a near duplicate.
+    disk_file: The path of the disk tier, None to keep the cache in memory only.
+    disk_timeout: The seconds to wait for the lock of another process on the disk tier.
+    hits, near_hits, disk_hits, misses: The counters of the lookups.
+
+    Methods:
+    key: Compute the cache key of an image.
+    get: Look up the result of a key.
+    put: Store the result of a key.
+    stats: Return the counters of the lookups.
+    clear: Empty the memory tier and reset the counters.
+    close: Close the disk tier.
+    '''
+
+    def __init__(self, max_entries=1024, use_perceptual_hash=False, max_distance=4, disk_file=None,
+                 disk_timeout=30.0):
+        self.max_entries = max_entries
+        self.use_perceptual_hash = use_perceptual_hash
+        self.max_distance = max_distance
+        self.disk_file = disk_file
+        self.hits = 0
+        self.near_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # content hash -> ((scope, perceptual hash) or None, result)
+        self._bands = {}  # (scope, band, bits) -> content hashes of the entries with these bits in this band
+        self._lock = threading.Lock()
+        self._disk = None
+        self._disk_lock = threading.Lock()
+        if disk_file:
+            os.makedirs(os.path.dirname(disk_file) or ".", exist_ok=True)
+            self._disk = sqlite3.connect(disk_file, timeout=disk_timeout, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("PRAGMA synchronous=NORMAL")
+            with self._disk:
+                self._disk.execute(
+                    "CREATE TABLE IF NOT EXISTS recognition_cache ("
+                    "key TEXT PRIMARY KEY, plate TEXT, confidence REAL)")
+
+    def key(self, image, scope=None):
+        '''
+        This method computes the cache key of an image: its content hash and, if enabled, its perceptual hash.
+
+        ***Parameters***
+        image: numpy.ndarray
+            The decoded image.
+        scope: str
+            What else the result depends on, e.g. the region of interest of the lane. The same image
+            may give another result in another scope, so neither the exact nor the near duplicate hits cross scopes.
+
+        ***Returns***
+        tuple
+            The content hash, and the (scope, perceptual hash) pair or None if there is no perceptual hash.
+        '''
+        digest = content_hash(image)
+        if scope is not None:
+            digest = f"{digest}:{scope}"
+        phash = perceptual_hash(image) if self.use_perceptual_hash else None
+        return digest, None if phash is None else (scope, phash)
+
+    def _band_keys(self, near):
+        '''
+        This method returns the (scope, band, bits) keys of a (scope, perceptual hash) pair in the near duplicate index.
+        '''
+        scope, phash = near
+        count = self.max_distance + 1
+        width = -(-PERCEPTUAL_HASH_BITS // count)
+        mask = (1 << width) - 1
+        return [(scope, band, (phash >> (band * width)) & mask) for band in range(count)]
+
+    def _index(self, digest, near):
+        for band_key in self._band_keys(near):
+            self._bands.setdefault(band_key, set()).add(digest)
+
+    def _unindex(self, digest, near):
+        for band_key in self._band_keys(near):
+            digests = self._bands.get(band_key)
+            if digests is not None:
+                digests.discard(digest)
+                if not digests:
+                    del self._bands[band_key]
+
+    def _find_near_duplicate(self, near):
+        '''
+        This method returns the content hash of the closest cached near duplicate in the same scope, or None.
+        Only the entries sharing a band of the hash with it are compared.
+        '''
+        best, best_distance = None, self.max_distance + 1
+        candidates = set()
+        for band_key in self._band_keys(near):
+            candidates |= self._bands.get(band_key, set())
+        for digest in candidates:
+            distance = bin(near[1] ^ self._entries[digest][0][1]).count("1")
+            if distance < best_distance:
+                best, best_distance = digest, distance
+        return best
+
+    def get(self, key):
+        '''
+        This method looks up the result of a key.
+
+        ***Returns***
+        tuple or None or MISS
+            The cached (plate, confidence) or None result, MISS if it is not cached.
+        '''
+        digest, near = key
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return self._entries[digest][1]
+            if near is not None:
+                match = self._find_near_duplicate(near)
+                if match is not None:
+                    self._entries.move_to_end(match)
+                    self.near_hits += 1
+                    return self._entries[match][1]
+        row = self._read_disk(digest)
+        with self._lock:
+            if row is not None:
+                result = None if row[0] is None else (row[0], row[1])
+                self._remember(digest, near, result)
+                self.disk_hits += 1
+                return result
+            self.misses += 1
+            return MISS
+
+    def _read_disk(self, digest):
+        '''
+        This method returns the (plate, confidence) row of a content hash in the disk tier, None if there is none
+        or the read failed, e.g. the database stayed locked by another process longer than the timeout.
+        '''
+        try:
+            with self._disk_lock:
+                if self._disk is None:
+                    return None
+                return self._disk.execute(
+                    "SELECT plate, confidence FROM recognition_cache WHERE key = ?", (digest,)).fetchone()
+        except sqlite3.Error as error:
+            logger.warning("The recognition cache could not be read, counted as a miss: %s", error)
+            return None
+
+    def _remember(self, digest, near, result):
+        '''
+        This method stores a result in the memory tier and evicts the least recently used ones.
+        '''
+        old = self._entries.get(digest)
+        if old is not None and old[0] is not None:
+            self._unindex(digest, old[0])
+        self._entries[digest] = (near, result)
+        self._entries.move_to_end(digest)
+        if near is not None:
+            self._index(digest, near)
+        while len(self._entries) > self.max_entries:
+            evicted, (evicted_near, _) = self._entries.popitem(last=False)
+            if evicted_near is not None:
+                self._unindex(evicted, evicted_near)
+
+    def put(self, key, result):
+        '''
+        This method stores the (plate, confidence) or None result of a key.
+        If the disk tier cannot be written, the result is only kept in memory.
+        '''
+        digest, near = key
+        with self._lock:
+            self._remember(digest, near, result)
+        if self._disk is None:
+            return
+        plate, confidence = result if result is not None else (None, None)
+        try:
+            with self._disk_lock, self._disk:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO recognition_cache (key, plate, confidence) VALUES (?, ?, ?)",
+                    (digest, plate, confidence))
+        except sqlite3.Error as error:
+            logger.warning("The recognition cache could not be written: %s", error)
+
+    def stats(self):
+        '''
+        This method returns the counters of the lookups and the number of cached results.
+        '''
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+    def clear(self):
+        '''
+        This method empties the memory tier and resets the counters, the disk tier is kept.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._bands.clear()
+            self.hits = self.near_hits = self.disk_hits = self.misses = 0
+
+    def close(self):
+        '''
+        This method closes the disk tier.
+        '''
+        with self._disk_lock:
+            if self._disk is not None:
+                self._disk.close()
+                self._disk = None
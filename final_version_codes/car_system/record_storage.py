@@ -0,0 +1,906 @@
+import os
+import csv
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from itertools import islice
+from collections.abc import Mapping, Sequence
+from datetime import datetime, timedelta
+from car_system.event_log import EventLog, TIME_FORMAT
+from car_system.history_records import HistoryRecords, EPOCH
+from car_system.csv_loader import load_parking_csv, load_history_csv, quarantine_rows
+from monitoring.metrics import CSV_SAVE_SECONDS, HISTORY_LOAD_SECONDS, timed
+
+PARKING_RECORDS_FILE = "final_version_codes/data_storage/parking_records.csv"
+HISTORY_RECORDS_FILE = "final_version_codes/data_storage/history_records.csv"
+TOMBSTONE_FILE = "final_version_codes/data_storage/history_tombstones.log"
+DATABASE_FILE = "final_version_codes/data_storage/parking_records.db"
+HISTORY_HEADER = ["Plate", "Entry Time", "Exit Time", "Fee", "ID"]
+MAX_PAGE_ANCHORS = 1024
+
+
+class RecordStorage(ABC):
+    '''
+    This is the base class of the storage backends behind the parking lot system.
+    A backend implements record_entry, record_exit and delete_history_record, the other methods
+    have default implementations on top of history_records which it may replace with faster ones.
+
+    Attributes:
+    parking_records: A mapping of the current parking records, plate -> entry time.
+    history_records: A sequence of the historical parking records, (plate, entry time, exit time, fee).
+        Every record has a stable ID, its items() method yields the (ID, record) pairs.
+
+    Methods:
+    record_entry: Store a vehicle entry.
+    record_exit: Store a vehicle exit, it moves the vehicle from the parking to the history records.
+    delete_history_record: Delete the historical record of an ID.
+    delete_history_records: Delete the historical records of a set of IDs.
+    delete_history_range: Delete the historical records matching a plate and exit time range.
+    import_history: Store a batch of historical records, e.g. from an imported file.
+    query_history: Return the historical records matching a plate and exit time range.
+    count_history: Count the historical records matching a plate and exit time range.
+    page_history: Return one page of the historical records matching a plate and exit time range.
+    history_plates: Return the distinct plates of the historical records.
+    close: Release the files or connections of the backend.
+    '''
+
+    parking_records = None
+    history_records = None
+
+    @abstractmethod
+    def record_entry(self, plate, entry_time):
+        '''
+        This method stores a vehicle entry.
+        '''
+
+    @abstractmethod
+    def record_exit(self, plate, entry_time, exit_time, fee):
+        '''
+        This method removes the vehicle from the parking records and stores its historical record.
+        '''
+
+    @abstractmethod
+    def delete_history_record(self, record_id):
+        '''
+        This method deletes the historical record of an ID.
+
+        ***Returns***
+        bool
+            False if there was no such record.
+        '''
+
+    def delete_history_records(self, record_ids):
+        '''
+        This method deletes the historical records of a set of IDs and returns how many were deleted.
+        '''
+        return sum(1 for record_id in record_ids if self.delete_history_record(record_id))
+
+    def delete_history_range(self, start=None, end=None, plate=None):
+        '''
+        This method deletes the historical records of a plate which exited in [start, end)
+        and returns how many were deleted.
+        '''
+        record_ids = [record_id for record_id, _ in self._matching_history(plate, start, end)]
+        return self.delete_history_records(record_ids)
+
+    def import_history(self, records):
+        '''
+        This method stores a batch of historical records, e.g. from an imported file; every record gets a new ID.
+        A backend whose history_records are only kept in memory must write them itself.
+
+        ***Returns***
+        int
+            The number of records stored.
+        '''
+        records = list(records)
+        self.history_records.extend(records)
+        return len(records)
+
+    def query_history(self, plate=None, start=None, end=None):
+        '''
+        This method returns the historical records of a plate which exited in [start, end).
+        Every criterion is optional, this default implementation scans the records.
+        '''
+        return [record for _, record in self._matching_history(plate, start, end)]
+
+    def _matching_history(self, plate, start, end):
+        '''
+        This method yields the (ID, record) pairs matching a plate and exit time range.
+        '''
+        for record_id, record in self.history_records.items():
+            if (plate is None or record[0] == plate) \
+                    and (start is None or record[2] >= start) \
+                    and (end is None or record[2] < end):
+                yield record_id, record
+
+    def count_history(self, plate=None, start=None, end=None):
+        '''
+        This method counts the historical records of a plate which exited in [start, end).
+        '''
+        if plate is None and start is None and end is None:
+            return len(self.history_records)
+        return sum(1 for _ in self._matching_history(plate, start, end))
+
+    def page_history(self, offset, limit, plate=None, start=None, end=None):
+        '''
+        This method returns one page of the historical records of a plate which exited in [start, end).
+
+        ***Returns***
+        list
+            Up to limit (ID, record) pairs.
+        '''
+        return list(islice(self._matching_history(plate, start, end), offset, offset + limit))
+
+    def history_plates(self):
+        '''
+        This method returns the distinct plates of the historical records, e.g. to index them for a fuzzy search.
+        '''
+        return {record[0] for record in self.history_records}
+
+    def close(self):
+        '''
+        This method releases the files or connections of the backend.
+        '''
+
+
+class CsvRecordStorage(RecordStorage):
+    '''
+    This is the default storage backend: the records are kept in memory, the CSV files are the
+    snapshots and the entry/exit events are appended to the event log in between.
+    A short lock covers the in-memory update and the buffered log write of each event,
+    the fsync is committed after releasing it so the concurrent lanes share it.
+    The compactions run in a background thread: under that lock they only rotate the event log and take
+    a snapshot of the records, the CSV files are written from the snapshot while the lanes keep going.
+    The history queries take the same lock, so they never see a compaction renumbering the slots
+    between finding the matching slots and reading their records.
+    Deleting a historical record appends its ID to the tombstone file, and once compact_tombstones_at
+    tombstones piled up, a background compaction rewrites the history file without them.
+
+    Attributes:
+    parking_records: A dictionary to store the current parking records.
+    history_records: The HistoryRecords of the historical parking records.
+    active_history: The HistoryRecords written to the history file, history_records itself for this backend.
+    parking_file: The path of the parking records CSV file.
+    history_file: The path of the history records CSV file.
+    tombstone_file: The path of the file of the deleted historical record IDs.
+    compact_tombstones_at: The number of tombstones which triggers a history compaction.
+    event_log: The append-only log of the entry/exit events.
+    saved_history_slots: The number of history slots already in the history CSV file.
+    load_errors: The (file, line, message) of the malformed rows skipped when loading the CSV files,
+        their raw lines are copied to the quarantine files before any rewrite.
+
+    Methods:
+    save_parking_records: Save the current parking records to a CSV file.
+    load_parking_records: Load the parking records from a CSV file.
+    save_history_records: Save the historical parking records to a CSV file.
+    append_history_records: Append the new historical parking records to the CSV file.
+    load_history_records: Load the historical parking records from a CSV file.
+    load_tombstones: Apply the deletions recorded in the tombstone file.
+    replay_events: Apply the logged events which are not in the CSV files yet.
+    compact_records: Fold the logged events into the CSV files.
+    compact_history: Rewrite the history file without the deleted records.
+    '''
+
+    def __init__(self, parking_file=PARKING_RECORDS_FILE, history_file=HISTORY_RECORDS_FILE,
+                 event_log=None, tombstone_file=TOMBSTONE_FILE, compact_tombstones_at=1000):
+        self.parking_records = {}
+        self.active_history = HistoryRecords()
+        self.history_records = self.active_history
+        self.parking_file = parking_file
+        self.history_file = history_file
+        self.tombstone_file = tombstone_file
+        self.compact_tombstones_at = compact_tombstones_at
+        self.event_log = event_log or EventLog()
+        self.saved_history_slots = 0
+        self.load_errors = []
+        self._lock = threading.RLock()
+        # One compaction at a time, always taken before _lock
+        self._compaction_lock = threading.RLock()
+        self._compaction_thread = None
+        self._compaction_thread_lock = threading.Lock()
+
+        events = self.event_log.recover(self.history_file)
+        legacy_format = self.load_history_records()
+        self.load_parking_records()
+        # The compactions rewrite the files without the malformed rows
+        quarantine_rows(self.load_errors)
+        self.replay_events(events)
+        self.load_tombstones()
+        if legacy_format:
+            # A history file written before the record IDs: rewrite it once with its IDs
+            self.compact_history()
+
+    def record_entry(self, plate, entry_time):
+        with self._lock:
+            self.parking_records[plate] = entry_time
+            seq = self.event_log.append_entry(plate, entry_time)
+        self.event_log.commit(seq)
+        if self.event_log.should_compact():
+            self._start_compaction(self.compact_records)
+
+    def record_exit(self, plate, entry_time, exit_time, fee):
+        with self._lock:
+            self.parking_records.pop(plate, None)
+            record_id = self.active_history.append((plate, entry_time, exit_time, fee))
+            seq = self.event_log.append_exit(plate, entry_time, exit_time, fee, record_id)
+        self.event_log.commit(seq)
+        if self.event_log.should_compact():
+            self._start_compaction(self.compact_records)
+
+    def delete_history_record(self, record_id):
+        return self.delete_history_records([record_id]) == 1
+
+    def delete_history_records(self, record_ids):
+        with self._lock:
+            deleted = [record_id for record_id in record_ids if self._remove_record(record_id)]
+            if deleted:
+                with open(self.tombstone_file, mode="a") as file:
+                    file.writelines(f"{record_id}\n" for record_id in deleted)
+                    file.flush()
+                    os.fsync(file.fileno())
+            self._schedule_history_compaction()
+        return len(deleted)
+
+    def delete_history_range(self, start=None, end=None, plate=None):
+        with self._lock:
+            return super().delete_history_range(start, end, plate)
+
+    def import_history(self, records):
+        '''
+        This method appends a batch of historical records and folds them into the history file at once:
+        they are not in the event log, so they would be lost by a restart before the next compaction.
+        '''
+        records = list(records)
+        with self._lock:
+            for record in records:
+                self.active_history.append(record)
+        self.compact_records()
+        return len(records)
+
+    def _matching_history(self, plate, start, end):
+        with self._lock:
+            history = self.history_records
+            return [(history.record_id(slot), history.record(slot))
+                    for slot in history.match(plate, start, end)]
+
+    def count_history(self, plate=None, start=None, end=None):
+        with self._lock:
+            return len(self.history_records.match(plate, start, end))
+
+    def page_history(self, offset, limit, plate=None, start=None, end=None):
+        with self._lock:
+            history = self.history_records
+            return [(history.record_id(slot), history.record(slot))
+                    for slot in history.match(plate, start, end)[offset:offset + limit]]
+
+    def history_plates(self):
+        # The plate dictionary of the columns, the plates of deleted records included
+        return list(self.active_history.plates)
+
+    def _remove_record(self, record_id):
+        '''
+        This method leaves the tombstone of a record in memory, it returns False if there is no such record.
+        '''
+        return self.active_history.remove_id(record_id)
+
+    def _tombstone_count(self):
+        '''
+        This method returns the number of deleted records still in the history files.
+        '''
+        return self.active_history.dead
+
+    def _tombstone_ids(self):
+        '''
+        This method returns the IDs to keep in the tombstone file after a history compaction.
+        '''
+        return self.active_history.dead_ids()
+
+    def _schedule_history_compaction(self):
+        '''
+        This method starts a background history compaction once enough tombstones piled up.
+        '''
+        if self._tombstone_count() >= self.compact_tombstones_at:
+            self._start_compaction(self.compact_history)
+
+    def _start_compaction(self, target):
+        '''
+        This method runs a compaction in a background thread, unless one is running already:
+        the next event or deletion starts another one if it is still due.
+        '''
+        with self._compaction_thread_lock:
+            if self._compaction_thread is not None and self._compaction_thread.is_alive():
+                return
+            self._compaction_thread = threading.Thread(
+                target=target, name=target.__name__.replace("_", "-"), daemon=True)
+            self._compaction_thread.start()
+
+    def close(self):
+        with self._compaction_thread_lock:
+            compaction_thread = self._compaction_thread
+        if compaction_thread is not None:
+            compaction_thread.join()
+        with self._lock:
+            pending = self.active_history.slots() > self.saved_history_slots
+        if pending:
+            # Also folds the records appended without an event, which a restart would not replay
+            self.compact_records()
+        self.event_log.close()
+
+    @timed(CSV_SAVE_SECONDS, file="parking")
+    def save_parking_records(self, parking_records=None):
+        '''
+        This method saves the current parking records, or a snapshot of them, to a CSV file.
+        The file is written aside and then swapped in, so a crash never leaves a half-written snapshot.
+        '''
+        if parking_records is None:
+            parking_records = self.parking_records
+        temp_file = self.parking_file + ".tmp"
+        with open(temp_file, mode="w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["Plate", "Entry Time"])
+            for plate, entry_time in parking_records.items():
+                writer.writerow(
+                    [plate, entry_time.strftime(TIME_FORMAT)])
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.parking_file)
+
+    def load_parking_records(self):
+        '''
+        This method loads the parking records from a CSV file, the malformed rows are added to load_errors.
+        '''
+        try:
+            self.parking_records.update(load_parking_csv(self.parking_file, self.load_errors))
+        except FileNotFoundError:
+            pass  # If file not found, it means no records exist yet
+
+    @timed(CSV_SAVE_SECONDS, file="history")
+    def save_history_records(self, slots=None):
+        '''
+        This method saves the live historical parking records, or those of the given slots, to a CSV file.
+        It rewrites the whole file, so it is only used by the history compaction.
+        '''
+        history = self.active_history
+        if slots is None:
+            slots = history.live_slots()
+            self.saved_history_slots = history.slots()
+        temp_file = self.history_file + ".tmp"
+        with open(temp_file, mode="w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(HISTORY_HEADER)
+            for slot in slots:
+                plate, entry_time, exit_time, fee = history.record(slot)
+                writer.writerow([plate, entry_time.strftime(TIME_FORMAT),
+                                 exit_time.strftime(TIME_FORMAT), fee, history.record_id(slot)])
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.history_file)
+
+    @timed(CSV_SAVE_SECONDS, file="history_append")
+    def append_history_records(self, stop=None):
+        '''
+        This method appends the historical parking records which are not in the CSV file yet,
+        up to the slot stop (excluded) of a snapshot or the last slot.
+        '''
+        if stop is None:
+            stop = self.active_history.slots()
+        write_header = not os.path.exists(self.history_file)
+        with open(self.history_file, mode="a", newline="") as file:
+            writer = csv.writer(file)
+            if write_header:
+                writer.writerow(HISTORY_HEADER)
+            for record_id, record in self.active_history.items_from(self.saved_history_slots, stop):
+                plate, entry_time, exit_time, fee = record
+                writer.writerow([plate, entry_time.strftime(TIME_FORMAT),
+                                 exit_time.strftime(TIME_FORMAT), fee, record_id])
+            file.flush()
+            os.fsync(file.fileno())
+        self.saved_history_slots = stop
+
+    @timed(HISTORY_LOAD_SECONDS)
+    def load_history_records(self):
+        '''
+        This method loads the historical parking records from a CSV file, the malformed rows are added to load_errors.
+        The files written before the record IDs have no ID column, their records are numbered in order.
+
+        ***Returns***
+        bool
+            True if the file has no ID column yet.
+        '''
+        legacy_format = False
+        try:
+            legacy_format = load_history_csv(self.history_file, self.active_history, self.load_errors)
+        except FileNotFoundError:
+            pass  # If file not found, it means no records exist yet
+        self.saved_history_slots = self.active_history.slots()
+        return legacy_format
+
+    def load_tombstones(self):
+        '''
+        This method applies the deletions recorded in the tombstone file.
+        '''
+        try:
+            with open(self.tombstone_file, mode="r") as file:
+                for line in file:
+                    if line.strip().isdigit():
+                        self.active_history.remove_id(int(line))
+        except FileNotFoundError:
+            pass  # If file not found, it means no records were deleted since the last compaction
+
+    def replay_events(self, events):
+        '''
+        This method applies the logged events which happened after the last compaction.
+        Replaying is idempotent for the parking records, so an interrupted compaction is harmless.
+        '''
+        for event in events:
+            if event[0] == "ENTRY":
+                _, plate, entry_time = event
+                self.parking_records[plate] = entry_time
+            else:
+                _, plate, entry_time, exit_time, fee, record_id = event
+                self.parking_records.pop(plate, None)
+                if record_id is not None and self.active_history.get(record_id) is not None:
+                    continue  # Already in the history file
+                self.active_history.append(
+                    (plate, entry_time, exit_time, fee), record_id)
+
+    def compact_records(self):
+        '''
+        This method folds the logged events into the CSV files and then deletes them from the event log.
+        The history file only gets the new records appended, the parking file is bounded by the lot size.
+        The writers only wait for the log rotation and the snapshot, not for the files.
+        '''
+        with self._compaction_lock:
+            with self._lock:
+                seq = self.event_log.rotate()
+                stop = self.active_history.slots()
+                parking_records = dict(self.parking_records)
+            self.append_history_records(stop)
+            self.save_parking_records(parking_records)
+            self.event_log.checkpoint(seq, self.history_file)
+
+    def compact_history(self):
+        '''
+        This method rewrites the history file without the deleted records and prunes the tombstone file.
+        The file is written from a snapshot of the live records, the writers only wait for the snapshot and
+        for the swap of the compacted columns; the records deleted meanwhile stay as tombstones.
+        '''
+        with self._compaction_lock:
+            self.compact_records()
+            with self._lock:
+                history = self.active_history
+                stop = history.slots()
+                live = history.live_slots(0, stop)
+                seq = self.event_log.checkpoint_seq
+            # While the file is swapped, a recovery must neither trim it nor replay the folded events
+            self.event_log.checkpoint(seq, None)
+            self.save_history_records(live)
+            with self._lock:
+                history.compact(live, stop)
+                self.saved_history_slots = len(live)
+                self._write_tombstones(self._tombstone_ids())
+            self.event_log.checkpoint(seq, self.history_file)
+
+    def _write_tombstones(self, record_ids):
+        '''
+        This method replaces the tombstone file with the given IDs.
+        '''
+        temp_file = self.tombstone_file + ".tmp"
+        with open(temp_file, mode="w") as file:
+            file.writelines(f"{record_id}\n" for record_id in record_ids)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.tombstone_file)
+
+
+class SqliteParkingRecords(Mapping):
+    '''
+    This is a read-only mapping view of the parking_records table, plate -> entry time.
+    Every lookup is a single query on the primary key, nothing is kept in memory.
+    '''
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    @property
+    def connection(self):
+        return self.storage.connection
+
+    def __getitem__(self, plate):
+        row = self.connection.execute(
+            "SELECT entry_time FROM parking_records WHERE plate = ?", (plate,)).fetchone()
+        if row is None:
+            raise KeyError(plate)
+        return datetime.strptime(row[0], TIME_FORMAT)
+
+    def __contains__(self, plate):
+        return self.connection.execute(
+            "SELECT 1 FROM parking_records WHERE plate = ?", (plate,)).fetchone() is not None
+
+    def __iter__(self):
+        for (plate,) in self.connection.execute(
+                "SELECT plate FROM parking_records ORDER BY entry_time"):
+            yield plate
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM parking_records").fetchone()[0]
+
+    def items(self):
+        for plate, entry_time in self.connection.execute(
+                "SELECT plate, entry_time FROM parking_records ORDER BY entry_time"):
+            yield plate, datetime.strptime(entry_time, TIME_FORMAT)
+
+
+class SqliteHistoryRecords(Sequence):
+    '''
+    This is a sequence view of the history_records table, in insertion order.
+    Iterating streams the rows from the database instead of materializing them.
+    A record is addressed by its ID, the primary key: get is a single-row lookup. A position is not
+    a column of the table, so indexing from the start skips the rows before it; the negative indexes
+    (e.g. [-1], the last exit) are read backwards from the end of the primary key instead.
+
+    Methods:
+    items: Iterate over the (ID, record) pairs.
+    get: Return the record of an ID.
+    extend: Insert records, e.g. imported from a file.
+    summarize: Aggregate the records with GROUP BY queries.
+    '''
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    @property
+    def connection(self):
+        return self.storage.connection
+
+    @staticmethod
+    def _epoch_hour(text):
+        '''
+        This method returns the epoch hour of a time given as "YYYY-MM-DD HH".
+        '''
+        return (datetime.strptime(text, "%Y-%m-%d %H") - EPOCH) // timedelta(hours=1)
+
+    def summarize(self, dwell_bins_minutes, window_hours=0):
+        '''
+        This method aggregates the records for TrafficAnalytics.seed with GROUP BY queries,
+        so the rows are not read into Python; see analytics.summarize_history for the summary.
+        '''
+        bounds = [minutes * 60 for minutes in dwell_bins_minutes]
+        dwell = "(CAST(strftime('%s', exit_time) AS INTEGER) - CAST(strftime('%s', entry_time) AS INTEGER))"
+        dwell_bin = "CASE " + " ".join(f"WHEN {dwell} < {bound} THEN {index}" for index, bound in enumerate(bounds)) \
+            + f" ELSE {len(bounds)} END" if bounds else "0"
+        summary = {
+            "dwell_bins_minutes": list(dwell_bins_minutes),
+            "arrivals_by_hour": [0] * 24,
+            "departures_by_hour": [0] * 24,
+            "dwell_histogram": [0] * (len(bounds) + 1),
+            "dwell_count": 0,
+            "dwell_seconds": 0.0,
+            "revenue_by_day": {},
+            "revenue_by_month": {},
+            "total_revenue": 0.0,
+            "last_exit": None,
+            "hourly_traffic": {},
+        }
+        for column, key in (("entry_time", "arrivals_by_hour"), ("exit_time", "departures_by_hour")):
+            for hour, count in self.connection.execute(
+                    f"SELECT CAST(substr({column}, 12, 2) AS INTEGER), COUNT(*) FROM history_records GROUP BY 1"):
+                summary[key][hour] = count
+        for index, count, seconds in self.connection.execute(
+                f"SELECT {dwell_bin}, COUNT(*), SUM({dwell}) FROM history_records GROUP BY 1"):
+            summary["dwell_histogram"][index] = count
+            summary["dwell_count"] += count
+            summary["dwell_seconds"] += float(seconds)
+        for day, total in self.connection.execute(
+                "SELECT substr(exit_time, 1, 10), SUM(fee) FROM history_records GROUP BY 1"):
+            summary["revenue_by_day"][day] = total
+            summary["revenue_by_month"][day[:7]] = summary["revenue_by_month"].get(day[:7], 0.0) + total
+            summary["total_revenue"] += total
+        last_exit = self.connection.execute("SELECT MAX(exit_time) FROM history_records").fetchone()[0]
+        if last_exit is None:
+            return summary
+        last_exit = datetime.strptime(last_exit, TIME_FORMAT)
+        summary["last_exit"] = int((last_exit - EPOCH).total_seconds())
+        if window_hours:
+            last = summary["last_exit"] // 3600
+            first = (EPOCH + timedelta(hours=last - window_hours + 1)).strftime(TIME_FORMAT)
+            traffic = summary["hourly_traffic"]
+            for hour, count in self.connection.execute(
+                    "SELECT substr(entry_time, 1, 13), COUNT(*) FROM history_records "
+                    "WHERE exit_time >= ? AND entry_time >= ? GROUP BY 1", (first, first)):
+                traffic.setdefault(self._epoch_hour(hour), [0, 0])[0] = count
+            for hour, count in self.connection.execute(
+                    "SELECT substr(exit_time, 1, 13), COUNT(*) FROM history_records "
+                    "WHERE exit_time >= ? GROUP BY 1", (first,)):
+                traffic.setdefault(self._epoch_hour(hour), [0, 0])[1] = count
+        return summary
+
+    @staticmethod
+    def _to_record(row):
+        plate, entry_time, exit_time, fee = row
+        return (plate, datetime.strptime(entry_time, TIME_FORMAT),
+                datetime.strptime(exit_time, TIME_FORMAT), fee)
+
+    @staticmethod
+    def _to_row(record):
+        '''
+        This method returns the column values of a record, its times being datetimes or strings in TIME_FORMAT.
+        '''
+        plate, entry_time, exit_time, fee = record
+        times = [time.strftime(TIME_FORMAT) if isinstance(time, datetime)
+                 else datetime.strptime(str(time), TIME_FORMAT).strftime(TIME_FORMAT)
+                 for time in (entry_time, exit_time)]
+        return (str(plate), *times, float(fee))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            rows = self.connection.execute(
+                "SELECT plate, entry_time, exit_time, fee FROM history_records "
+                "ORDER BY id LIMIT ? OFFSET ?", (max(0, stop - start), start))
+            return [self._to_record(row) for row in rows]
+        if idx < 0:
+            row = self.connection.execute(
+                "SELECT plate, entry_time, exit_time, fee FROM history_records "
+                "ORDER BY id DESC LIMIT 1 OFFSET ?", (-idx - 1,)).fetchone()
+        else:
+            row = self.connection.execute(
+                "SELECT plate, entry_time, exit_time, fee FROM history_records "
+                "ORDER BY id LIMIT 1 OFFSET ?", (idx,)).fetchone()
+        if row is None:
+            raise IndexError("history record index out of range")
+        return self._to_record(row)
+
+    def get(self, record_id):
+        '''
+        This method returns the record of an ID, or None, with a lookup on the primary key.
+        '''
+        row = self.connection.execute(
+            "SELECT plate, entry_time, exit_time, fee FROM history_records WHERE id = ?",
+            (record_id,)).fetchone()
+        return None if row is None else self._to_record(row)
+
+    def extend(self, records):
+        '''
+        This method inserts records in one transaction, each one gets a new ID.
+        '''
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO history_records (plate, entry_time, exit_time, fee) VALUES (?, ?, ?, ?)",
+                (self._to_row(record) for record in records))
+        self.storage.clear_page_anchors()
+
+    def __iter__(self):
+        for row in self.connection.execute(
+                "SELECT plate, entry_time, exit_time, fee FROM history_records ORDER BY id"):
+            yield self._to_record(row)
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM history_records").fetchone()[0]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def items(self):
+        for row in self.connection.execute(
+                "SELECT id, plate, entry_time, exit_time, fee FROM history_records ORDER BY id"):
+            yield row[0], self._to_record(row[1:])
+
+
+class SqliteRecordStorage(RecordStorage):
+    '''
+    This is the SQLite storage backend. The records stay in the database, which is indexed on
+    plate, entry time and exit time and uses WAL journaling, so lookups, inserts and deletes are
+    single-row operations and the startup does not depend on the amount of history.
+    Every thread gets its own connection, so the lanes read concurrently and SQLite serializes the commits;
+    the connections of the threads which ended are closed.
+    A page of the history is read from the ID ending the previous page (keyset pagination) when the pages
+    are browsed in order, so turning a page is an index seek instead of skipping all the rows before it.
+
+    Attributes:
+    database_file: The path of the SQLite database.
+    connection: The connection to the database of the calling thread.
+    parking_records: A mapping view of the current parking records.
+    history_records: A sequence view of the historical parking records.
+
+    Methods:
+    import_csv_records: Copy the records of the CSV files into the database.
+    clear_page_anchors: Forget the page positions, after the history changed.
+    '''
+
+    def __init__(self, database_file=DATABASE_FILE):
+        self.database_file = database_file
+        self._local = threading.local()
+        self._connections = {}  # thread -> connection
+        self._connections_lock = threading.Lock()
+        self._page_anchors = {}  # (plate, start, end, offset) -> ID of the record before offset
+        self._anchors_lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS parking_records (
+                    plate TEXT PRIMARY KEY,
+                    entry_time TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_parking_entry_time ON parking_records (entry_time);
+                CREATE TABLE IF NOT EXISTS history_records (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    plate TEXT NOT NULL,
+                    entry_time TEXT NOT NULL,
+                    exit_time TEXT NOT NULL,
+                    fee REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_history_plate ON history_records (plate);
+                CREATE INDEX IF NOT EXISTS idx_history_entry_time ON history_records (entry_time);
+                CREATE INDEX IF NOT EXISTS idx_history_exit_time ON history_records (exit_time);
+            ''')
+        self.parking_records = SqliteParkingRecords(self)
+        self.history_records = SqliteHistoryRecords(self)
+
+    @property
+    def connection(self):
+        '''
+        This property returns the connection of the calling thread, it is opened on first use.
+        Opening one closes those of the threads which ended, e.g. the threads of the metrics server.
+        '''
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.database_file, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                for thread in [thread for thread in self._connections if not thread.is_alive()]:
+                    self._connections.pop(thread).close()
+                self._connections[threading.current_thread()] = connection
+        return connection
+
+    def clear_page_anchors(self):
+        '''
+        This method forgets the page positions: once records are deleted, the offsets point to other records.
+        '''
+        with self._anchors_lock:
+            self._page_anchors.clear()
+
+    def record_entry(self, plate, entry_time):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO parking_records (plate, entry_time) VALUES (?, ?)",
+                (plate, entry_time.strftime(TIME_FORMAT)))
+
+    def record_exit(self, plate, entry_time, exit_time, fee):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM parking_records WHERE plate = ?", (plate,))
+            self.connection.execute(
+                "INSERT INTO history_records (plate, entry_time, exit_time, fee) VALUES (?, ?, ?, ?)",
+                (plate, entry_time.strftime(TIME_FORMAT), exit_time.strftime(TIME_FORMAT), fee))
+
+    def delete_history_record(self, record_id):
+        return self.delete_history_records([record_id]) == 1
+
+    def delete_history_records(self, record_ids):
+        with self.connection:
+            deleted = self.connection.executemany(
+                "DELETE FROM history_records WHERE id = ?",
+                ((record_id,) for record_id in record_ids)).rowcount
+        self.clear_page_anchors()
+        return deleted
+
+    def delete_history_range(self, start=None, end=None, plate=None):
+        where, parameters = self._where(plate, start, end)
+        with self.connection:
+            deleted = self.connection.execute(
+                "DELETE FROM history_records" + where, parameters).rowcount
+        self.clear_page_anchors()
+        return deleted
+
+    @staticmethod
+    def _where(plate, start, end):
+        '''
+        This method builds the WHERE clause of a plate and exit time range, on indexed columns.
+        '''
+        conditions, parameters = [], []
+        if plate is not None:
+            conditions.append("plate = ?")
+            parameters.append(plate)
+        if start is not None:
+            conditions.append("exit_time >= ?")
+            parameters.append(start.strftime(TIME_FORMAT))
+        if end is not None:
+            conditions.append("exit_time < ?")
+            parameters.append(end.strftime(TIME_FORMAT))
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return where, parameters
+
+    def query_history(self, plate=None, start=None, end=None):
+        where, parameters = self._where(plate, start, end)
+        return [SqliteHistoryRecords._to_record(row) for row in self.connection.execute(
+            "SELECT plate, entry_time, exit_time, fee FROM history_records"
+            + where + " ORDER BY id", parameters)]
+
+    def count_history(self, plate=None, start=None, end=None):
+        where, parameters = self._where(plate, start, end)
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM history_records" + where, parameters).fetchone()[0]
+
+    def history_plates(self):
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT plate FROM history_records")]
+
+    def page_history(self, offset, limit, plate=None, start=None, end=None):
+        where, parameters = self._where(plate, start, end)
+        key = (plate, start, end)
+        with self._anchors_lock:
+            after = self._page_anchors.get(key + (offset,)) if offset else None
+        if after is not None:
+            # The next page of the one before: seek from the last ID of that page
+            where += (" AND" if where else " WHERE") + " id > ?"
+            rows = self.connection.execute(
+                "SELECT id, plate, entry_time, exit_time, fee FROM history_records"
+                + where + " ORDER BY id LIMIT ?", parameters + [after, limit]).fetchall()
+        else:
+            rows = self.connection.execute(
+                "SELECT id, plate, entry_time, exit_time, fee FROM history_records"
+                + where + " ORDER BY id LIMIT ? OFFSET ?", parameters + [limit, offset]).fetchall()
+        if rows:
+            with self._anchors_lock:
+                if len(self._page_anchors) >= MAX_PAGE_ANCHORS:
+                    self._page_anchors.clear()
+                self._page_anchors[key + (offset + len(rows),)] = rows[-1][0]
+        return [(row[0], SqliteHistoryRecords._to_record(row[1:])) for row in rows]
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections = {}
+        self._local = threading.local()
+
+    def import_csv_records(self, parking_file=PARKING_RECORDS_FILE,
+                           history_file=HISTORY_RECORDS_FILE):
+        '''
+        This method copies the records of the CSV backend into the database, in one transaction.
+        It is meant to be run once when switching a parking lot over to SQLite.
+        '''
+        csv_storage = CsvRecordStorage(parking_file, history_file)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO parking_records (plate, entry_time) VALUES (?, ?)",
+                ((plate, entry_time.strftime(TIME_FORMAT))
+                 for plate, entry_time in csv_storage.parking_records.items()))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO history_records (id, plate, entry_time, exit_time, fee) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((record_id, plate, entry_time.strftime(TIME_FORMAT), exit_time.strftime(TIME_FORMAT), fee)
+                 for record_id, (plate, entry_time, exit_time, fee) in csv_storage.history_records.items()))
+        csv_storage.close()
+        self.clear_page_anchors()
+
+
+def create_storage(backend="csv", **options):
+    '''
+    This function creates the storage backend of the parking lot system.
+
+    ***Parameters***
+    backend: str
+        "csv" (the default), "partitioned" (CSV with monthly history files) or "sqlite".
+    options:
+        The keyword arguments of the backend class.
+
+    ***Returns***
+    RecordStorage
+        The storage backend.
+    '''
+    if backend == "csv":
+        return CsvRecordStorage(**options)
+    if backend == "partitioned":
+        # Imported here, the partitioned backend is built on this module
+        from car_system.partitioned_storage import PartitionedRecordStorage
+        return PartitionedRecordStorage(**options)
+    if backend == "sqlite":
+        return SqliteRecordStorage(**options)
+    raise ValueError(f"Unknown storage backend: {backend}")
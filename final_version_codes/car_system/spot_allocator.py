@@ -0,0 +1,310 @@
+'''
+This module assigns the parking spots. The parking lot is described by a layout of levels, zones
+and spot counts per type, e.g. {"L1": {"A": {"standard": 120, "ev": 8, "disabled": 4}}},
+saved as JSON in SPOT_LAYOUT_FILE. Without a layout file the parking lot has no capacity limit, as before.
+The assigned spots are appended to SPOT_ASSIGNMENTS_FILE, so the parked vehicles get their own spots back
+after a restart.
+'''
+
+import os
+import csv
+import heapq
+import json
+import threading
+from collections import namedtuple
+
+SPOT_LAYOUT_FILE = "final_version_codes/data_storage/spot_layout.json"
+SPOT_ASSIGNMENTS_FILE = "final_version_codes/data_storage/spot_assignments.csv"
+SPOT_TYPES = ("standard", "compact", "ev", "disabled")
+# The spot types a vehicle may take, in order of preference, e.g. an EV parks on a standard spot once the EV spots are full
+FALLBACK_TYPES = {
+    "standard": ("standard",),
+    "compact": ("compact", "standard"),
+    "ev": ("ev", "standard"),
+    "disabled": ("disabled", "standard"),
+}
+
+Spot = namedtuple("Spot", ["number", "level", "zone", "spot_type"])
+
+
+class SpotAllocator:
+    '''
+    This is a class for the allocation of the parking spots.
+    The spots are numbered level by level and zone by zone, and the free spots are kept in min-heaps,
+    one per spot type and one per (level, zone, type), so the lowest free spot is found in O(log n)
+    whether or not a level or zone is requested. A spot taken through one heap stays in the other one
+    until it is popped and found busy in the free bitmap, and a released spot is only pushed to the heaps
+    it is not in anymore, so a spot is at most once in each heap and every operation is amortized O(log n).
+    The free spot counts per level, zone and type are kept up to date, so reading them is O(1).
+    With an assignments file, every assignment is appended to it as a "plate,number,level,zone,spot type" line
+    and every release as a "plate" line; restore gives the spots back at startup and rewrites the file compactly.
+
+    Attributes:
+    spots: The Spot of every number.
+    levels: The level names, in layout order.
+    capacity: The total number of spots.
+    assignments: The spot number of every parked plate.
+    assignments_file: The path of the file of the assigned spots, None to not keep them.
+
+    Methods:
+    from_layout_file: Create the allocator of a JSON layout file.
+    restore: Give the parked vehicles their spots back after a restart.
+    assign: Assign the lowest free spot to a plate.
+    release: Free the spot of a plate.
+    spot_of: Return the Spot of a plate.
+    free_count: Return the number of free spots of a level, zone or type.
+    occupied_count: Return the number of occupied spots.
+    is_full: Return whether no spot is free for a vehicle type.
+    close: Close the assignments file.
+    '''
+
+    def __init__(self, layout, assignments_file=None):
+        self.spots = []
+        self.levels = list(layout)
+        self._free = bytearray()
+        self._in_heap = {"type": bytearray(), "group": bytearray()}  # Whether a spot is still in its heaps
+        self._type_heaps = {}   # spot type -> free spot numbers
+        self._group_heaps = {}  # (level, zone, spot type) -> free spot numbers
+        self._free_counts = {}  # (level, zone, spot type), None for any -> free spots
+        for level, zones in layout.items():
+            for zone, counts in zones.items():
+                for spot_type, count in counts.items():
+                    if spot_type not in SPOT_TYPES:
+                        raise ValueError(f"Unknown spot type: {spot_type}")
+                    for _ in range(count):
+                        self._add_spot(Spot(len(self.spots), level, zone, spot_type))
+        self.capacity = len(self.spots)
+        self.assignments = {}
+        self.assignments_file = assignments_file
+        self._journal = None
+        self._journal_lines = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_layout_file(cls, file_path=SPOT_LAYOUT_FILE, assignments_file=SPOT_ASSIGNMENTS_FILE):
+        '''
+        This method creates the allocator of a JSON layout file, or returns None if there is no such file.
+        '''
+        try:
+            with open(file_path, mode="r") as file:
+                return cls(json.load(file), assignments_file)
+        except FileNotFoundError:
+            return None
+
+    def _read_assignments(self):
+        '''
+        This method returns the Spot of the plates in the assignments file, the released plates left out.
+        '''
+        assignments = {}
+        try:
+            with open(self.assignments_file, mode="r", newline="") as file:
+                for row in csv.reader(file):
+                    if len(row) == 1:
+                        assignments.pop(row[0], None)
+                    elif len(row) == 5 and row[1].isdigit():
+                        assignments[row[0]] = Spot(int(row[1]), *row[2:])
+                    # Otherwise a torn last line after a crash
+        except FileNotFoundError:
+            pass  # If file not found, it means no spot was assigned yet
+        return assignments
+
+    def restore(self, plates):
+        '''
+        This method gives the parked vehicles their spots back after a restart, from the assignments file,
+        and then rewrites the file with the current assignments only. A vehicle whose spot is unknown,
+        e.g. parked before the file existed, or is not in the layout anymore, gets the lowest free spot
+        for the type of its old spot, standard by default.
+
+        ***Parameters***
+        plates: iterable
+            The parked plates, in order of entry.
+
+        ***Returns***
+        list
+            The plates which could not be placed, no spot being free for them.
+        '''
+        plates = list(plates)
+        saved = self._read_assignments() if self.assignments_file else {}
+        with self._lock:
+            for plate in plates:
+                spot = saved.get(plate)
+                if spot is not None and spot.number < self.capacity and self.spots[spot.number] == spot \
+                        and self._free[spot.number] and plate not in self.assignments:
+                    self._take(plate, spot.number)
+        unplaced = []
+        for plate in plates:
+            spot_type = saved[plate].spot_type if plate in saved else "standard"
+            if plate not in self.assignments and self.assign(plate, spot_type) is None:
+                unplaced.append(plate)
+        if self.assignments_file:
+            with self._lock:
+                self._rewrite_assignments()
+        return unplaced
+
+    def _rewrite_assignments(self):
+        '''
+        This method replaces the assignments file with the current assignments and reopens it for appending.
+        '''
+        if self._journal is not None:
+            self._journal.close()
+        temp_file = self.assignments_file + ".tmp"
+        with open(temp_file, mode="w", newline="") as file:
+            csv.writer(file).writerows(
+                [plate, *self.spots[number]] for plate, number in self.assignments.items())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.assignments_file)
+        self._journal = open(self.assignments_file, mode="a", newline="")
+        self._journal_lines = len(self.assignments)
+
+    def _record(self, plate, number):
+        '''
+        This method appends an assignment, or a release if number is None, to the assignments file.
+        It is flushed but not synced: a line lost in a crash only moves that vehicle to another spot at restart.
+        The file is rewritten once it has a few lines per spot, so it stays bounded by the lot size.
+        '''
+        if self.assignments_file is None:
+            return
+        if self._journal is None:
+            self._journal = open(self.assignments_file, mode="a", newline="")
+        csv.writer(self._journal).writerow([plate] if number is None else [plate, *self.spots[number]])
+        self._journal.flush()
+        self._journal_lines += 1
+        if self._journal_lines > 4 * self.capacity + 1024:
+            self._rewrite_assignments()
+
+    def _take(self, plate, number):
+        '''
+        This method marks a free spot as assigned to a plate. The spot stays in its heaps
+        until it is popped and found busy.
+        '''
+        spot = self.spots[number]
+        self._free[number] = 0
+        for key in self._count_keys(spot):
+            self._free_counts[key] -= 1
+        self.assignments[plate] = number
+        return spot
+
+    @staticmethod
+    def _count_keys(spot):
+        '''
+        This method returns the keys of the free spot counts a spot is counted in.
+        '''
+        level, zone, spot_type = spot.level, spot.zone, spot.spot_type
+        return ((None, None, None), (level, None, None), (level, zone, None),
+                (None, None, spot_type), (level, None, spot_type), (level, zone, spot_type))
+
+    def _add_spot(self, spot):
+        self.spots.append(spot)
+        self._free.append(1)
+        self._in_heap["type"].append(1)
+        self._in_heap["group"].append(1)
+        self._type_heaps.setdefault(spot.spot_type, []).append(spot.number)
+        self._group_heaps.setdefault((spot.level, spot.zone, spot.spot_type), []).append(spot.number)
+        for key in self._count_keys(spot):
+            self._free_counts[key] = self._free_counts.get(key, 0) + 1
+
+    def _pop_free(self, heap, kind):
+        '''
+        This method pops the lowest free spot of a heap, dropping the numbers taken through another heap.
+        '''
+        in_heap = self._in_heap[kind]
+        while heap:
+            number = heapq.heappop(heap)
+            in_heap[number] = 0
+            if self._free[number]:
+                return number
+        return None
+
+    def assign(self, plate, vehicle_type="standard", level=None, zone=None):
+        '''
+        This method assigns the lowest free spot to a plate.
+
+        ***Parameters***
+        plate: str
+            The license plate of the vehicle.
+        vehicle_type: str
+            The type of the vehicle, it may also take the spot types of FALLBACK_TYPES.
+        level, zone: str
+            Only a spot of this level, or of this zone of the level.
+
+        ***Returns***
+        Spot
+            The assigned spot, None if no spot is free.
+        '''
+        with self._lock:
+            if plate in self.assignments:
+                return self.spots[self.assignments[plate]]
+            for spot_type in FALLBACK_TYPES.get(vehicle_type, (vehicle_type,)):
+                if level is None:
+                    number = self._pop_free(self._type_heaps.get(spot_type, []), "type")
+                else:
+                    number = None
+                    for group, heap in self._group_heaps.items():
+                        if group[0] == level and (zone is None or group[1] == zone) and group[2] == spot_type:
+                            number = self._pop_free(heap, "group")
+                            if number is not None:
+                                break
+                if number is not None:
+                    break
+            else:
+                return None
+            spot = self._take(plate, number)
+            self._record(plate, number)
+            return spot
+
+    def release(self, plate):
+        '''
+        This method frees the spot of a plate and returns it, None if the plate had no spot.
+        '''
+        with self._lock:
+            number = self.assignments.pop(plate, None)
+            if number is None:
+                return None
+            self._record(plate, None)
+            spot = self.spots[number]
+            self._free[number] = 1
+            for key in self._count_keys(spot):
+                self._free_counts[key] += 1
+            if not self._in_heap["type"][number]:
+                self._in_heap["type"][number] = 1
+                heapq.heappush(self._type_heaps[spot.spot_type], number)
+            if not self._in_heap["group"][number]:
+                self._in_heap["group"][number] = 1
+                heapq.heappush(self._group_heaps[(spot.level, spot.zone, spot.spot_type)], number)
+            return spot
+
+    def spot_of(self, plate):
+        '''
+        This method returns the Spot of a parked plate, or None.
+        '''
+        number = self.assignments.get(plate)
+        return None if number is None else self.spots[number]
+
+    def free_count(self, level=None, zone=None, spot_type=None):
+        '''
+        This method returns the number of free spots, of a level, of a zone of a level and/or of a spot type, in O(1).
+        '''
+        return self._free_counts.get((level, zone if level is not None else None, spot_type), 0)
+
+    def occupied_count(self):
+        '''
+        This method returns the number of occupied spots.
+        '''
+        return self.capacity - self._free_counts.get((None, None, None), 0)
+
+    def is_full(self, vehicle_type="standard"):
+        '''
+        This method returns whether no spot is free for a vehicle type.
+        '''
+        return not any(self._free_counts.get((None, None, spot_type), 0)
+                       for spot_type in FALLBACK_TYPES.get(vehicle_type, (vehicle_type,)))
+
+    def close(self):
+        '''
+        This method closes the assignments file.
+        '''
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
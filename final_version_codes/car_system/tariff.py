@@ -0,0 +1,180 @@
+import numpy as np
+
+HOURS_PER_WEEK = 7 * 24
+DAYS_PER_WEEK = 7
+# 1970-01-01, the origin of the epoch seconds, was a Thursday (Monday = 0)
+EPOCH_WEEKDAY = 3
+EPOCH_ORDINAL = 719163
+
+
+def to_epoch_seconds(times):
+    '''
+    This function converts times to int64 seconds since 1970-01-01, keeping the wall clock time.
+
+    ***Parameters***
+    times: sequence of datetime or numpy.ndarray
+        The times, naive datetimes or a datetime64/int64 array.
+
+    ***Returns***
+    numpy.ndarray
+        The int64 seconds.
+    '''
+    if isinstance(times, np.ndarray):
+        if times.dtype.kind == "i":
+            return times.astype(np.int64, copy=False)
+        return times.astype("datetime64[s]").astype(np.int64)
+    # Reading the fields is several times faster than letting NumPy convert the datetime objects
+    return np.fromiter(
+        ((time.toordinal() - EPOCH_ORDINAL) * 86400 + time.hour * 3600 + time.minute * 60 + time.second
+         for time in times), dtype=np.int64)
+
+
+class Tariff:
+    '''
+    This is a class for the parking rates.
+    The stay is billed by the hour, each billed hour at the rate of the hour of the week it starts in,
+    so the time-of-day bands and the weekend rate apply to the part of the stay they cover.
+    The fees are computed on NumPy arrays: a week of rates is turned into prefix sums once, then the fee of
+    any stay is a few table lookups, whatever its length, and a whole history is billed without a Python loop.
+
+    Attributes:
+    hourly_rate: The rate of an hour outside of the bands.
+    bands: The (start hour, end hour, rate) time-of-day bands, e.g. (22, 6, 2) for a cheaper night.
+    weekend_rate: The rate of an hour on Saturdays and Sundays, None to apply the bands on weekends too.
+    daily_cap: The maximum fee of each 24 hours of a stay, None for no cap.
+    grace_minutes: The stays up to this long are free.
+    minimum_hours: The minimum number of billed hours of a paid stay.
+    round_up: Whether a started hour is billed, by default only the full hours are.
+
+    Methods:
+    from_dict: Create a tariff from its configuration.
+    hour_rates: Return the rate of each hour of the week.
+    compute_fees: Compute the billed hours and fees of arrays of stays.
+    compute_fee: Compute the billed hours and fee of one stay.
+    bill_records: Compute the fees of historical records.
+    '''
+
+    def __init__(self, hourly_rate=5, bands=None, weekend_rate=None, daily_cap=None,
+                 grace_minutes=0, minimum_hours=1, round_up=False):
+        self.hourly_rate = hourly_rate
+        self.bands = [tuple(band) for band in bands or []]
+        self.weekend_rate = weekend_rate
+        self.daily_cap = daily_cap
+        self.grace_minutes = grace_minutes
+        self.minimum_hours = minimum_hours
+        self.round_up = round_up
+        self._build_tables()
+
+    @classmethod
+    def from_dict(cls, config):
+        '''
+        This method creates a tariff from its configuration, e.g. loaded from a JSON file.
+        The keys are the names of the arguments of the constructor, the missing ones keep their default.
+        '''
+        return cls(**config)
+
+    def hour_rates(self):
+        '''
+        This method returns the rate of each of the 168 hours of the week, Monday 00:00 first.
+        '''
+        day = np.full(24, self.hourly_rate, dtype=np.float64)
+        for start, end, rate in self.bands:
+            if start <= end:
+                day[start:end] = rate
+            else:  # The band goes past midnight
+                day[start:] = rate
+                day[:end] = rate
+        week = np.tile(day, DAYS_PER_WEEK)
+        if self.weekend_rate is not None:
+            week[5 * 24:] = self.weekend_rate
+        return week
+
+    def _build_tables(self):
+        '''
+        This method precomputes the prefix sums used by compute_fees.
+        '''
+        rates = self.hour_rates()
+        # Two weeks, so any run of up to a week starting in the first one is a difference of prefix sums
+        self._prefix = np.concatenate(([0.0], np.cumsum(np.tile(rates, 2))))
+        self._week_total = self._prefix[HOURS_PER_WEEK]
+        if self.daily_cap is None:
+            return
+        # capped[h, d]: the capped fee of the first d full days of a stay starting at hour h of the week
+        hours = np.arange(HOURS_PER_WEEK)[:, None]
+        day_starts = (hours + 24 * np.arange(DAYS_PER_WEEK)[None, :]) % HOURS_PER_WEEK
+        day_fees = np.minimum(self._prefix[day_starts + 24] - self._prefix[day_starts], self.daily_cap)
+        self._capped_days = np.concatenate(
+            (np.zeros((HOURS_PER_WEEK, 1)), np.cumsum(day_fees, axis=1)), axis=1)
+
+    def _run_fee(self, first_hour, hours):
+        '''
+        This method sums the rates of runs of less than a week of billed hours.
+        '''
+        return self._prefix[first_hour + hours] - self._prefix[first_hour]
+
+    def compute_fees(self, entry_times, exit_times):
+        '''
+        This method computes the billed hours and fees of arrays of stays.
+
+        ***Parameters***
+        entry_times: sequence of datetime or numpy.ndarray
+            The entry times, naive datetimes, datetime64 or epoch seconds.
+        exit_times: sequence of datetime or numpy.ndarray
+            The exit times, in the same format.
+
+        ***Returns***
+        numpy.ndarray, numpy.ndarray
+            The int64 billed hours and the float64 fees.
+        '''
+        entry = to_epoch_seconds(entry_times)
+        duration = to_epoch_seconds(exit_times) - entry
+        if self.round_up:
+            hours = -(-duration // 3600)
+        else:
+            hours = duration // 3600
+        hours = np.maximum(hours, self.minimum_hours)
+        if self.grace_minutes:
+            hours = np.where(duration <= self.grace_minutes * 60, 0, hours)
+
+        days = entry // 86400
+        first_hour = ((days + EPOCH_WEEKDAY) % DAYS_PER_WEEK) * 24 + (entry % 86400) // 3600
+        if self.daily_cap is None:
+            weeks, rest = np.divmod(hours, HOURS_PER_WEEK)
+            fees = weeks * self._week_total + self._run_fee(first_hour, rest)
+        else:
+            full_days, rest = np.divmod(hours, 24)
+            weeks, days_left = np.divmod(full_days, DAYS_PER_WEEK)
+            fees = weeks * self._capped_days[first_hour, DAYS_PER_WEEK] \
+                + self._capped_days[first_hour, days_left]
+            last_day_hour = (first_hour + 24 * full_days) % HOURS_PER_WEEK
+            fees = fees + np.minimum(self._run_fee(last_day_hour, rest), self.daily_cap)
+        return hours, fees
+
+    def compute_fee(self, entry_time, exit_time):
+        '''
+        This method computes the billed hours and fee of one stay.
+
+        ***Returns***
+        int, float
+            The billed hours and the fee.
+        '''
+        hours, fees = self.compute_fees([entry_time], [exit_time])
+        return int(hours[0]), round(float(fees[0]), 2)
+
+    def bill_records(self, records):
+        '''
+        This method computes the fees of (plate, entry time, exit time, fee) records with this tariff,
+        e.g. to re-bill the history after a tariff change.
+
+        ***Returns***
+        numpy.ndarray
+            The fees, in the order of the records.
+        '''
+        if hasattr(records, "columns"):
+            # The columnar history store, no tuple is built
+            columns = records.columns()
+            return self.compute_fees(columns["entry_time"], columns["exit_time"])[1]
+        records = list(records)
+        entry_times = to_epoch_seconds(record[1] for record in records)
+        exit_times = to_epoch_seconds(record[2] for record in records)
+        return self.compute_fees(entry_times, exit_times)[1]
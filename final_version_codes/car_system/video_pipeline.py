@@ -0,0 +1,231 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from car_system.plate_recognizer import PlateRecognizer
+from car_system.preprocess import FramePreprocessor
+from car_system.parking_engine import ParkingError
+
+logger = logging.getLogger(__name__)
+
+
+class PlateDeduplicator:
+    '''
+    This is a class for merging the repeated reads of the same plate into one event.
+    A plate read again within window seconds of its last read is a duplicate, so a car
+    standing in front of the camera for many frames only produces one event.
+
+    Attributes:
+    window: The seconds after the last read during which the plate is not reported again.
+    last_seen: A dictionary of plate -> time of its last read, only for the recent plates.
+
+    Methods:
+    seen: Record a read and check whether it is a new event.
+    '''
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self.last_seen = {}
+        self._lock = threading.Lock()
+        self._last_purge = None
+
+    def seen(self, plate, timestamp):
+        '''
+        This method records a read of a plate at timestamp (in seconds).
+
+        ***Returns***
+        bool
+            True if this read is a new event, False if it is a repeat of a recent read.
+        '''
+        with self._lock:
+            last = self.last_seen.get(plate)
+            self.last_seen[plate] = timestamp
+            if self._last_purge is None or timestamp - self._last_purge >= self.window:
+                self.last_seen = {p: t for p, t in self.last_seen.items()
+                                  if timestamp - t < self.window}
+                self._last_purge = timestamp
+            return last is None or timestamp - last >= self.window
+
+
+class VideoRecognitionPipeline:
+    '''
+    This is a class for recognizing the license plates of a camera stream or a video file.
+    One thread decodes the frames, only the frames where something moved are sent to a pool of
+    recognition workers, and the repeated reads of a plate are merged into one event.
+    When the workers fall behind, more frames are skipped, and fewer again once they catch up,
+    so a CPU-only box keeps up with a real-time 25-30 fps stream.
+
+    Attributes:
+    source: The stream URL, camera index or video file, anything cv2.VideoCapture accepts.
+    on_plate: The callback of the events, called as on_plate(plate, confidence, timestamp).
+    recognizer: The plate recognizer, its pool has one inference session per worker.
+    preprocessor: The FramePreprocessor of the camera (region of interest and downscaling).
+    workers: The number of recognition workers.
+    min_confidence: The reads below this confidence are ignored.
+    motion_threshold: The mean pixel change (0-255) of the small gray frame needed to run recognition.
+    min_skip, max_skip: The bounds of the adaptive frame skipping, 1 means every frame is considered.
+    deduplicator: The PlateDeduplicator merging the repeated reads.
+    stats: A dictionary of counters of the frames: read, considered, moving (passed the motion gate),
+        recognized (a plate was found in them) and dropped (every worker was busy).
+
+    Methods:
+    start: Start the decoding thread.
+    stop: Ask the pipeline to stop.
+    join: Wait until the stream is finished and the pending recognitions are done.
+    run: Start the pipeline and wait until the stream is finished.
+    '''
+
+    def __init__(self, source, on_plate, recognizer=None, workers=2, min_confidence=0.8,
+                 motion_threshold=4.0, min_skip=1, max_skip=8, dedup_window=10.0, preprocessor=None):
+        self.source = source
+        self.on_plate = on_plate
+        self.workers = workers
+        self.recognizer = recognizer or PlateRecognizer(pool_size=workers)
+        self.preprocessor = preprocessor or FramePreprocessor()
+        self.min_confidence = min_confidence
+        self.motion_threshold = motion_threshold
+        self.min_skip = min_skip
+        self.max_skip = max_skip
+        self.deduplicator = PlateDeduplicator(dedup_window)
+        self.stats = {"read": 0, "considered": 0, "moving": 0,
+                      "recognized": 0, "dropped": 0}
+        self._skip = min_skip
+        self._in_flight = threading.Semaphore(workers)
+        self._executor = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key):
+        '''
+        This method increments one of the stats counters.
+        '''
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def start(self):
+        '''
+        This method loads the models and starts the decoding thread.
+        '''
+        self.recognizer.wait_until_ready()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="plate-video-worker")
+        self._thread = threading.Thread(
+            target=self._decode_loop, name="plate-video-decoder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        This method asks the decoding thread to stop after the current frame.
+        '''
+        self._stop.set()
+
+    def join(self):
+        '''
+        This method waits until the stream is finished and the pending recognitions are done.
+        '''
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def run(self):
+        '''
+        This method starts the pipeline and waits until the stream is finished.
+        '''
+        self.start()
+        self.join()
+
+    @staticmethod
+    def _motion_signature(frame):
+        '''
+        This method returns a small blurred gray version of the frame, cheap to compare.
+        '''
+        small = cv2.resize(frame, (64, 36), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(gray, (5, 5), 0)
+
+    def _decode_loop(self):
+        '''
+        This method reads the frames and sends the moving ones to the workers.
+        '''
+        capture = cv2.VideoCapture(self.source)
+        start = time.monotonic()
+        previous = None
+        index = 0
+        try:
+            while not self._stop.is_set():
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                self._count("read")
+                index += 1
+                if index % self._skip:
+                    continue
+                self._count("considered")
+                # Video files carry their own clock, live streams use the wall clock
+                position = capture.get(cv2.CAP_PROP_POS_MSEC)
+                timestamp = position / 1000 if position > 0 else time.monotonic() - start
+
+                signature = self._motion_signature(frame)
+                if previous is not None and \
+                        cv2.absdiff(signature, previous).mean() < self.motion_threshold:
+                    continue
+                self._count("moving")
+
+                if not self._in_flight.acquire(blocking=False):
+                    # Every worker is busy: drop this frame and skip more from now on
+                    self._count("dropped")
+                    self._skip = min(self._skip + 1, self.max_skip)
+                    continue
+                self._executor.submit(self._recognize, frame, timestamp)
+                # The next frames are compared with the last recognized one, not with a dropped one
+                previous = signature
+        finally:
+            capture.release()
+
+    def _recognize(self, frame, timestamp):
+        '''
+        This method recognizes one frame in a worker and reports the new plates.
+        Nobody waits for the result of a worker, so its errors are logged here instead of being lost in the future.
+        '''
+        try:
+            result = self.recognizer.recognize_plate(frame, self.preprocessor)
+            if result is not None:
+                self._count("recognized")
+                plate, confidence = result
+                if confidence >= self.min_confidence and self.deduplicator.seen(plate, timestamp):
+                    self.on_plate(plate, confidence, timestamp)
+        except Exception:
+            logger.exception("The recognition of the frame at %.2f s failed", timestamp)
+        finally:
+            self._in_flight.release()
+            # The workers kept up, consider more frames again
+            self._skip = max(self._skip - 1, self.min_skip)
+
+
+def gate_handler(engine, direction="entry"):
+    '''
+    This function returns an on_plate callback which registers the plates of a gate camera in the parking engine.
+
+    ***Parameters***
+    engine: ParkingEngine
+        The parking engine.
+    direction: str
+        "entry" or "exit", the direction of the gate.
+
+    ***Returns***
+    function
+        The on_plate callback, the refused operations (e.g. a car already inside) are logged and skipped.
+    '''
+    if direction not in ("entry", "exit"):
+        raise ValueError("direction must be 'entry' or 'exit'")
+    action = engine.enter if direction == "entry" else engine.exit
+
+    def on_plate(plate, confidence, timestamp):
+        try:
+            action(plate)
+        except ParkingError as error:
+            logger.warning("The %s gate refused %s (confidence %.2f): %s", direction, plate, confidence, error)
+    return on_plate
@@ -3,6 +3,7 @@ from tkinter import messagebox, filedialog
 from PIL import Image, ImageTk
 import pandas as pd
 import os
+from monitoring.metrics import EXPORT_SECONDS, EXPORTED_ROWS
 
 
 class DataExportImport:
@@ -13,18 +14,22 @@ class DataExportImport:
     root: The main window
     parking_records: A list of parking records
     history_records: A list of history records
+    storage: The RecordStorage the imported history records are written to, None to only extend history_records
 
     Methods:
     export_import_data: Display the data export/import menu
     export_parking_records: Export parking records
     export_history_records: Export history records
+    write_parking_records: Write the parking records to a file, without any dialog
+    write_history_records: Write the history records to a file, without any dialog
     import_records: Import records
     '''
 
-    def __init__(self, root, parking_records, history_records):
+    def __init__(self, root, parking_records, history_records, storage=None):
         self.root = root
         self.parking_records = parking_records
         self.history_records = history_records
+        self.storage = storage
 
     def export_import_data(self):
         '''
@@ -54,17 +59,14 @@ class DataExportImport:
         '''
         This method exports the parking records to an Excel file.
         '''
-        if self.parking_records == {}:
+        if not self.parking_records:
             messagebox.showerror("Error", "No parking records to export.")
             return
         try:
-            df = pd.DataFrame(
-                self.parking_records, columns=[
-                    "License Plate", "Entry Time"])
             file_path = filedialog.asksaveasfilename(defaultextension=".xlsx",
                                                      filetypes=[("Excel Files", "*.xlsx")])
             if file_path:
-                df.to_excel(file_path, index=False)
+                self.write_parking_records(file_path)
                 messagebox.showinfo(
                     "Success", "Parking records exported successfully.")
         except Exception as e:
@@ -75,27 +77,57 @@ class DataExportImport:
         '''
         This method exports the history records to an Excel file.
         '''
-        if self.history_records == []:
+        if not len(self.history_records):
             messagebox.showerror("Error", "No history records to export.")
             return
         try:
-            df = pd.DataFrame(
-                self.history_records,
-                columns=[
-                    "License Plate",
-                    "Entry Time",
-                    "Exit Time",
-                    "Fee"])
             file_path = filedialog.asksaveasfilename(defaultextension=".xlsx",
                                                      filetypes=[("Excel Files", "*.xlsx")])
             if file_path:
-                df.to_excel(file_path, index=False)
+                self.write_history_records(file_path)
                 messagebox.showinfo(
                     "Success", "History records exported successfully.")
         except Exception as e:
             messagebox.showerror(
                 "Error", f"Failed to export history records: {e}")
 
+    @staticmethod
+    def _write(df, file_path):
+        '''
+        This method writes a DataFrame as CSV or Excel, depending on the file extension.
+        '''
+        if file_path.endswith(".csv"):
+            df.to_csv(file_path, index=False)
+        else:
+            df.to_excel(file_path, index=False)
+
+    def write_parking_records(self, file_path):
+        '''
+        This method writes the parking records to an Excel or CSV file, it is the export without the dialogs.
+        '''
+        with EXPORT_SECONDS.time(operation="export", records="parking"):
+            df = pd.DataFrame(
+                list(self.parking_records.items()), columns=[
+                    "License Plate", "Entry Time"])
+            self._write(df, file_path)
+        EXPORTED_ROWS.inc(len(df), operation="export", records="parking")
+
+    def write_history_records(self, file_path, records=None):
+        '''
+        This method writes the history records, or the given ones, to an Excel or CSV file,
+        it is the export without the dialogs.
+        '''
+        with EXPORT_SECONDS.time(operation="export", records="history"):
+            df = pd.DataFrame(
+                list(self.history_records if records is None else records),
+                columns=[
+                    "License Plate",
+                    "Entry Time",
+                    "Exit Time",
+                    "Fee"])
+            self._write(df, file_path)
+        EXPORTED_ROWS.inc(len(df), operation="export", records="history")
+
     def import_records(self, record_type):
         '''
         This method imports records from an Excel or CSV file.
@@ -104,14 +136,22 @@ class DataExportImport:
             file_path = filedialog.askopenfilename(
                 filetypes=[("Excel Files", "*.xlsx"), ("CSV Files", "*.csv")])
             if file_path:
-                if file_path.endswith(".csv"):
-                    df = pd.read_csv(file_path)
-                else:
-                    df = pd.read_excel(file_path)
-                if record_type == "parking":
-                    self.parking_records.extend(df.values.tolist())
-                elif record_type == "history":
-                    self.history_records.extend(df.values.tolist())
+                with EXPORT_SECONDS.time(operation="import", records=record_type):
+                    if file_path.endswith(".csv"):
+                        df = pd.read_csv(file_path)
+                    else:
+                        df = pd.read_excel(file_path)
+                    if record_type == "parking":
+                        self.parking_records.extend(df.values.tolist())
+                    elif record_type == "history":
+                        records = [(plate, pd.Timestamp(entry_time).to_pydatetime(),
+                                    pd.Timestamp(exit_time).to_pydatetime(), float(fee))
+                                   for plate, entry_time, exit_time, fee in df.iloc[:, :4].values.tolist()]
+                        if self.storage is not None:
+                            self.storage.import_history(records)
+                        else:
+                            self.history_records.extend(records)
+                EXPORTED_ROWS.inc(len(df), operation="import", records=record_type)
                 messagebox.showinfo(
                     "Success", f"Records imported successfully into {record_type} records.")
         except Exception as e:
@@ -0,0 +1,433 @@
+'''
+This module holds the counters, gauges and latency histograms of the parking lot system,
+and exports them in the Prometheus text format: written to a file for the textfile collector of
+a node exporter, or served on a localhost endpoint to be scraped.
+The metrics are disabled until enable (or configure_from_environment) is called: every update
+then returns after checking one flag, so the instrumented code pays almost nothing.
+
+The application enables them from the environment:
+    PARKING_METRICS_PORT=9464             serve http://127.0.0.1:9464/metrics
+    PARKING_METRICS_FILE=/path/parking.prom   rewrite the file every PARKING_METRICS_INTERVAL seconds (15)
+'''
+
+import os
+import time
+import logging
+import bisect
+import threading
+from abc import ABC, abstractmethod
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(labelnames, values, extra=()):
+    '''
+    This function formats the labels of a sample, e.g. {result="success",le="0.5"}.
+    '''
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(ABC):
+    '''
+    This is the base class of the metrics, a metric has one value per combination of its label values.
+    '''
+
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def _samples(self):
+        '''
+        This method returns the (name, formatted labels, value) samples of the metric.
+        '''
+
+    def render(self):
+        '''
+        This method returns the metric in the Prometheus text format.
+        '''
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self._samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    '''
+    This is a class for a value which only goes up, e.g. the number of vehicle entries.
+    '''
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        '''
+        This method adds amount to the counter of the labels.
+        '''
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values = {(): 0}
+        return [(self.name + "_total", _format_labels(self.labelnames, key), value)
+                for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    '''
+    This is a class for a value which goes up and down, e.g. the occupancy.
+    A gauge can also read its value from a function at export time, so it costs nothing in between.
+    '''
+
+    kind = "gauge"
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        super().__init__(registry, name, documentation, labelnames)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        '''
+        This method sets the gauge of the labels.
+        '''
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        '''
+        This method adds amount, which may be negative, to the gauge of the labels.
+        '''
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, function, **labels):
+        '''
+        This method makes the gauge of the labels read function() whenever the metrics are exported.
+        '''
+        self._functions[self._key(labels)] = function
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, function in self._functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                continue  # A failing gauge is left out of this export, the others are still exported
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in sorted(values.items())]
+
+
+class _NullTimer:
+    '''
+    This is the timer returned by a disabled histogram, it does nothing.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    '''
+    This is a context manager observing its duration in a histogram.
+    '''
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    '''
+    This is a class for the distribution of a value, e.g. a latency in seconds, counted in cumulative buckets.
+    '''
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        '''
+        This method counts a value in the histogram of the labels.
+        '''
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def time(self, **labels):
+        '''
+        This method returns a context manager observing the duration of its block, in seconds.
+        '''
+        if not self.registry.enabled:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: (list(state[0]), state[1], state[2]) for key, state in self._values.items()}
+        samples = []
+        for key, (counts, count, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((self.name + "_bucket",
+                                _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))]),
+                                cumulative))
+            labels = _format_labels(self.labelnames, key)
+            samples.append((self.name + "_count", labels, count))
+            samples.append((self.name + "_sum", labels, total))
+        return samples
+
+
+class MetricsRegistry:
+    '''
+    This is a class for the set of metrics of the application and their export.
+
+    Attributes:
+    enabled: Whether the metrics are updated, False until enable is called.
+    server: The HTTP server of the metrics, None if they are not served.
+
+    Methods:
+    counter: Return the counter of a name, creating it on first use.
+    gauge: Return the gauge of a name, creating it on first use.
+    histogram: Return the histogram of a name, creating it on first use.
+    enable: Start updating the metrics.
+    render: Return all the metrics in the Prometheus text format.
+    write_textfile: Write the metrics to a file atomically.
+    start_textfile_writer: Rewrite the metrics file periodically in the background.
+    serve: Serve the metrics on a localhost HTTP endpoint.
+    close: Stop the server and the file writer.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.server = None
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._writer_thread = None
+
+    def _get(self, cls, name, documentation, labelnames, **options):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, documentation, labelnames, **options)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already a {metric.kind}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def enable(self, enabled=True):
+        '''
+        This method starts (or stops) updating the metrics.
+        '''
+        self.enabled = enabled
+
+    def render(self):
+        '''
+        This method returns all the metrics in the Prometheus text format.
+        '''
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return "".join(metric.render() + "\n" for metric in metrics)
+
+    def write_textfile(self, file_path):
+        '''
+        This method writes the metrics to a file, aside and then swapped in,
+        so the textfile collector never reads a half-written file.
+        '''
+        temp_file = file_path + ".tmp"
+        with open(temp_file, mode="w", encoding="utf-8") as file:
+            file.write(self.render())
+        os.replace(temp_file, file_path)
+
+    def start_textfile_writer(self, file_path, interval=15.0):
+        '''
+        This method rewrites the metrics file every interval seconds in a daemon thread.
+        '''
+        def write_periodically():
+            while not self._stop.wait(interval):
+                try:
+                    self.write_textfile(file_path)
+                except OSError:
+                    # e.g. a full disk or a folder being remounted, the next write may succeed
+                    logger.exception("Cannot write the metrics file %s", file_path)
+
+        self.write_textfile(file_path)
+        self._writer_thread = threading.Thread(target=write_periodically, name="metrics-textfile", daemon=True)
+        self._writer_thread.start()
+
+    def serve(self, port=9464, host="127.0.0.1"):
+        '''
+        This method serves the metrics on http://host:port/metrics in a daemon thread.
+        It listens on localhost by default, the node exporters scrape it from the same machine.
+        '''
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # No access log on the console of the application
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True).start()
+        return self.server.server_address
+
+    def close(self):
+        '''
+        This method stops the metrics server and the file writer.
+        '''
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+REGISTRY = MetricsRegistry()
+
+
+def timed(histogram, **labels):
+    '''
+    This function returns a decorator observing the duration of every call of a function in a histogram.
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not histogram.registry.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def configure_from_environment(registry=REGISTRY, environ=os.environ):
+    '''
+    This function enables the metrics and their export if PARKING_METRICS_PORT or PARKING_METRICS_FILE is set.
+
+    ***Returns***
+    bool
+        True if the metrics were enabled.
+    '''
+    port = environ.get("PARKING_METRICS_PORT")
+    file_path = environ.get("PARKING_METRICS_FILE")
+    if not port and not file_path:
+        return False
+    registry.enable()
+    if port:
+        registry.serve(int(port))
+    if file_path:
+        registry.start_textfile_writer(file_path, float(environ.get("PARKING_METRICS_INTERVAL", 15)))
+    return True
+
+
+# The metrics of the application, shared by the car, user and export systems
+RECOGNITION_SECONDS = REGISTRY.histogram(
+    "parking_recognition_seconds", "Duration of a license plate recognition from an uploaded image.")
+VEHICLE_EVENTS = REGISTRY.counter(
+    "parking_vehicle_events", "Vehicle entries and exits, by event and result.", ["event", "result"])
+CSV_SAVE_SECONDS = REGISTRY.histogram(
+    "parking_csv_save_seconds", "Duration of a save of the records CSV files.", ["file"])
+HISTORY_LOAD_SECONDS = REGISTRY.histogram(
+    "parking_history_load_seconds", "Duration of the history records load at startup.")
+UI_RENDER_SECONDS = REGISTRY.histogram(
+    "parking_ui_render_seconds", "Duration of the rendering of a screen or view.", ["view"])
+OCCUPANCY = REGISTRY.gauge(
+    "parking_occupancy", "Number of vehicles in the parking lot.")
+HISTORY_RECORDS = REGISTRY.gauge(
+    "parking_history_records", "Number of historical parking records.")
+LOGIN_ATTEMPTS = REGISTRY.counter(
+    "parking_login_attempts", "User login attempts, by result.", ["result"])
+LOGIN_SECONDS = REGISTRY.histogram(
+    "parking_login_seconds", "Duration of a login credential check: the user lookup and the scrypt check of the password.")
+REGISTRATIONS = REGISTRY.counter(
+    "parking_user_registrations", "User registrations and password resets, by action and result.",
+    ["action", "result"])
+USERS = REGISTRY.gauge(
+    "parking_users", "Number of registered users.")
+EXPORT_SECONDS = REGISTRY.histogram(
+    "parking_export_seconds", "Duration of an export or import of records.", ["operation", "records"])
+EXPORTED_ROWS = REGISTRY.counter(
+    "parking_exported_rows", "Rows exported or imported, by operation and records.", ["operation", "records"])
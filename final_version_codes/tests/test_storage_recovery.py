@@ -0,0 +1,122 @@
+'''
+This module tests the recovery of the CSV storage backend: the event log replayed after a restart,
+a compaction interrupted between writing the CSV files and its checkpoint, and the deleted records
+surviving a history compaction. Every test works in its own temporary folder and simulates a crash
+by closing the event log without the compaction of CsvRecordStorage.close.
+
+Run it from the final_version_codes folder:
+    python -m unittest discover tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+from car_system.event_log import EventLog
+from car_system.record_storage import CsvRecordStorage
+
+START = datetime(2024, 1, 1, 8, 0, 0)
+
+
+class CsvRecordStorageRecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storages = []
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.event_log.close()
+        shutil.rmtree(self.directory)
+
+    def open_storage(self):
+        '''
+        This method opens the storage of the test folder, no compaction runs unless the test starts it.
+        '''
+        path = lambda name: os.path.join(self.directory, name)
+        storage = CsvRecordStorage(
+            path("parking_records.csv"), path("history_records.csv"),
+            EventLog(path("events.log"), path("checkpoint.json"), fsync_policy="always", compact_every=10 ** 6),
+            path("history_tombstones.log"), compact_tombstones_at=10 ** 6)
+        self.storages.append(storage)
+        return storage
+
+    def crash(self, storage):
+        '''
+        This method stops a storage as a crash would, without folding the event log into the CSV files.
+        '''
+        storage.event_log.close()
+        self.storages.remove(storage)
+
+    def record_visits(self, storage, count, first=0):
+        '''
+        This method records count vehicles entering and exiting, and one vehicle still parked.
+        '''
+        for number in range(first, first + count):
+            entry_time = START + timedelta(hours=number)
+            storage.record_entry(f"A{number}", entry_time)
+            storage.record_exit(f"A{number}", entry_time, entry_time + timedelta(minutes=30), 5.0)
+        storage.record_entry(f"P{first}", START)
+
+    def assertSameRecords(self, storage, expected):
+        history = sorted(storage.history_records.items())
+        record_ids = [record_id for record_id, _ in history]
+        self.assertEqual(len(record_ids), len(set(record_ids)))
+        self.assertEqual(history, expected[0])
+        self.assertEqual(dict(storage.parking_records), expected[1])
+
+    @staticmethod
+    def snapshot(storage):
+        return sorted(storage.history_records.items()), dict(storage.parking_records)
+
+    def test_restart_replays_the_event_log(self):
+        storage = self.open_storage()
+        self.record_visits(storage, 20)
+        expected = self.snapshot(storage)
+        self.crash(storage)
+
+        self.assertSameRecords(self.open_storage(), expected)
+
+    def test_interrupted_compaction_loses_and_duplicates_nothing(self):
+        storage = self.open_storage()
+        self.record_visits(storage, 10)
+        storage.compact_records()
+        self.record_visits(storage, 10, first=10)
+        expected = self.snapshot(storage)
+        # The new records are appended to the history file, then the checkpoint fails
+        with mock.patch.object(EventLog, "checkpoint", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                storage.compact_records()
+        self.crash(storage)
+
+        storage = self.open_storage()
+        self.assertSameRecords(storage, expected)
+        self.record_visits(storage, 5, first=20)
+        expected = self.snapshot(storage)
+        storage.compact_records()
+        self.crash(storage)
+        self.assertSameRecords(self.open_storage(), expected)
+
+    def test_tombstones_survive_a_history_compaction(self):
+        storage = self.open_storage()
+        self.record_visits(storage, 20)
+        record_ids = [record_id for record_id, _ in storage.history_records.items()]
+        self.assertEqual(storage.delete_history_records(record_ids[:5]), 5)
+        storage.compact_history()
+        # Deleted after the compaction, only in the tombstone file
+        self.assertEqual(storage.delete_history_records(record_ids[5:8]), 3)
+        expected = self.snapshot(storage)
+        self.assertEqual(len(expected[0]), 12)
+        self.crash(storage)
+
+        storage = self.open_storage()
+        self.assertSameRecords(storage, expected)
+        storage.compact_history()
+        self.crash(storage)
+        self.assertSameRecords(self.open_storage(), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
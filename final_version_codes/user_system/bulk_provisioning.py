@@ -0,0 +1,162 @@
+'''
+This module registers a batch of users from a CSV file, e.g. the new staff of a season.
+The rows are validated and deduplicated against the existing users first, then the passwords and
+security answers are hashed over a pool of threads (scrypt releases the GIL, so the threads run on
+all the cores), and the whole batch is committed in a single transaction of the user store:
+either every valid user is added or, if the write fails, none of them.
+
+The CSV file has a header and the columns username, password, security_question, security_answer.
+
+Run it from the project folder, like the application:
+    PYTHONPATH=final_version_codes python -m user_system.bulk_provisioning users.csv [--workers N] [--dry-run]
+'''
+
+import os
+import sys
+import csv
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from user_system.password_hash import hash_password
+from user_system.user_store import UserStore, USERS_DATABASE_FILE
+
+CSV_COLUMNS = ("username", "password", "security_question", "security_answer")
+SECURITY_QUESTIONS = ("What is your pet's name?", "Where were you born?")
+MIN_PASSWORD_LENGTH = 6
+
+
+def read_users_csv(file_path):
+    '''
+    This function reads the users of a CSV file.
+
+    ***Returns***
+    list
+        (line number, row) pairs, the row being a dictionary of CSV_COLUMNS.
+    '''
+    with open(file_path, mode="r", newline="", encoding="utf-8-sig") as file:
+        reader = csv.DictReader(file)
+        missing = [column for column in CSV_COLUMNS if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"{file_path} has no column {', '.join(missing)}")
+        # The header is line 1
+        return [(line, row) for line, row in enumerate(reader, start=2)]
+
+
+def validate_users(rows, existing_users):
+    '''
+    This function checks the rows like the registration form does, and skips the usernames
+    which already exist or appear twice in the batch (the first row is kept).
+
+    ***Parameters***
+    rows: list
+        The (line number, row) pairs of read_users_csv.
+    existing_users: Mapping
+        The registered users, by username.
+
+    ***Returns***
+    list, list
+        The valid rows, and the (line number, username, message) of the rejected ones.
+    '''
+    valid, errors = [], []
+    seen = set()
+    for line, row in rows:
+        username = (row.get("username") or "").strip()
+        password = row.get("password") or ""
+        question = (row.get("security_question") or "").strip()
+        answer = row.get("security_answer") or ""
+        if not username or not password or not question or not answer:
+            message = "All fields are required"
+        elif username in existing_users:
+            message = "Username already exists"
+        elif username in seen:
+            message = "Duplicate username in the file"
+        elif len(password) < MIN_PASSWORD_LENGTH:
+            message = f"Password must be at least {MIN_PASSWORD_LENGTH} characters long"
+        elif question not in SECURITY_QUESTIONS:
+            message = "Unknown security question"
+        else:
+            seen.add(username)
+            valid.append({"username": username, "password": password,
+                          "security_question": question, "security_answer": answer})
+            continue
+        errors.append((line, username, message))
+    return valid, errors
+
+
+def _hash_user(row):
+    return row["username"], {
+        "password": hash_password(row["password"]),
+        "security_question": row["security_question"],
+        "security_answer": hash_password(row["security_answer"]),
+    }
+
+
+def hash_users(rows, workers=None):
+    '''
+    This function hashes the passwords and security answers of the valid rows over a pool of threads.
+
+    ***Returns***
+    dict
+        The user entries to store, by username, in the order of the rows.
+    '''
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(executor.map(_hash_user, rows))
+
+
+def provision_users(users, csv_file, workers=None):
+    '''
+    This function registers the valid users of a CSV file in the user store.
+
+    ***Parameters***
+    users: UserStore
+        The store of the registered users.
+    csv_file: str
+        The CSV file of the new users.
+    workers: int
+        The number of hashing threads, the number of CPU cores by default.
+
+    ***Returns***
+    list, list
+        The added usernames, and the (line number, username, message) of the rejected rows.
+    '''
+    rows = read_users_csv(csv_file)
+    valid, errors = validate_users(rows, users)
+    entries = hash_users(valid, workers)
+    added = users.add_many(entries)
+    if len(added) < len(entries):
+        # Registered by another terminal while the batch was hashed
+        lines = {}
+        for line, row in rows:
+            lines.setdefault((row.get("username") or "").strip(), line)
+        errors += sorted((lines[username], username, "Username already exists")
+                         for username in entries.keys() - set(added))
+    return added, errors
+
+
+def main(argv=None):
+    '''
+    This function provisions the users of the CSV file given on the command line and reports the rejected rows.
+    '''
+    parser = argparse.ArgumentParser(description="Register a batch of users from a CSV file.")
+    parser.add_argument("csv_file", help="CSV file with the columns " + ", ".join(CSV_COLUMNS) + ".")
+    parser.add_argument("--database", default=USERS_DATABASE_FILE, help="The user database to add them to.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of hashing threads (default: number of CPU cores).")
+    parser.add_argument("--dry-run", action="store_true", help="Only validate the file, do not write.")
+    args = parser.parse_args(argv)
+
+    users = UserStore(args.database)
+    if args.dry_run:
+        valid, errors = validate_users(read_users_csv(args.csv_file), users)
+        added = [row["username"] for row in valid]
+    else:
+        added, errors = provision_users(users, args.csv_file, args.workers)
+    users.close()
+    for line, username, message in errors:
+        print(f"line {line}: {username or '(no username)'}: {message}", file=sys.stderr)
+    print(f"{len(added)} users {'valid' if args.dry_run else 'added'}, {len(errors)} rejected")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
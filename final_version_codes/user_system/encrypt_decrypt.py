@@ -1,7 +1,14 @@
 import base64
+import threading
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
 
+PRIVATE_KEY_FILE = "final_version_codes/user_info_data/private_key.pem"
+PUBLIC_KEY_FILE = "final_version_codes/user_info_data/public_key.pem"
+
+_keys = None
+_keys_lock = threading.Lock()
+
 
 def encrypt_message(message, public_key):
     '''
@@ -56,19 +63,31 @@ def decrypt_message(encrypted_message, private_key):
     return decrypted_message.decode('utf-8')
 
 
-def load_keys():
+def load_keys(reload=False):
     '''
     This function loads the private and public keys from the files.
+    The keys are read and parsed once, the next calls return the cached keys.
+
+    ***Parameters***
+    reload: bool
+        Read the files again, e.g. after the keys were replaced.
 
     ***Returns***
     RSAPrivateKey, RSAPublicKey
         The private and public keys loaded from the files.
     '''
-    with open("final_version_codes/user_info_data/private_key.pem", "rb") as f:
-        private_key = serialization.load_pem_private_key(
-            f.read(), password=None)
+    global _keys
+    keys = _keys
+    if keys is not None and not reload:
+        return keys
+    with _keys_lock:
+        if _keys is None or reload:
+            with open(PRIVATE_KEY_FILE, "rb") as f:
+                private_key = serialization.load_pem_private_key(
+                    f.read(), password=None)
 
-    with open("final_version_codes/user_info_data/public_key.pem", "rb") as f:
-        public_key = serialization.load_pem_public_key(f.read())
+            with open(PUBLIC_KEY_FILE, "rb") as f:
+                public_key = serialization.load_pem_public_key(f.read())
 
-    return private_key, public_key
+            _keys = private_key, public_key
+        return _keys
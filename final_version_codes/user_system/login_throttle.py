@@ -0,0 +1,161 @@
+'''
+This module is the admission control in front of the credential checks (login, admin password, security answer).
+Every check costs a password hash, so a flood of wrong guesses, e.g. credential stuffing from a terminal,
+would keep the CPU busy and slow down the lanes. The throttle refuses them before any hashing:
+
+- every key (a username, a terminal) has a token bucket, each attempt takes a token and the bucket refills
+  at a steady rate, so a burst of attempts is allowed but not a sustained flood;
+- the consecutive failures of a key lock it out for a time which doubles with every further failure.
+
+A key costs one small entry, and the entries are kept from the least to the most recently used, so the idle ones
+are dropped from the front in O(1), like the sessions.
+'''
+
+import time
+import threading
+from collections import OrderedDict
+
+# (tokens per second, bucket size) by kind of key
+THROTTLE_LIMITS = {
+    "user": (1 / 5, 5),         # a burst of 5 attempts, then one every 5 seconds
+    "admin": (1 / 5, 5),        # the admin password, by terminal
+    "terminal": (1, 20),        # a burst of 20 attempts, then one per second
+}
+# Consecutive failures before the first lockout, by kind of key: a terminal is shared by the operators
+LOCKOUT_THRESHOLDS = {
+    "user": 5,
+    "admin": 5,
+    "terminal": 20,
+}
+BASE_LOCKOUT = 30               # seconds, doubled with every further failure
+MAX_LOCKOUT = 3600
+IDLE_TIMEOUT = 3600             # an entry unused this long is forgotten
+MAX_KEYS = 65536
+
+# The fields of an entry, a list to be updated in place
+_TOKENS, _UPDATED, _FAILURES, _LOCKED_UNTIL = range(4)
+
+
+class LoginThrottle:
+    '''
+    This is a class for the token buckets and lockouts of the credential checks. A key is a (kind, name) pair,
+    e.g. ("user", "alice"), ("admin", "lane-1") or ("terminal", "lane-1"), the kind selecting its limits.
+
+    Attributes:
+    limits: The (tokens per second, bucket size) by kind of key.
+    lockout_thresholds: The consecutive failures before a key is locked out, by kind of key.
+    base_lockout: The seconds of the first lockout, doubled with every further failure.
+    max_lockout: The seconds of a lockout at most.
+    idle_timeout: The seconds after which an unused entry is dropped, at least max_lockout.
+    max_keys: The number of entries kept at most.
+
+    Methods:
+    acquire: Admit an attempt for some keys, taking a token from each.
+    retry_after: Return the seconds to wait before an attempt would be admitted.
+    record_failure: Count a failed attempt, locking the keys out past the threshold.
+    record_success: Forget the failures of the keys.
+    '''
+
+    def __init__(self, limits=None, lockout_thresholds=None, base_lockout=BASE_LOCKOUT,
+                 max_lockout=MAX_LOCKOUT, idle_timeout=IDLE_TIMEOUT, max_keys=MAX_KEYS, clock=time.monotonic):
+        self.limits = dict(THROTTLE_LIMITS if limits is None else limits)
+        self.lockout_thresholds = dict(LOCKOUT_THRESHOLDS if lockout_thresholds is None else lockout_thresholds)
+        self.base_lockout = base_lockout
+        self.max_lockout = max_lockout
+        # A locked out entry is never idle long enough to be dropped
+        self.idle_timeout = max(idle_timeout, max_lockout)
+        self.max_keys = max_keys
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> [tokens, updated, failures, locked until], least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, now):
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if now - oldest[_UPDATED] < self.idle_timeout:
+                break
+            self._entries.popitem(last=False)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    def _tokens(self, key, entry, now):
+        rate, burst = self.limits[key[0]]
+        return min(burst, entry[_TOKENS] + (now - entry[_UPDATED]) * rate)
+
+    def _wait(self, key, entry, tokens, now):
+        rate, _ = self.limits[key[0]]
+        return max(entry[_LOCKED_UNTIL] - now, (1 - tokens) / rate if tokens < 1 else 0)
+
+    def _entry(self, key, now):
+        '''
+        This method returns the entry of a key with its bucket refilled, and marks it as the most recently used.
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [self.limits[key[0]][1], now, 0, 0]
+        else:
+            entry[_TOKENS] = self._tokens(key, entry, now)
+            self._entries.move_to_end(key)
+        entry[_UPDATED] = now
+        return entry
+
+    def acquire(self, *keys):
+        '''
+        This method admits an attempt if none of its keys is locked out or out of tokens, and then takes
+        a token from each; a refused attempt takes none.
+
+        ***Returns***
+        float
+            0 if the attempt is admitted, otherwise the seconds to wait.
+        '''
+        now = self._clock()
+        with self._lock:
+            entries = [self._entry(key, now) for key in keys]
+            wait = max((self._wait(key, entry, entry[_TOKENS], now) for key, entry in zip(keys, entries)), default=0)
+            if wait <= 0:
+                for entry in entries:
+                    entry[_TOKENS] -= 1
+            self._evict(now)
+        return max(wait, 0)
+
+    def retry_after(self, *keys):
+        '''
+        This method returns the seconds to wait before an attempt for the keys would be admitted, without taking a token.
+        '''
+        now = self._clock()
+        with self._lock:
+            wait = 0
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    wait = max(wait, self._wait(key, entry, self._tokens(key, entry, now), now))
+        return max(wait, 0)
+
+    def record_failure(self, *keys):
+        '''
+        This method counts a failed attempt for the keys. From the threshold-th consecutive failure on,
+        the key is locked out for base_lockout seconds, doubled with every further failure up to max_lockout.
+        '''
+        now = self._clock()
+        with self._lock:
+            for key in keys:
+                entry = self._entry(key, now)
+                entry[_FAILURES] += 1
+                excess = entry[_FAILURES] - self.lockout_thresholds[key[0]]
+                if excess >= 0:
+                    entry[_LOCKED_UNTIL] = now + min(self.max_lockout, self.base_lockout * 2 ** min(excess, 32))
+            self._evict(now)
+
+    def record_success(self, *keys):
+        '''
+        This method forgets the failures of the keys after a successful attempt.
+        '''
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry[_FAILURES] = 0
+                    entry[_LOCKED_UNTIL] = 0
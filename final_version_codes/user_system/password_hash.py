@@ -0,0 +1,85 @@
+'''
+This module hashes the passwords and security answers with scrypt, a salted and memory-hard function:
+a stored hash cannot be turned back into the password, and checking one costs the same bounded time
+whatever the number of users. The cost parameters are stored in the hash itself, so they can be raised
+later: the hashes made with older parameters still verify, and needs_rehash tells when to upgrade one.
+
+A hash is stored as "scrypt$n$r$p$salt$hash", the salt and hash in base64.
+'''
+
+import os
+import hmac
+import base64
+import hashlib
+
+HASH_PREFIX = "scrypt$"
+SCRYPT_N = 2 ** 14   # CPU/memory cost, about 60 ms and 16 MB per hash
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+def _scrypt(secret, salt, n, r, p):
+    return hashlib.scrypt(secret.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * r * n + 1024 * 1024, dklen=KEY_BYTES)
+
+
+def hash_password(secret, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    '''
+    This function hashes a password or security answer with a new random salt.
+
+    ***Parameters***
+    secret: str
+        The password or answer.
+    n, r, p: int
+        The scrypt cost parameters.
+
+    ***Returns***
+    str
+        The hash to store, "scrypt$n$r$p$salt$hash".
+    '''
+    salt = os.urandom(SALT_BYTES)
+    digest = _scrypt(secret, salt, n, r, p)
+    return HASH_PREFIX + f"{n}${r}${p}$" + base64.b64encode(salt).decode("ascii") \
+        + "$" + base64.b64encode(digest).decode("ascii")
+
+
+def is_password_hash(stored):
+    '''
+    This function tells a stored hash from an older RSA-encrypted value.
+    '''
+    return isinstance(stored, str) and stored.startswith(HASH_PREFIX)
+
+
+def _parse(stored):
+    _, n, r, p, salt, digest = stored.split("$")
+    return int(n), int(r), int(p), base64.b64decode(salt), base64.b64decode(digest)
+
+
+def verify_password(secret, stored):
+    '''
+    This function checks a password or security answer against its stored hash, in constant time.
+
+    ***Returns***
+    bool
+        True if the secret matches.
+    '''
+    try:
+        n, r, p, salt, digest = _parse(stored)
+    except (ValueError, TypeError):
+        return False
+    return hmac.compare_digest(_scrypt(secret, salt, n, r, p), digest)
+
+
+def needs_rehash(stored, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    '''
+    This function tells whether a stored value should be hashed again: an RSA-encrypted value,
+    or a hash made with other cost parameters.
+    '''
+    if not is_password_hash(stored):
+        return True
+    try:
+        return _parse(stored)[:3] != (n, r, p)
+    except (ValueError, TypeError):
+        return True
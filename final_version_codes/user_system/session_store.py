@@ -0,0 +1,132 @@
+'''
+This module keeps the login sessions of the operators in memory, so a terminal checks its
+credentials once per shift instead of once per action. A session is an opaque random token:
+validating it is one dictionary lookup, it never reads the key files or users.json.
+'''
+
+import time
+import secrets
+import threading
+from collections import OrderedDict, namedtuple
+
+Session = namedtuple("Session", ["username", "created", "expires", "last_seen"])
+
+SESSION_TTL = 12 * 3600      # A session lasts at most a shift
+IDLE_TIMEOUT = 30 * 60       # and ends after 30 minutes without any action
+MAX_SESSIONS = 1024
+TOKEN_BYTES = 32
+
+
+class SessionStore:
+    '''
+    This is a class for the in-memory store of the login sessions, with a TTL and an idle timeout.
+    The sessions are kept in an OrderedDict from the least to the most recently used, so the idle ones
+    are at the front: creating a session drops the idle sessions from the front and, once the store is full,
+    the least recently used one, each in O(1). Validating a token moves it to the back, also in O(1).
+
+    Attributes:
+    ttl: The seconds a session lasts at most after its creation.
+    idle_timeout: The seconds without validation after which a session ends.
+    max_sessions: The number of sessions kept at most.
+
+    Methods:
+    create: Open a session for a user and return its token.
+    validate: Return the user of a token, or None if the session ended.
+    get: Return the Session of a token without refreshing it.
+    revoke: End a session.
+    revoke_user: End all the sessions of a user.
+    purge_expired: Drop all the ended sessions.
+    '''
+
+    def __init__(self, ttl=SESSION_TTL, idle_timeout=IDLE_TIMEOUT, max_sessions=MAX_SESSIONS, clock=time.monotonic):
+        self.ttl = ttl
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._clock = clock
+        self._sessions = OrderedDict()  # token -> Session, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _alive(self, session, now):
+        return now < session.expires and now - session.last_seen < self.idle_timeout
+
+    def create(self, username):
+        '''
+        This method opens a session for a user who just passed the credential check.
+
+        ***Returns***
+        str
+            The opaque session token.
+        '''
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        now = self._clock()
+        with self._lock:
+            # The idle sessions are at the front, drop them before making room
+            while self._sessions:
+                oldest = next(iter(self._sessions.values()))
+                if now - oldest.last_seen < self.idle_timeout:
+                    break
+                self._sessions.popitem(last=False)
+            while len(self._sessions) >= self.max_sessions:
+                self._sessions.popitem(last=False)
+            self._sessions[token] = Session(username, now, now + self.ttl, now)
+        return token
+
+    def validate(self, token):
+        '''
+        This method checks a session token and refreshes its idle timeout.
+
+        ***Returns***
+        str
+            The username of the session, None if the token is unknown or the session ended.
+        '''
+        if not token:
+            return None
+        now = self._clock()
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            if not self._alive(session, now):
+                del self._sessions[token]
+                return None
+            self._sessions[token] = session._replace(last_seen=now)
+            self._sessions.move_to_end(token)
+            return session.username
+
+    def get(self, token):
+        '''
+        This method returns the Session of a token without refreshing it, None if the session ended.
+        '''
+        session = self._sessions.get(token)
+        if session is None or not self._alive(session, self._clock()):
+            return None
+        return session
+
+    def revoke(self, token):
+        '''
+        This method ends a session, e.g. at logout.
+        '''
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    def revoke_user(self, username):
+        '''
+        This method ends all the sessions of a user, e.g. after a password reset. It scans the sessions.
+        '''
+        with self._lock:
+            for token in [token for token, session in self._sessions.items() if session.username == username]:
+                del self._sessions[token]
+
+    def purge_expired(self):
+        '''
+        This method drops all the ended sessions and returns how many there were.
+        '''
+        now = self._clock()
+        with self._lock:
+            expired = [token for token, session in self._sessions.items() if not self._alive(session, now)]
+            for token in expired:
+                del self._sessions[token]
+        return len(expired)
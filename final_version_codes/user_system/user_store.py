@@ -0,0 +1,191 @@
+'''
+This module keeps the users in a SQLite database instead of one JSON file. A registration or password reset
+writes the one row it changes in a transaction, a login reads one row by its primary key, and the startup does
+not read the users at all. The database uses WAL journaling, so the terminals of a parking lot read it concurrently
+while SQLite serializes their writes: two terminals registering users at once can no longer lose one of them.
+
+The users of an existing users.json are copied into the database the first time it is opened, in the same
+transaction as a marker row: a failed import is retried at the next start, it never leaves an empty store behind.
+'''
+
+import os
+import json
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+USERS_FILE = "final_version_codes/user_info_data/users.json"
+USERS_DATABASE_FILE = "final_version_codes/user_info_data/users.db"
+USER_FIELDS = ("password", "security_question", "security_answer")
+JSON_MIGRATION = "users.json"
+
+
+class UserStore(Mapping):
+    '''
+    This is a class for the SQLite store of the users. It is a read-only mapping, username -> user entry
+    (a dictionary of USER_FIELDS), every lookup being a single query on the primary key; the writes go
+    through its methods. Every thread gets its own connection, closed once the thread ended.
+
+    Attributes:
+    database_file: The path of the SQLite database.
+    connection: The connection to the database of the calling thread.
+
+    Methods:
+    add: Register a user, unless the username exists.
+    add_many: Register a batch of users in one transaction.
+    set_field: Change one field of a user.
+    migrated: Tell whether a migration was done.
+    import_json: Copy the users of a JSON file into the database.
+    close: Close the connections.
+    '''
+
+    def __init__(self, database_file=USERS_DATABASE_FILE, users_file=USERS_FILE):
+        self.database_file = database_file
+        self._local = threading.local()
+        self._connections = {}  # thread -> connection
+        self._connections_lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    password TEXT NOT NULL,
+                    security_question TEXT NOT NULL,
+                    security_answer TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS migrations (
+                    name TEXT PRIMARY KEY
+                );
+            ''')
+        if users_file and os.path.exists(users_file) and not self.migrated(JSON_MIGRATION):
+            self.import_json(users_file)
+
+    @property
+    def connection(self):
+        '''
+        This property returns the connection of the calling thread, it is opened on first use.
+        Opening one closes those of the threads which ended, e.g. the threads of the metrics server.
+        '''
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.database_file, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                for thread in [thread for thread in self._connections if not thread.is_alive()]:
+                    self._connections.pop(thread).close()
+                self._connections[threading.current_thread()] = connection
+        return connection
+
+    def __getitem__(self, username):
+        row = self.connection.execute(
+            "SELECT password, security_question, security_answer FROM users WHERE username = ?",
+            (username,)).fetchone()
+        if row is None:
+            raise KeyError(username)
+        return dict(zip(USER_FIELDS, row))
+
+    def __contains__(self, username):
+        return self.connection.execute(
+            "SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is not None
+
+    def __iter__(self):
+        for (username,) in self.connection.execute("SELECT username FROM users ORDER BY username"):
+            yield username
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def add(self, username, entry):
+        '''
+        This method registers a user. The check and the insert are one statement, so two terminals
+        registering the same username at once cannot both succeed.
+
+        ***Returns***
+        bool
+            True if the user was added, False if the username already exists.
+        '''
+        with self.connection:
+            return self.connection.execute(
+                "INSERT OR IGNORE INTO users (username, password, security_question, security_answer) "
+                "VALUES (?, ?, ?, ?)",
+                (username, *(entry[field] for field in USER_FIELDS))).rowcount == 1
+
+    def add_many(self, entries):
+        '''
+        This method registers a batch of users in one transaction: either all the new ones are added or none.
+
+        ***Parameters***
+        entries: dict
+            The user entries, by username.
+
+        ***Returns***
+        list
+            The added usernames, without those which already existed.
+        '''
+        with self.connection:
+            return self._insert_many(entries)
+
+    def _insert_many(self, entries):
+        added = []
+        for username, entry in entries.items():
+            missing = [field for field in USER_FIELDS if not entry.get(field)]
+            if missing:
+                raise ValueError(f"User {username} has no {', '.join(missing)}")
+            if self.connection.execute(
+                    "INSERT OR IGNORE INTO users (username, password, security_question, security_answer) "
+                    "VALUES (?, ?, ?, ?)",
+                    (username, *(entry[field] for field in USER_FIELDS))).rowcount == 1:
+                added.append(username)
+        return added
+
+    def set_field(self, username, field, value):
+        '''
+        This method changes one field of a user, e.g. the password after a reset. Only this column
+        is written, so it does not undo a change of another field made meanwhile by another terminal.
+
+        ***Returns***
+        bool
+            True if the user exists.
+        '''
+        if field not in USER_FIELDS:
+            raise ValueError(f"Unknown user field: {field}")
+        with self.connection:
+            return self.connection.execute(
+                f"UPDATE users SET {field} = ? WHERE username = ?", (value, username)).rowcount == 1
+
+    def migrated(self, name):
+        '''
+        This method tells whether a migration, e.g. the import of users.json, was done.
+        '''
+        return self.connection.execute(
+            "SELECT 1 FROM migrations WHERE name = ?", (name,)).fetchone() is not None
+
+    def import_json(self, users_file=USERS_FILE):
+        '''
+        This method copies the users of a JSON file into the database and marks the migration done,
+        in one transaction: if an entry is invalid, nothing is imported and the error is raised.
+        The users already in the database are kept.
+
+        ***Returns***
+        int
+            The number of users added.
+        '''
+        with open(users_file, 'r') as file:
+            users = json.load(file)
+        with self.connection:
+            added = self._insert_many(users)
+            self.connection.execute(
+                "INSERT OR IGNORE INTO migrations (name) VALUES (?)", (JSON_MIGRATION,))
+        return len(added)
+
+    def close(self):
+        '''
+        This method closes the connections of all the threads.
+        '''
+        with self._connections_lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections = {}
+        self._local = threading.local()
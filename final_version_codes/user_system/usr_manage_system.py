@@ -4,9 +4,18 @@ from tkinter import filedialog
 from tkinter import simpledialog
 import json
 import os
+import hmac
+import math
+import socket
 from PIL import Image, ImageTk
 import base64
-from user_system.encrypt_decrypt import encrypt_message, decrypt_message, load_keys
+from user_system.encrypt_decrypt import decrypt_message, load_keys
+from user_system.password_hash import hash_password, verify_password, is_password_hash, needs_rehash
+from user_system.session_store import SessionStore
+from user_system.login_throttle import LoginThrottle
+from user_system.bulk_provisioning import SECURITY_QUESTIONS, provision_users
+from user_system.user_store import UserStore
+from monitoring.metrics import LOGIN_ATTEMPTS, LOGIN_SECONDS, REGISTRATIONS, USERS
 
 
 class UserSystem:
@@ -16,27 +25,42 @@ class UserSystem:
     Attributes:
     root: root window
     main_menu_callback: callback function to main menu
-    users_file: JSON file to store user information
     admin_file: JSON file to store admin information
-    users: dictionary to store user information
+    users: UserStore of the user information
     admin: dictionary to store admin information
+    sessions: SessionStore of the login sessions
+    session_token: token of the session opened on this terminal, None if logged out
+    throttle: LoginThrottle of the credential checks
+    terminal: name of this terminal, a key of the throttle
 
     Methods:
     load_admin: Load admin from a JSON file
-    load_users: Load users from a JSON file
-    save_users: Save users to a JSON file
+    save_admin: Save admin to a JSON file
+    check_secret: Check a password or security answer against its stored value
+    upgrade_secret: Replace a stored RSA-encrypted value with a password hash
     login_screen: User login screen
     verify_admin_password: Verify admin password
+    throttle_keys: Return the throttle keys of an attempt for a user
+    admit: Admit a credential check or show how long to wait
+    authenticate: Check credentials and open a session
     login: Login function
+    current_user: Return the user of the session of this terminal
+    logout: End the session of this terminal
+    import_users: Register the users of a CSV file
+    import_users_dialog: Import a CSV file of users chosen by the admin
     '''
 
-    def __init__(self, root, main_menu_callback):
+    def __init__(self, root, main_menu_callback, sessions=None, users=None, throttle=None, terminal=None):
         self.root = root
         self.main_menu_callback = main_menu_callback
-        self.users_file = 'final_version_codes/user_info_data/users.json'
+        self.sessions = sessions if sessions is not None else SessionStore()
+        self.session_token = None
+        self.throttle = throttle if throttle is not None else LoginThrottle()
+        self.terminal = terminal or socket.gethostname()
         self.admin_file = 'final_version_codes/user_info_data/admin.json'
-        self.load_users()
+        self.users = users if users is not None else UserStore()
         self.load_admin()
+        USERS.set_function(lambda: len(self.users))
 
     def load_admin(self):
         '''
@@ -48,23 +72,40 @@ class UserSystem:
         else:
             self.admin = {}
 
-    def load_users(self):
+    def save_admin(self):
         '''
-        This method loads the user information from a JSON file.
+        This method saves the admin information to a JSON file.
         '''
-        if os.path.exists(self.users_file):
-            with open(self.users_file, 'r') as file:
-                self.users = json.load(file)
-        else:
-            # messagebox.showinfo("Actions needed", "No users found. Please register first!")
-            self.users = {}
+        with open(self.admin_file, 'w') as file:
+            json.dump(self.admin, file)
+
+    def check_secret(self, secret, stored):
+        '''
+        This method checks a password or security answer against its stored value: a salted scrypt hash,
+        or the RSA-encrypted value of the entries saved before the hashes, decrypted with the cached key.
 
-    def save_users(self):
+        ***Returns***
+        bool
+            True if the secret matches.
         '''
-        This method saves the user information to a JSON file.
+        if is_password_hash(stored):
+            return verify_password(secret, stored)
+        private_key, _ = load_keys()
+        return hmac.compare_digest(decrypt_message(stored, private_key).encode(), secret.encode())
+
+    def upgrade_secret(self, entry, field, secret):
         '''
-        with open(self.users_file, 'w') as file:
-            json.dump(self.users, file)
+        This method replaces a stored RSA-encrypted value, or a hash with outdated parameters,
+        by a password hash once the secret was verified, so the entries migrate at their next use.
+
+        ***Returns***
+        bool
+            True if the entry changed and the field must be saved.
+        '''
+        if not needs_rehash(entry[field]):
+            return False
+        entry[field] = hash_password(secret)
+        return True
 
     def login_screen(self, callback=None):
         '''
@@ -121,32 +162,92 @@ class UserSystem:
         '''
         admin_password = simpledialog.askstring(
             "Admin", "Enter admin password:", show='*')
-        private_key, _ = load_keys()
-        encrypted_password = self.admin["admin"]["password"]
-        decrypted_password = decrypt_message(encrypted_password, private_key)
-
         if admin_password is None:
             return
-        if decrypted_password == admin_password:
+        # The admin password has its own key, apart from any user named "admin"
+        keys = ("admin", self.terminal), ("terminal", self.terminal)
+        if not self.admit(keys):
+            return
+        if self.check_secret(admin_password, self.admin["admin"]["password"]):
+            self.throttle.record_success(*keys)
+            if self.upgrade_secret(self.admin["admin"], "password", admin_password):
+                self.save_admin()
             self.register_screen()
         else:
+            self.throttle.record_failure(*keys)
             messagebox.showerror("Error", "Incorrect admin password")
 
+    def throttle_keys(self, username):
+        '''
+        This method returns the throttle keys of a credential check for a user from this terminal.
+        '''
+        return ("user", username), ("terminal", self.terminal)
+
+    def admit(self, keys):
+        '''
+        This method takes a token of the throttle for a credential check, or tells how long to wait.
+
+        ***Returns***
+        bool
+            True if the check may proceed.
+        '''
+        wait = self.throttle.acquire(*keys)
+        if wait:
+            LOGIN_ATTEMPTS.inc(result="throttled")
+            messagebox.showerror(
+                "Error", f"Too many attempts! Please try again in {math.ceil(wait)} seconds.")
+            return False
+        return True
+
+    def authenticate(self, username, password):
+        '''
+        This method checks the credentials of a user and opens a session for them.
+        It is the only step which reads the credentials, the session token is then validated in memory.
+        The attempt first goes through the throttle, and an unknown username is refused without hashing anything.
+
+        ***Returns***
+        str
+            The session token, None if the credentials are wrong or the attempt is throttled.
+        '''
+        keys = self.throttle_keys(username)
+        if self.throttle.acquire(*keys):
+            LOGIN_ATTEMPTS.inc(result="throttled")
+            return None
+        with LOGIN_SECONDS.time():
+            user_data = self.users.get(username)
+            valid = user_data is not None and self.check_secret(password, user_data["password"])
+        if valid:
+            LOGIN_ATTEMPTS.inc(result="success")
+            self.throttle.record_success(*keys)
+            if self.upgrade_secret(user_data, "password", password):
+                self.users.set_field(username, "password", user_data["password"])
+            return self.sessions.create(username)
+        LOGIN_ATTEMPTS.inc(result="failure")
+        self.throttle.record_failure(*keys)
+        return None
+
     def login(self):
         '''
-        This method verifies the user login credentials.
+        This method verifies the user login credentials and opens the session of this terminal.
         '''
-        if self.users == {}:
+        if not self.users:
+            LOGIN_ATTEMPTS.inc(result="no_users")
             messagebox.showinfo(
                 "Actions needed",
                 "No users found. Please register first!")
             return
         username = self.username_entry.get()
         password = self.password_entry.get()
-        private_key, _ = load_keys()
-        encrypted_password = self.users[username]["password"]
-        decrypted_password = decrypt_message(encrypted_password, private_key)
-        if username in self.users and decrypted_password == password:
+        wait = self.throttle.retry_after(*self.throttle_keys(username))
+        if wait:
+            LOGIN_ATTEMPTS.inc(result="throttled")
+            messagebox.showerror(
+                "Error", f"Too many attempts! Please try again in {math.ceil(wait)} seconds.")
+            return
+        token = self.authenticate(username, password)
+        if token is not None:
+            self.sessions.revoke(self.session_token)
+            self.session_token = token
             if self.callback:
                 self.callback()
             messagebox.showinfo("Info", "Login successful!")
@@ -154,6 +255,20 @@ class UserSystem:
             messagebox.showerror(
                 "Error", "Invalid username or password! Please try again or register first!")
 
+    def current_user(self):
+        '''
+        This method returns the user of the session of this terminal, None if there is none or it ended.
+        It refreshes the idle timeout of the session, so it is called on every operator action.
+        '''
+        return self.sessions.validate(self.session_token)
+
+    def logout(self):
+        '''
+        This method ends the session of this terminal.
+        '''
+        self.sessions.revoke(self.session_token)
+        self.session_token = None
+
     def register_screen(self):
         '''
         This method creates the user registration screen.
@@ -204,11 +319,8 @@ class UserSystem:
                 12)).pack()
         self.security_question_var = tk.StringVar(self.root)
         self.security_question_var.set("Select a question")
-        security_questions = [
-            "What is your pet's name?",
-            "Where were you born?"]
         self.security_question_menu = tk.OptionMenu(
-            self.root, self.security_question_var, *security_questions)
+            self.root, self.security_question_var, *SECURITY_QUESTIONS)
         self.security_question_menu.config(font=("Times New Roman", 12))
         self.security_question_menu.pack()
         tk.Label(
@@ -228,6 +340,8 @@ class UserSystem:
                 12),
             command=self.register).pack(
             pady=10)
+        tk.Button(self.root, text="Import Users from CSV", font=("Times New Roman", 12),
+                  command=self.import_users_dialog).pack(pady=10)
         tk.Button(self.root, text="Back to Login", font=("Times New Roman", 12),
                   command=lambda: self.login_screen(self.callback)).pack(pady=10)
 
@@ -240,32 +354,69 @@ class UserSystem:
         confirm_password = self.confirm_password_entry.get()
         security_question = self.security_question_var.get()
         security_answer = self.security_answer_entry.get()
-        _, public_key = load_keys()
         if username in self.users:
+            REGISTRATIONS.inc(action="register", result="rejected")
             messagebox.showerror("Error", "Username already existed!")
             return
         if len(password) < 6:
+            REGISTRATIONS.inc(action="register", result="rejected")
             messagebox.showerror(
                 "Error", "Password must be at least 6 characters long!")
             return
         if password == confirm_password:
             if username and password and security_question != "Select a question" and security_answer:
-                encrypted_password = encrypt_message(password, public_key)
-                encrypted_security_answer = encrypt_message(
-                    security_answer, public_key)
-                self.users[username] = {
-                    "password": encrypted_password,
+                if not self.users.add(username, {
+                    "password": hash_password(password),
                     "security_question": security_question,
-                    "security_answer": encrypted_security_answer
-                }
-                self.save_users()
+                    "security_answer": hash_password(security_answer)
+                }):
+                    # Registered by another terminal meanwhile
+                    REGISTRATIONS.inc(action="register", result="rejected")
+                    messagebox.showerror("Error", "Username already existed!")
+                    return
+                REGISTRATIONS.inc(action="register", result="success")
                 messagebox.showinfo("Info", "Registration successful!")
                 self.login_screen(self.callback)
             else:
+                REGISTRATIONS.inc(action="register", result="rejected")
                 messagebox.showerror("Error", "All fields are required!")
         else:
+            REGISTRATIONS.inc(action="register", result="rejected")
             messagebox.showerror("Error", "Passwords do not match!")
 
+    def import_users(self, csv_file, workers=None):
+        '''
+        This method registers the users of a CSV file, hashed in parallel and saved in a single transaction.
+
+        ***Returns***
+        list, list
+            The added usernames, and the (line number, username, message) of the rejected rows.
+        '''
+        added, errors = provision_users(self.users, csv_file, workers)
+        REGISTRATIONS.inc(len(added), action="import", result="success")
+        REGISTRATIONS.inc(len(errors), action="import", result="rejected")
+        return added, errors
+
+    def import_users_dialog(self):
+        '''
+        This method asks for a CSV file of users, imports it and shows a summary.
+        '''
+        csv_file = filedialog.askopenfilename(filetypes=[("CSV files", "*.csv")])
+        if not csv_file:
+            return
+        try:
+            added, errors = self.import_users(csv_file)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Error", f"Failed to import users: {e}")
+            return
+        summary = f"{len(added)} users registered, {len(errors)} rows rejected."
+        if errors:
+            summary += "\n\n" + "\n".join(
+                f"Line {line}: {username or '(no username)'}: {message}" for line, username, message in errors[:10])
+            if len(errors) > 10:
+                summary += f"\n... and {len(errors) - 10} more"
+        messagebox.showinfo("Import Users", summary)
+
     def forgot_password_screen(self):
         '''
         This method creates the forgot password screen.
@@ -295,11 +446,8 @@ class UserSystem:
                 12)).pack()
         self.security_question_var = tk.StringVar(self.root)
         self.security_question_var.set("Select a question")
-        security_questions = [
-            "What is your pet's name?",
-            "Where were you born?"]
         self.security_question_menu = tk.OptionMenu(
-            self.root, self.security_question_var, *security_questions)
+            self.root, self.security_question_var, *SECURITY_QUESTIONS)
         self.security_question_menu.config(font=("Times New Roman", 12))
         self.security_question_menu.pack()
         tk.Label(
@@ -330,18 +478,23 @@ class UserSystem:
         security_question = self.security_question_var.get()
         security_answer = self.security_answer_entry.get()
 
-        if username in self.users:
-            user_data = self.users[username]
-            private_key, _ = load_keys()
-            encrypted_security_answer = user_data["security_answer"]
-            decrypted_security_answer = decrypt_message(
-                encrypted_security_answer, private_key)
-            if user_data["security_question"] == security_question and decrypted_security_answer == security_answer:
+        keys = self.throttle_keys(username)
+        if not self.admit(keys):
+            return
+        user_data = self.users.get(username)
+        if user_data is not None:
+            if user_data["security_question"] == security_question \
+                    and self.check_secret(security_answer, user_data["security_answer"]):
+                self.throttle.record_success(*keys)
+                if self.upgrade_secret(user_data, "security_answer", security_answer):
+                    self.users.set_field(username, "security_answer", user_data["security_answer"])
                 self.show_reset_password_fields()
             else:
+                self.throttle.record_failure(*keys)
                 messagebox.showerror(
                     "Error", "Security question or answer is incorrect!")
         else:
+            self.throttle.record_failure(*keys)
             messagebox.showerror("Error", "Username not found!")
 
     def show_reset_password_fields(self):
@@ -377,23 +530,21 @@ class UserSystem:
         username = self.reset_username_entry.get()
         new_password = self.new_password_entry.get()
         confirm_new_password = self.confirm_new_password_entry.get()
-        private_key, public_key = load_keys()
 
         if new_password == confirm_new_password:
-            encrypted_new_password = encrypt_message(new_password, public_key)
-            encrypted_old_password = self.users[username]["password"]
-            decrypted_old_password = decrypt_message(
-                encrypted_old_password, private_key)
-
-            if new_password == decrypted_old_password:
+            if self.check_secret(new_password, self.users[username]["password"]):
+                REGISTRATIONS.inc(action="reset_password", result="rejected")
                 messagebox.showerror(
                     "Error", "New password cannot be the same as the old password!")
             else:
-                self.users[username]["password"] = encrypted_new_password
-                self.save_users()
+                self.users.set_field(username, "password", hash_password(new_password))
+                # The sessions opened with the old password end
+                self.sessions.revoke_user(username)
+                REGISTRATIONS.inc(action="reset_password", result="success")
                 messagebox.showinfo("Info", "Password reset successful!")
                 self.login_screen(self.callback)
         else:
+            REGISTRATIONS.inc(action="reset_password", result="rejected")
             messagebox.showerror("Error", "Passwords do not match!")
 
     def clear_frame(self):